@@ -5,71 +5,12 @@
 #TODO/FIXME:
 # Using external symbol files for dot graph
 
-from z80da import disassemble
-from z80cpc import checkFirmwareVector
-import subprocess
+from z80smart import Disassembler, hx, parseRegion
+from z80platform import platforms, defaultPlatform
+import z80state
+import z80sig
 import argparse
-import string
-
-#-- Globals
-
-# Memory = 64Kb
-mem= [0] * 65536
-# Code areas
-# Exceptions: memcode[pc] = -1. will be ignored
-memcode= [-1] * 65536
-memopcode= {}
-
-comments={}
-
-#Data for generating dot graph
-#Jump list
-jplist={} #[]
-#Jump destination list
-jptolist={}
-#Consecutive opcodes for generating dot graph
-nextopcode= {} #[-1] * 65536
-
-
-def hx( v ):
-   "Converts a number to an hex string"
-   return '#'+format(v, '02x')
-
-def addJump(adrfrom,adrto,opcode,jptype,stack,jpl):
-    #print(stack,jpl)
-    if stack!=None:
-        stack.append(adrto)
-    if jpl!=None:
-        jpl[adrfrom] = [adrfrom,adrto,jptype,opcode]
-    jptolist[adrto] = 1
-    #print(stack,jpl)
-
-def arrayAsDB(a):
-    res = "db "
-    st = ''
-    nc = 0
-    for i in range(len(a)):
-        if i != 0:
-            res+= ','
-        # Check if there is some text
-        if a[i][0]=='#':
-            v = int(a[i][1:],16)
-        else:
-            v = int(a[i][0:])
-        res+=hx(v) #a[i]
-        l = v & 0xdf # Remove bit 5
-        if l>=65 and l<65+26:
-            nc+=1
-            if v&32==32:
-                st+=string.ascii_lowercase[l-65]
-            else:
-                st+=string.ascii_uppercase[l-65]
-        else:
-            st = st+'.'
-    if nc>0:
-        res += ' ;'+st
-    return res
-
+import json
 
 ap = argparse.ArgumentParser()
 ap.add_argument('-i', '--input-file', default='input.bin', help='Input Binary file')
@@ -81,12 +22,31 @@ ap.add_argument('-a', '--start-adresses', nargs="+", help='Start adresses (in he
 ap.add_argument('-s', '--symbols',  help='Additional symbol file to use for disassembling with disark.')
 ap.add_argument('-r', '--regions',  help='Region file to use for disassembling with disark.')
 ap.add_argument('-x', '--exclude-adresses',  nargs="+", help='Exclude adresses (in hex format) - code won\'t be disassembled')
+ap.add_argument('-g', '--merge-gap', type=int, default=0, help='Write data regions separated by less than this number of code bytes as one region')
 ap.add_argument('-z', '--zero',  nargs="+", help='Region to fill with zeroes. (addr1-addr2 or addr1+nbytes, in hexadecimal)')
 ap.add_argument('-v', '--verbose', default=0, action='count', help='Increase Verbosity')
 ap.add_argument('-G', '--dot', action='store_true' , help='Generates a dot (graphviz) file')
+ap.add_argument('-F', '--graph-format', nargs="+", default=['dot'], choices=['dot', 'json', 'graphml'], help='Control flow graph formats written with -G')
+ap.add_argument('-C', '--call-graph', action='store_true', help='Generates a dot (graphviz) file of the functions and their calls')
+ap.add_argument('--root', help='Call graph: only functions around this adress (in hex format)')
+ap.add_argument('--depth', type=int, help='Call graph: maximum number of calls from the root')
+ap.add_argument('--max-nodes', type=int, help='Call graph: maximum number of functions')
+ap.add_argument('--cluster', default='0', help='Call graph: group functions by adress ranges of this size (in hex format)')
+ap.add_argument('-t', '--timing', action='store_true', help='Annotate instructions and basic blocks with their T-states and CPC NOPs')
+ap.add_argument('-l', '--loops', action='store_true', help='Generates a report of the loops ranked by cost per iteration')
 ap.add_argument('-c', '--check',  action='store_true', help='Reassemble and diff')
-ap.add_argument('-R', '--rasm',  default='rasm', help='Path to rasm binary')
 ap.add_argument('-u', '--undocumentedOpcodes',  action='store_false', help='Undocumented Opcodes to bytes')
+ap.add_argument('-P', '--platform',  default=defaultPlatform, choices=sorted(platforms), help='Platform whose firmware calls are named')
+ap.add_argument('-L', '--execution-log', nargs="+", help='Emulator execution logs (executed adresses) to trace from')
+ap.add_argument('--log-format', default='auto', choices=['auto', 'text', 'binary'], help='Execution log format: one hexadecimal adress per line, or 16 bit little endian adresses')
+ap.add_argument('-E', '--emulate', action='store_true', help='Run the code from the start adresses on an emulated Z80 to find more code')
+ap.add_argument('--emulate-limit', type=int, default=1000000, help='Emulation: maximum number of instructions run from each start adress')
+ap.add_argument('-T', '--scan-pointers', action='store_true', help='Trace the targets of the pointer tables found in the data regions')
+ap.add_argument('--min-pointers', type=int, default=4, help='Pointer tables: minimum number of consecutive pointers')
+ap.add_argument('-K', '--signatures', help='Signature file of known routines, found routines are named after them')
+ap.add_argument('--superset', action='store_true', help='Decode the instructions at every adress at once before tracing')
+ap.add_argument('--stats', action='store_true', help='Save the time of each phase and analysis counters in a JSON file')
+ap.add_argument('-S', '--state',  help='Analysis state file, reloaded if it matches the binary and options, then updated')
 
 #ap.add_argument('-D', '--diff',  help='Path to diff tool')
 args = vars(ap.parse_args())
@@ -100,193 +60,85 @@ output_prefix=args['input_file']
 if args['output_prefix']!=None:
     output_prefix=args['output_prefix']
 
-def storeNextPC(pc,nextpc):
-    nextopaddr = pc + nextpc
-    nextopcode[pc] = nextopaddr
+d = Disassembler(args['verbose'], args['platform'], args['superset'])
+phase = d.stats.phase
 
 fileName=args['input_file']
-with open(fileName, mode='rb') as file:
-    fileContent = file.read()
-
-#Copy file content to mem (FIXME: could be much faster)
 offset = int(args['org'],16)
-for i in range(len(fileContent)):
-    mem[i+offset] = fileContent[i]
-    memcode[i+offset] = 0
+with phase('load'):
+    d.load(fileName, offset)
 
 if args['zero'] != None :
-    #Fill with zeroes
-    for a in args['zero']:
-        ar = False
-        print (a)
-        if '-' in a:
-            ar = a.split('-')
-            ar[0] = int(ar[0],16)
-            ar[1] = int(ar[1],16)
-        elif '+' in a:
-            ar = a.split('+')
-            print(ar)
-            ar[0] = int(ar[0],16)
-            ar[1] = ar[0]+int(ar[1],16)
-        else:
-            print('Error: Bad region definition', a)
-        if ar is not False:
-            print('Filling with 0: ', ar[0],ar[1])
-            for i in range(ar[0],ar[1]):
-                mem[i]=0
-    #Now save binary file
-    fileName+='.tmp'
-    with open(fileName, mode='wb') as file:
-        # i+offset ... len(fileContent)
-        ab = bytearray(mem[offset:offset+len(fileContent)])
-        file.write(ab)
+    with phase('zero'):
+        #Fill with zeroes
+        for a in args['zero']:
+            print (a)
+            ar = parseRegion(a)
+            if ar is None:
+                print('Error: Bad region definition', a)
+            else:
+                print('Filling with 0: ', ar[0],ar[1])
+                d.zero(ar[0],ar[1])
+        #Now save binary file
+        fileName+='.tmp'
+        d.save_image(fileName)
 
 #Exclude
+excluded = []
 if args['exclude_adresses'] != None:
-    for a in args['exclude_adresses']:
-        memcode[int(a,16)] = -1
-
-#Bytes distribution
-#dist= [0] * 256
-#for i in fileContent:
-#    dist[i] += 1
-#print(len((fileContent)))
-
-#print(disassemble(fileContent,0x38))
-if mem[0x38]==0xC3:
-    print('Interruption #38 Handler: JP' , hx(mem[0x39] + 256*mem[0x3a]))
+    excluded = [int(a,16) for a in args['exclude_adresses']]
+    d.exclude(excluded)
+
+if d.mem[0x38]==0xC3:
+    print('Interruption #38 Handler: JP' , hx(d.mem[0x39] + 256*d.mem[0x3a]))
+
+starts = []
+if args['start_adresses'] != None:
+    starts = [int(a,16) for a in args['start_adresses']]
+
+#Reload a previous analysis, new start adresses are traced incrementally
+stateOptions = (offset, args['zero'], excluded, args['execution_log'], args['emulate'] and args['emulate_limit'], args['scan_pointers'] and args['min_pointers'])
+if args['state'] != None:
+    with phase('state'):
+        reason = z80state.load(d, args['state'], stateOptions, starts)
+        if reason is None:
+            print('Analysis state loaded from', args['state'])
+        else:
+            print('Analysis state not used:', reason)
 
-pcstack=[]
-if 'start_adresses' in args:
-    for a in args['start_adresses']:
-        pcstack.append(int(a,16))
+#Executed adresses are traced first
+for log in args['execution_log'] or []:
+    with phase('log'):
+        d.importLog(log, args['log_format'])
 
 #Start parsing
-while len(pcstack)>0:
-    start_pc = pc =pcstack.pop(0)
-    while True:
-        # decoder l'instruction en PC de facon simple
-        try:
-            op = disassemble(mem,pc)
-            (opcode,data,sz) = op
-            if args['verbose']>2:
-                print(hx(pc),op,hx(mem[pc]))
-        except Exception as e:
-            print(e,pc)
-            break;
-
-        if memcode[pc]<0:
-            break;
+with phase('trace'):
+    d.trace(starts)
 
-        if memcode[pc]>1: # and memcode[pc]!=1:
-            print(hx(start_pc), hx(pc), 'Warning: Jumping in the middle of an instruction!' )
-            break;
+if args['emulate']:
+    with phase('emulate'):
+        d.emulate(starts, args['emulate_limit'])
 
-        if memcode[pc]>0:
-            break;
+if args['scan_pointers']:
+    with phase('pointers'):
+        d.scanPointers(args['min_pointers'])
 
-        #Mark as code (>0)
-        for i in range(0,op[2]):
-            memcode[pc+i] = 1+i
-
-        memopcode[pc] = op
-
-        if opcode=='ld':
-            ldp=data.split(',')
-            if ldp[0]==ldp[1]:
-                print(hx(start_pc), hx(pc), 'Warning, unusual instruction:', opcode,data)
-
-        if opcode=='jp' or opcode=='jr' or ('rst' in opcode):
-            #is it a jp(hl) jp(ix) ... ?
-            if ('hl' in data) or ('ix' in data) or ('iy' in data):
-                print(hx(start_pc), hx(pc), 'JP ('+data+') encoutered')
-                break;
-            #is there a condition?
-            if ',' in op[1]:
-                ii = op[1].index(',')+1
-                #print (hx(start_pc), hx(pc),opcode,data,sz,op[1][ii:], hx(int(op[1][ii:],16)))
-                addJump(pc, int(op[1][ii:],16),opcode,"jump cond", pcstack,jplist)
-                #pcstack.append(int(op[1][ii:],16))
-                storeNextPC(pc,op[2])
-                pc += op[2]
-            else:
-                #print (hx(start_pc), hx(pc),op)
-                addJump(pc, int(op[1],16),opcode,'jump',None,jplist)
-                pc = int(op[1],16)
-                start_pc = pc
-
-        elif opcode=='call' :
-            if ',' in op[1]:
-                ii = op[1].index(',')+1
-                jpl='call cond'
-            else:
-                ii = 0
-                jpl='call'
-            addJump(pc, int(op[1][ii:],16),opcode,jpl,pcstack,jplist)
-            storeNextPC(pc,op[2])
-            pc += op[2]
-        elif  opcode=='djnz':
-            addJump(pc, int(op[1],16),opcode,'jump cond',pcstack,jplist)
-            storeNextPC(pc,op[2])
-            pc += op[2]
-        elif opcode=='ret' and data=='':
-            #print('RET=> on arrete' , opcode,data,pc,op[2], pcstack)
-            break
-        else:
-            #print(opcode,data)
-            storeNextPC(pc,op[2])
-            pc += op[2]
+if args['signatures'] != None:
+    with phase('signatures'):
+        sigs = z80sig.Signatures(args['signatures'])
+        print('Known routines found:', z80sig.match(d, sigs), 'of', len(sigs))
+        sigs.close()
 
+if args['state'] != None:
+    with phase('state'):
+        z80state.save(d, args['state'], stateOptions)
 
 #Generate Region file
 symfilename = args['regions']
 if args['regions'] == None :
-    # Symbols (for disark)
-    curZoneCodeType=True
-    curZoneStart=0
-    curZoneEnd=0
     symfilename=output_prefix+'.reg'
-    symfile = open(symfilename,"w")
-
-    for a in args['start_adresses']:
-        symfile.write('start_'+a.upper() + ' #' + a + '\n');
-        #symfile.write('start'+format(a,'04x') + ' equ ' + hx(a) + '\n');
-
-    i = 0
-    while i<len(mem):
-        t = memcode[i]>0
-
-        if t != curZoneCodeType:
-            # Zone complete curZoneStart-curZoneEnd
-            #print(';Zone',curZoneCodeType, hx(curZoneStart),hx(curZoneEnd-curZoneStart))
-            if curZoneCodeType==False:
-                symfile.write('data'+format(curZoneStart,'04X')+' '+hx(curZoneStart)+ '\n');
-                symfile.write('DisarkByteRegionStart'+hx(curZoneStart)+' '+hx(curZoneStart)+ '\n');
-                symfile.write('DisarkByteRegionEnd'+hx(curZoneStart)+' '+hx(curZoneEnd+1)+ '\n');
-            curZoneStart = i
-            curZoneCodeType = t
-
-
-        if t==True:
-            try:
-                curZoneEnd=i+memopcode[i][2]-1
-                i+=memopcode[i][2]
-            except Exception as e:
-                print(Exception, e, t, "i==",i,memcode[i])
-                curZoneEnd=i
-                i+=1
-        else:
-            curZoneEnd=i
-            i+=1
-
-    #Last region
-    if curZoneCodeType==False:
-        symfile.write('DisarkByteRegionStartLast'+' '+hx(curZoneStart)+ '\n');
-        symfile.write('DisarkByteRegionEndLast'+' '+hx(curZoneEnd)+ '\n');
-
-
-    symfile.close()
-
+    with phase('regions'), open(symfilename,"w") as symfile:
+        d.emit_regions(symfile, args['merge_gap'])
 
 #Additional symbols files: concatenate region file and symbol file
 if args['symbols'] != None :
@@ -304,161 +156,46 @@ outasm = output_prefix+".asm"
 # Disark
 if args['use_disark']==True:
     tmpfilename=output_prefix+".tmp"
-    path=  args['disark_path'] + "Disark"
-    print('Now running disark...', path, tmpfilename, symfilename)
-    options = [path, fileName, tmpfilename, "--loadAddress", str(offset) , "--genLabels", "--src8bitsValuesInHex", "--src16bitsValuesInHex", "--symbolFile",symfilename]
-    if args['undocumentedOpcodes']==False:
-        options.append("--undocumentedOpcodesToBytes")
-
-    print(options)
-    res = subprocess.run(options)
-    print(res)
+    with phase('disark'):
+        d.run_disark(fileName, tmpfilename, symfilename, args['disark_path'] + "Disark", args['undocumentedOpcodes'])
 
     print('Post processing...')
-    # Post processing
-    with open(tmpfilename, mode='rt') as file:
-        dfileContent = file.readlines()
-    dbcount = 0
-    dbl=[]
-    asmfile = open(outasm,"w")
-    #print(fileContent)
-
-    #TODO: handle dw
-    for l in dfileContent:
-        ll=l.strip()
-        # starts by a label?
-        if ('start' in ll and ll.index('start')==0) or ('data' in ll and ll.index('data')==0) or ('lab' in ll and ll.index('lab')==0):
-            if len(dbl)>0:
-                asmfile.write('  '+arrayAsDB(dbl)+'\n')
-                dbl=[]
-            spl = ll.split(' ')
-            asmfile.write(spl[0]+':\n')
-            ll = ll[len(spl[0])+1:]
-
-        if ('db' in ll) and (ll.index('db')==0):
-            dbl.append(ll[3:])
-            if len(dbl)==8:
-                asmfile.write('  '+arrayAsDB(dbl)+'\n')
-                dbl=[]
-        else:
-            if len(dbl)>0:
-                asmfile.write('  '+arrayAsDB(dbl)+'\n')
-                dbl=[]
-            # Add comments
-            comment=''
-            if 'call' in ll:
-                comment = checkFirmwareVector(ll)
-                if comment is False:
-                    comment=''
-                else:
-                    comment=' ; Call to firmware: '+comment
-            asmfile.write('  '+ll+comment + '\n')
-    asmfile.close()
+    with phase('postprocess'), open(outasm,"w") as asmfile:
+        d.postprocess_disark(tmpfilename, asmfile)
 else:
     #Generate asm file
     print('Generating ', outasm)
-    print("It's better to use disark with -d option")
-    asmfile = open(outasm,"w")
-    i=0
-    while i<len(mem):
-        if memcode[i]>0:
-            asmfile.write(' ' + memopcode[i][0] + ' ' + memopcode[i][1] + '\n')
-            i+=memopcode[i][2]
-        else:
-            #TODO: Group dbs
-            asmfile.write(' db ' +  hx(mem[i]) + '\n')
-            i+=1
-
-    asmfile.close()
+    with phase('asm'), open(outasm,"w") as asmfile:
+        d.emit_asm(asmfile, args['undocumentedOpcodes'], cycles=args['timing'])
 
 if args['check']==True:
-    rasmpath=args['rasm']
-
-    print('- running rasm', rasmpath, outasm)
-    res = subprocess.run([rasmpath, outasm])
-    print(res)
-
-    print('- comparing')
-    if res.returncode ==0:
-        with open('rasmoutput.bin', mode='rb') as file:
-            checkContent = file.read()
-        l1 = len(fileContent)
-        l2 = len(checkContent)
-        if l1!=l2:
-            print('Warning! File Length not matching ',l1,l2)
-        for i in range(l1):
-            if fileContent[i]!=checkContent[i]:
-                print(hx(i+offset) , 'Not Matching! ', hx(fileContent[i]), hx(checkContent[i]) )
+    with phase('check'):
+        d.check(outasm)
 
-# Dot graph with all calls & jps
+# Control flow graph with all calls & jps
 if args['dot']==True:
-    print("Generating graphviz/dot file",output_prefix+".dot")
-    dotfile = open(output_prefix+".dot","w")
-    dotfile.write('digraph G {\n')
-    #print(jplist)
-    nodeAttributes = {}
-    #Touis les sauts
-    for j in jplist:
-        i = jplist[j]
-        options='[label="'+i[2]+'"]'
-        nodeAttributes[i[0]]=1
-        nodeAttributes[i[1]]=1
-        dotfile.write('lab'+format(i[0],'04x')+' -> '+'lab'+format(i[1],'04x')+' '+options+';\n')
-
-    # Bloc 1st and last address
-    k0=None
-    k1=0
-
-    #print(sorted(list(nextopcode.keys())))
-    # Consecutive instructions
-    for k in sorted(list(nextopcode.keys())):
-        nxt = nextopcode[k]
-        #1st opcode of a series of instructions
-        if k0==None:
-            k0=k
-            k1=k
-        else:
-            #Is there a jump at k ?
-            if k in jplist:
-                #adrfrom => [adrfrom,adrto,jptype,opcode]
-                jpt = jplist[k][2]
-                #Is it a conditional jump or a call?
-                if ('cond' in jpt) or ('call' in jpt):
-                    n1 = 'lab'+format(k0,'04x')
-                    n2 = 'lab'+format(k,'04x')
-                    dotfile.write(n1+' -> '+ n2 +' [style=dotted;] ;\n')
-                    nodeAttributes[k0]=1
-                    nodeAttributes[k]=1
-                    k0=k
-                    k1=k
-                else:
-                    k0=None
-            else:
-                #Did we jump here from somewhere?
-                if k in jptolist:
-                    n1 = 'lab'+format(k0,'04x')
-                    n2 = 'lab'+format(k,'04x')
-                    dotfile.write(n1+' -> '+ n2 +' [style=dotted;] ;\n')
-                    nodeAttributes[k0]=1
-                    nodeAttributes[k]=1
-                    k0=k
-                    k1=k
-                else:
-                    k1=nxt
-                    if nxt in nextopcode:
-                        #print(k,nxt, memopcode[k]);
-                        options=''
-                    else:
-                        print(hx(k),hx(nxt), memopcode[k],memopcode[nxt]);
-                        dotfile.write('lab'+format(k0,'04x')+' -> '+'lab'+format(k1,'02x')+'[style=dotted] ;\n')
-                        nodeAttributes[k0]=1
-                        nodeAttributes[k1]=1
-                        k0=None
-
-    for k in nodeAttributes:
-        dotfile.write('lab'+format(k,'04x') + ' ['+'label="#'+format(k,'04x')+'"' +']'+';\n')
-
-    dotfile.write('}\n')
-    dotfile.close()
+    writers = {'dot': d.emit_dot, 'json': d.emit_json, 'graphml': d.emit_graphml}
+    for fmt in args['graph_format']:
+        print("Generating control flow graph", output_prefix+"."+fmt)
+        with phase('dot'), open(output_prefix+"."+fmt,"w") as graphfile:
+            writers[fmt](graphfile)
+
+# Loops by cost
+if args['loops']==True:
+    print("Generating loop report", output_prefix+".loops.txt")
+    with phase('loops'), open(output_prefix+".loops.txt","w") as loopfile:
+        d.emit_loops(loopfile)
+
+# Call graph
+if args['call_graph']==True:
+    print("Generating call graph", output_prefix+".calls.dot")
+    root = int(args['root'],16) if args['root']!=None else None
+    with phase('callgraph'), open(output_prefix+".calls.dot","w") as dotfile:
+        d.emit_callgraph(dotfile, int(args['cluster'],16), root, args['depth'], args['max_nodes'])
+
+if args['stats']==True:
+    print("Saving statistics", output_prefix+".stats.json")
+    with open(output_prefix+".stats.json","w") as f:
+        json.dump(d.statistics(), f, indent=1)
 
 #python3.8.exe .\z80-smart-disassembler.py -a 5000 5003 5006 5009 5018 501e 5027 -i .\gng1985.BIN  -x b1 b941 5112 5269 -v -d -D
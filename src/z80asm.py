@@ -0,0 +1,362 @@
+#-----------------------------------------------------------------------------
+"""
+Z80 assembler, for checking a disassembly
+
+The encoder is the inverse of the z80da decoding tables: the operands of
+an instruction are reduced to a pattern (values replaced by V, index
+displacements by D) which is looked up in an index built from the source
+templates of the tables. It understands the source written by the
+disassembler and the usual rasm syntax of Disark outputs:
+
+    label:
+      org #4000
+      ld (ix+#05),#80
+      jr nz,label
+      db "text",#0d,10
+      dw label,#1234
+      ds 4
+    name equ #bb5a
+
+Two passes: the sizes of the instructions do not depend on the values of
+their operands, so the first pass places the labels and the second one
+encodes. assemble() returns the assembled bytes, mismatches() compares
+two images.
+"""
+#-----------------------------------------------------------------------------
+
+from z80da import encodings, _K_NONE, _K_N, _K_NN, _K_E, _K_D, _K_DN, _I_DUP
+import re
+
+# Operands that are not values
+_reserved = frozenset((
+    'a', 'b', 'c', 'd', 'e', 'h', 'l', 'f', 'i', 'r',
+    'af', "af'", 'bc', 'de', 'hl', 'sp', 'ix', 'iy', 'ixh', 'ixl', 'iyh', 'iyl',
+    'nz', 'z', 'nc', 'po', 'pe', 'p', 'm',
+    '(bc)', '(de)', '(hl)', '(sp)', '(c)', '(ix)', '(iy)',
+))
+
+def _pattern(template, kind):
+    """
+    Operand pattern of a source template.
+    """
+    t = template.replace('#%02x', 'V')
+    if kind in (_K_NN, _K_E):
+        t = t.replace('%s', 'V')
+    elif kind in (_K_D, _K_DN):
+        t = t.replace('%s', '+D')
+    return t
+
+def _index():
+    """
+    (mnemonic, operand pattern) => (opcodes, kind, nbytes)
+    """
+    res = {}
+    for (opcodes, op, template, kind, n, info) in encodings():
+        if info & _I_DUP:
+            continue
+        res.setdefault((op, _pattern(template, kind)), (opcodes, kind, n))
+    return res
+
+_encodings = _index()
+
+#-----------------------------------------------------------------------------
+
+_reNumber = (
+    (re.compile(r'[#&$]([0-9a-f]+)$', re.I), 16),
+    (re.compile(r'0x([0-9a-f]+)$', re.I), 16),
+    (re.compile(r'([0-9][0-9a-f]*)h$', re.I), 16),
+    (re.compile(r'%([01]+)$'), 2),
+    (re.compile(r'([0-9]+)$'), 10),
+)
+_reTerm = re.compile(r'\s*([+-]?)\s*([^+-]+)')
+_reIndex = re.compile(r'\((i[xy])\s*([+-].*)\)$', re.I)
+
+def _split(s, sep=','):
+    """
+    Split s on sep, outside quoted strings.
+    """
+    res = []
+    cur = ''
+    quote = None
+    for c in s:
+        if quote is not None:
+            if c == quote:
+                quote = None
+        elif c == '"' or (c == "'" and not cur.lower().endswith('af')):
+            quote = c
+        elif c == sep:
+            res.append(cur)
+            cur = ''
+            continue
+        cur += c
+    res.append(cur)
+    return res
+
+class _Unknown(Exception):
+    pass
+
+def _value(expr, symbols, pc):
+    """
+    Value of an expression: sum of numbers, characters, symbols and $.
+    """
+    expr = expr.strip()
+    if expr.startswith('(') and expr.endswith(')'):
+        expr = expr[1:-1]
+    v = 0
+    pos = 0
+    while pos < len(expr):
+        m = _reTerm.match(expr, pos)
+        if m is None:
+            raise ValueError('bad expression: '+expr)
+        pos = m.end()
+        term = m.group(2).strip()
+        if len(term) == 3 and term[0] == term[2] and term[0] in '"\'':
+            t = ord(term[1])
+        elif term == '$':
+            t = pc
+        elif term in symbols:
+            t = symbols[term]
+        else:
+            for (r, base) in _reNumber:
+                n = r.match(term)
+                if n is not None:
+                    t = int(n.group(1), base)
+                    break
+            else:
+                if re.match(r'[A-Za-z_][\w.]*$', term):
+                    raise _Unknown(term)
+                raise ValueError('bad expression: '+expr)
+        v = v - t if m.group(1) == '-' else v + t
+    return v
+
+def _byte(v):
+    if not -128 <= v <= 255:
+        raise ValueError('byte value out of range: %d' % v)
+    return v & 0xff
+
+def _word(v):
+    if not -32768 <= v <= 65535:
+        raise ValueError('word value out of range: %d' % v)
+    return v & 0xffff
+
+def _instruction(op, operands):
+    """
+    Return the (opcodes, kind, nbytes, value expressions) of an instruction.
+    """
+    ops = [o.strip() for o in _split(operands)] if operands.strip() else []
+    literal = ','.join(o.lower() for o in ops)
+    e = _encodings.get((op, literal))
+    if e is not None:
+        return e + ([],)
+    pat = []
+    exprs = []
+    for (i, o) in enumerate(ops):
+        ol = o.lower()
+        m = _reIndex.match(o)
+        if i == 0 and op in ('bit', 'res', 'set'):
+            # The bit number is part of the opcode
+            pat.append(str(_value(o, {}, 0)))
+        elif ol in _reserved and ol not in ('(ix)', '(iy)'):
+            pat.append(ol)
+        elif m is not None:
+            pat.append('(%s+D)' % m.group(1).lower())
+            exprs.append(m.group(2))
+        elif ol in ('(ix)', '(iy)'):
+            pat.append('(%s+D)' % ol[1:3])
+            exprs.append('0')
+        elif o.startswith('(') and o.endswith(')'):
+            pat.append('(V)')
+            exprs.append(o[1:-1])
+        else:
+            pat.append('V')
+            exprs.append(o)
+    e = _encodings.get((op, ','.join(pat)))
+    if e is None:
+        raise ValueError('unknown instruction: %s %s' % (op, operands.strip()))
+    return e + (exprs,)
+
+def _encode(opcodes, kind, n, exprs, symbols, pc):
+    """
+    Bytes of an instruction at pc.
+    """
+    vals = [_value(x, symbols, pc) for x in exprs]
+    if kind == _K_NONE:
+        return opcodes
+    elif kind == _K_N:
+        return opcodes + bytes((_byte(vals[0]),))
+    elif kind == _K_NN:
+        v = _word(vals[0])
+        return opcodes + bytes((v & 0xff, v >> 8))
+    elif kind == _K_E:
+        d = ((vals[0] - pc - n + 0x8000) & 0xffff) - 0x8000
+        if not -128 <= d <= 127:
+            raise ValueError('relative jump out of range')
+        return opcodes + bytes((d & 0xff,))
+    d = vals[0]
+    if not -128 <= d <= 127:
+        raise ValueError('index displacement out of range: %d' % d)
+    if len(opcodes) == 3:
+        # DDCB/FDCB: displacement before the opcode
+        return opcodes[:2] + bytes((d & 0xff,)) + opcodes[2:]
+    if kind == _K_D:
+        return opcodes + bytes((d & 0xff,))
+    return opcodes + bytes((d & 0xff, _byte(vals[1])))
+
+def _strip(line):
+    """
+    Line without its comment.
+    """
+    quote = None
+    for (i, c) in enumerate(line):
+        if quote is not None:
+            if c == quote:
+                quote = None
+        elif c == '"':
+            quote = c
+        elif c == ';':
+            return line[:i]
+    return line
+
+def _statements(lines):
+    """
+    Generator of (line number, label, operation, operands) tuples.
+    """
+    for (num, line) in enumerate(lines, 1):
+        line = _strip(line).rstrip()
+        if line.strip() == '':
+            continue
+        label = None
+        if not line[0].isspace():
+            # Label in the first column, with or without a colon
+            parts = line.split(None, 1)
+            label = parts[0].rstrip(':')
+            line = parts[1] if len(parts) > 1 else ''
+        elif ':' in line.split()[0]:
+            parts = line.split(':', 1)
+            label = parts[0].strip()
+            line = parts[1]
+        parts = line.split(None, 1)
+        if len(parts) == 0:
+            yield (num, label, None, '')
+        else:
+            yield (num, label, parts[0].lower(), parts[1] if len(parts) > 1 else '')
+
+#-----------------------------------------------------------------------------
+
+def assemble(lines, symbols=None, code=None):
+    """
+    Assemble source lines. Return a (start adress, bytes) tuple covering all
+    the assembled bytes. Raise ValueError on an error, with the line number.
+    If symbols (a dictionary) is given, it gets the value of each label,
+    code (a set) gets the adresses of the instructions.
+    """
+    # First pass: sizes and labels
+    if symbols is None:
+        symbols = {}
+    program = []
+    pc = 0
+    lastLabel = None
+    for (num, label, op, operands) in _statements(lines):
+        try:
+            if label is not None:
+                symbols[label] = pc
+                lastLabel = label
+            if op is None:
+                continue
+            if op == 'equ':
+                if lastLabel is None:
+                    raise ValueError('equ without a label')
+                symbols[lastLabel] = _value(operands, symbols, pc)
+            elif op == 'org':
+                pc = _value(operands, symbols, pc)
+                program.append((num, op, pc, None))
+            elif op in ('db', 'defb', 'dm', 'defm', 'byte'):
+                items = [x.strip() for x in _split(operands)]
+                size = sum(len(x)-2 if x[:1] == '"' else 1 for x in items)
+                program.append((num, 'db', pc, items))
+                pc += size
+            elif op in ('dw', 'defw', 'word'):
+                items = [x.strip() for x in _split(operands)]
+                program.append((num, 'dw', pc, items))
+                pc += 2*len(items)
+            elif op in ('ds', 'defs'):
+                items = _split(operands)
+                size = _value(items[0], symbols, pc)
+                program.append((num, 'ds', pc, (size, items[1] if len(items) > 1 else '0')))
+                pc += size
+            else:
+                e = _instruction(op, operands)
+                program.append((num, 'op', pc, e))
+                if code is not None:
+                    code.add(pc)
+                pc += e[2]
+        except (ValueError, _Unknown) as ex:
+            raise ValueError('line %d: %s' % (num, ex))
+
+    # Second pass: encode
+    image = bytearray(65536)
+    lo = 65536
+    hi = 0
+    for (num, kind, pc, arg) in program:
+        try:
+            if kind == 'org':
+                continue
+            elif kind == 'db':
+                b = bytearray()
+                for x in arg:
+                    if x[:1] == '"':
+                        b += x[1:-1].encode('latin-1')
+                    else:
+                        b.append(_byte(_value(x, symbols, pc)))
+            elif kind == 'dw':
+                b = bytearray()
+                for x in arg:
+                    v = _word(_value(x, symbols, pc))
+                    b += bytes((v & 0xff, v >> 8))
+            elif kind == 'ds':
+                b = bytes((_byte(_value(arg[1], symbols, pc)),)) * arg[0]
+            else:
+                b = _encode(*arg[:3], arg[3], symbols, pc)
+        except _Unknown as ex:
+            raise ValueError('line %d: unknown symbol %s' % (num, ex))
+        except ValueError as ex:
+            raise ValueError('line %d: %s' % (num, ex))
+        if len(b) == 0:
+            continue
+        if pc + len(b) > 65536:
+            raise ValueError('line %d: beyond the end of memory' % num)
+        image[pc:pc+len(b)] = b
+        lo = min(lo, pc)
+        hi = max(hi, pc+len(b))
+    if lo >= hi:
+        return (0, b'')
+    return (lo, bytes(image[lo:hi]))
+
+# byte => 0 if it is 0, 1 otherwise
+_nonZero = bytes((0,)) + bytes((1,)) * 255
+
+def mismatches(a, b):
+    """
+    Return the ranges where the byte strings a and b differ, as a list of
+    (start, end) offsets, end excluded. Bytes beyond the end of the shortest
+    one are a mismatch. The comparison is done on whole strings (one big
+    integer xor), only the differing ranges are searched byte by byte.
+    """
+    n = min(len(a), len(b))
+    res = []
+    if a[:n] != b[:n]:
+        x = int.from_bytes(a[:n], 'little') ^ int.from_bytes(b[:n], 'little')
+        diff = x.to_bytes(n, 'little').translate(_nonZero)
+        pos = diff.find(1)
+        while pos >= 0:
+            end = diff.find(0, pos)
+            if end < 0:
+                end = n
+            res.append((pos, end))
+            pos = diff.find(1, end)
+    if len(a) != len(b):
+        if res and res[-1][1] == n:
+            res[-1] = (res[-1][0], max(len(a), len(b)))
+        else:
+            res.append((n, max(len(a), len(b))))
+    return res
@@ -0,0 +1,273 @@
+# Z80 Smart Disassembler - batch mode
+# by Stephane Sikora
+
+#-----------------------------------------------------------------------------
+"""
+Batch mode: analyze many binaries in parallel
+
+Input files (or directories of files) are analyzed by a pool of worker
+processes. Each file gets its .asm, .reg and .dot outputs, plus a .log
+with the messages printed while analyzing it. The .asm output is
+reassembled in memory and compared with the binary. A summary table with
+the coverage of each file, the number of bytes that did not reassemble
+identically, or the error that stopped it, is printed and saved as a CSV
+file. A failing image does not stop the batch.
+
+A manifest gives per-file options, one file per line:
+
+    # file       options
+    game.bin     -O 4000 -a 4000 4003 -x b941
+    loader.bin   -O 170 -a 170 -z 200+40
+"""
+#-----------------------------------------------------------------------------
+
+from z80smart import Disassembler, parseRegion
+from z80platform import platforms, defaultPlatform
+import z80sig
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import contextlib
+import argparse
+import shlex
+import time
+import json
+import csv
+import os
+
+def _fileOptions():
+    """
+    Parser for the per-file options of a manifest line.
+    """
+    ap = argparse.ArgumentParser(prog='manifest', add_help=False)
+    ap.add_argument('input_file')
+    ap.add_argument('-O', '--org', default=None)
+    ap.add_argument('-a', '--start-adresses', nargs="+")
+    ap.add_argument('-x', '--exclude-adresses', nargs="+")
+    ap.add_argument('-z', '--zero', nargs="+")
+    return ap
+
+def readManifest(fileName):
+    """
+    Return the list of jobs (dictionaries of options) described in a manifest.
+    Relative paths are relative to the manifest directory. Lines that cannot
+    be parsed are reported and skipped.
+    """
+    ap = _fileOptions()
+    base = os.path.dirname(fileName)
+    jobs = []
+    with open(fileName) as f:
+        for (n, line) in enumerate(f, 1):
+            line = line.strip()
+            if line == '' or line[0] == '#':
+                continue
+            try:
+                job = vars(ap.parse_args(shlex.split(line)))
+            except (SystemExit, argparse.ArgumentError, ValueError):
+                # argparse exits on bad options, shlex raises on unbalanced quotes
+                print('Error: %s line %d skipped: %s' % (fileName, n, line))
+                continue
+            job['input_file'] = os.path.join(base, job['input_file'])
+            jobs.append(job)
+    return jobs
+
+def listInputs(paths):
+    """
+    Expand directories into the files they contain.
+    """
+    res = []
+    for p in paths:
+        if os.path.isdir(p):
+            for n in sorted(os.listdir(p)):
+                if os.path.isfile(os.path.join(p, n)):
+                    res.append(os.path.join(p, n))
+        else:
+            res.append(p)
+    return res
+
+#-----------------------------------------------------------------------------
+
+def analyze(job):
+    """
+    Analyze one binary and write its outputs. Runs in a worker process.
+    Return a summary dictionary, with the error message if it failed.
+    """
+    t0 = time.time()
+    summary = {'file': job['input_file'], 'size': 0, 'code': 0, 'coverage': 0.0,
+               'instructions': 0, 'mismatches': 0, 'time': 0.0, 'error': ''}
+    prefix = job['output_prefix']
+    try:
+        with open(prefix+'.log', 'w') as log, contextlib.redirect_stdout(log):
+            d = Disassembler(platform=job['platform'])
+            phase = d.stats.phase
+            org = int(job['org'] or '0', 16)
+            with phase('load'):
+                d.load(job['input_file'], org)
+            with phase('zero'):
+                for a in job['zero'] or []:
+                    ar = parseRegion(a)
+                    if ar is None:
+                        print('Error: Bad region definition', a)
+                    else:
+                        d.zero(ar[0], ar[1])
+            if job['exclude_adresses'] != None:
+                d.exclude([int(a,16) for a in job['exclude_adresses']])
+            if job['start_adresses'] != None:
+                starts = [int(a,16) for a in job['start_adresses']]
+            else:
+                starts = [org]
+            with phase('trace'):
+                d.trace(starts)
+            if job['emulate']:
+                with phase('emulate'):
+                    d.emulate(starts)
+            if job['scan_pointers']:
+                with phase('pointers'):
+                    d.scanPointers()
+            if job['signatures'] != None:
+                with phase('signatures'):
+                    sigs = z80sig.Signatures(job['signatures'])
+                    z80sig.match(d, sigs)
+                    sigs.close()
+            with phase('regions'), open(prefix+'.reg', 'w') as f:
+                d.emit_regions(f)
+            with phase('asm'), open(prefix+'.asm', 'w') as f:
+                d.emit_asm(f)
+            with phase('dot'), open(prefix+'.dot', 'w') as f:
+                d.emit_dot(f)
+            with phase('check'):
+                mismatches = d.verify()
+        size = len(d.data)
+        code = sum(1 for i in range(org, org+size) if d.memcode[i] > 0)
+        summary['size'] = size
+        summary['code'] = code
+        summary['coverage'] = 100.0 * code / size if size else 0.0
+        summary['instructions'] = d.instructionCount()
+        summary['mismatches'] = sum(e-s for (s, e) in mismatches)
+        summary['stats'] = d.statistics()
+    except Exception as e:
+        summary['error'] = '%s: %s' % (type(e).__name__, e)
+    summary['time'] = time.time() - t0
+    return summary
+
+def _failed(job, e):
+    """
+    Summary of a job whose worker died.
+    """
+    return {'file': job['input_file'], 'size': 0, 'code': 0, 'coverage': 0.0,
+            'instructions': 0, 'mismatches': 0, 'time': 0.0, 'error': '%s: %s' % (type(e).__name__, e)}
+
+def _analyzeAlone(job):
+    """
+    Analyze a job in a process of its own.
+    """
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        return pool.submit(analyze, job).result()
+
+def run(jobs, outputDir, workers=None):
+    """
+    Analyze all jobs on a process pool. Return the summaries, in job order.
+    If a worker dies (killed, crashed), the pool is lost: the jobs not
+    finished are run again in a process each, so only the job that kills
+    its worker fails.
+    """
+    os.makedirs(outputDir, exist_ok=True)
+    names = {}
+    for job in jobs:
+        # Keep output names unique when files from several directories share a name
+        n = os.path.basename(job['input_file'])
+        names[n] = names.get(n, 0) + 1
+        if names[n] > 1:
+            n += '.' + str(names[n])
+        job['output_prefix'] = os.path.join(outputDir, n)
+
+    results = [None] * len(jobs)
+    retry = []
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = {pool.submit(analyze, job): i for (i, job) in enumerate(jobs)}
+        for f in as_completed(futures):
+            i = futures[f]
+            try:
+                results[i] = f.result()
+            except BrokenProcessPool:
+                # A worker died, taking the pool down: the jobs left are
+                # run again, each in its own process
+                retry.append(i)
+            except Exception as e:
+                results[i] = _failed(jobs[i], e)
+    if retry:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as threads:
+            futures = {threads.submit(_analyzeAlone, jobs[i]): i for i in retry}
+            for f in as_completed(futures):
+                i = futures[f]
+                try:
+                    results[i] = f.result()
+                except Exception as e:
+                    # The worker running this job died
+                    results[i] = _failed(jobs[i], e)
+    return results
+
+_columns = ('file', 'size', 'code', 'coverage', 'instructions', 'mismatches', 'time', 'error')
+
+def printSummary(results):
+    w = max([len('file')] + [len(r['file']) for r in results])
+    print('%-*s %6s %6s %8s %6s %6s %7s  %s' % (w, 'file', 'size', 'code', 'coverage', 'instr', 'diff', 'time', 'error'))
+    for r in results:
+        print('%-*s %6d %6d %7.1f%% %6d %6d %6.2fs  %s' % (w, r['file'], r['size'], r['code'], r['coverage'], r['instructions'], r['mismatches'], r['time'], r['error']))
+    nerr = sum(1 for r in results if r['error'])
+    print(len(results), 'files,', nerr, 'errors')
+
+def writeSummary(results, fileName):
+    with open(fileName, 'w', newline='') as f:
+        w = csv.DictWriter(f, fieldnames=_columns, extrasaction='ignore')
+        w.writeheader()
+        for r in results:
+            w.writerow(r)
+
+#-----------------------------------------------------------------------------
+
+def main():
+    ap = argparse.ArgumentParser(description='Analyze many binaries in parallel')
+    ap.add_argument('inputs', nargs='*', help='Input binary files or directories')
+    ap.add_argument('-m', '--manifest', help='Manifest file: one input file per line, followed by its options (-O, -a, -x, -z)')
+    ap.add_argument('-o', '--output-dir', default='.', help='Directory for the generated files')
+    ap.add_argument('-O', '--org', default=None, help='Default load adress (in hex format)')
+    ap.add_argument('-a', '--start-adresses', nargs="+", help='Default start adresses (in hex format), the load adress if not set')
+    ap.add_argument('-x', '--exclude-adresses', nargs="+", help='Default excluded adresses (in hex format)')
+    ap.add_argument('-P', '--platform', default=defaultPlatform, choices=sorted(platforms), help='Platform whose firmware calls are named')
+    ap.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes (default: number of cores)')
+    ap.add_argument('-E', '--emulate', action='store_true', help='Run the code from the start adresses on an emulated Z80 to find more code')
+    ap.add_argument('-T', '--scan-pointers', action='store_true', help='Trace the targets of the pointer tables found in the data regions')
+    ap.add_argument('-K', '--signatures', help='Signature file of known routines, found routines are named after them')
+    ap.add_argument('--stats', help='JSON file for the phase times and counters of each file')
+    ap.add_argument('-s', '--summary', help='Summary CSV file (default: summary.csv in the output directory)')
+    args = vars(ap.parse_args())
+
+    jobs = []
+    if args['manifest'] != None:
+        for job in readManifest(args['manifest']):
+            for k in ('org', 'start_adresses', 'exclude_adresses'):
+                if job[k] is None:
+                    job[k] = args[k]
+            job['platform'] = args['platform']
+            job['scan_pointers'] = args['scan_pointers']
+            job['emulate'] = args['emulate']
+            job['signatures'] = args['signatures']
+            jobs.append(job)
+    for f in listInputs(args['inputs']):
+        jobs.append({'input_file': f, 'org': args['org'], 'start_adresses': args['start_adresses'],
+                     'exclude_adresses': args['exclude_adresses'], 'zero': None,
+                     'platform': args['platform'], 'scan_pointers': args['scan_pointers'],
+                     'emulate': args['emulate'], 'signatures': args['signatures']})
+    if len(jobs) == 0:
+        ap.error('no input file')
+
+    results = run(jobs, args['output_dir'], args['jobs'])
+    printSummary(results)
+    summary = args['summary'] or os.path.join(args['output_dir'], 'summary.csv')
+    writeSummary(results, summary)
+    if args['stats'] != None:
+        with open(args['stats'], 'w') as f:
+            json.dump([{'file': r['file'], 'stats': r.get('stats')} for r in results], f, indent=1)
+
+if __name__ == '__main__':
+    main()
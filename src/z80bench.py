@@ -0,0 +1,323 @@
+# Z80 Smart Disassembler - benchmarks
+# by Stephane Sikora
+
+#-----------------------------------------------------------------------------
+"""
+Benchmarks of the decoder, the tracer and the outputs
+
+The corpus is generated from fixed seeds, so every run measures the same
+images:
+    prefixes  every instruction of every prefix group, in a row
+    random    random bytes
+    code      code built from the decoder tables: instruction sequences
+              with jumps, calls and returns between them
+    data      graphics: rows of sprites of a few colours, traced from its
+              first byte (pure data: the code found there is wrong)
+    snapshot  a whole 64Kb memory at 0 (random bytes, code, prefixes,
+              random bytes), traced from the code routines
+
+Each phase is timed separately on each image (best of several runs):
+disassemble and decode (linear sweep, instructions/s), superset
+decoding of the whole memory, trace, emulate (instructions run from the
+start adresses, up to EMULATED in all), pointers (bytes of code found
+from pointer tables after the trace: on the data image, false hits),
+regions, asm, dot, loops (blocks of the control flow graph). Results are
+saved as JSON, and compared with a saved baseline:
+
+    python3 z80bench.py run -o baseline.json
+    (change something)
+    python3 z80bench.py run -o new.json
+    python3 z80bench.py compare baseline.json new.json
+"""
+#-----------------------------------------------------------------------------
+
+from z80smart import Disassembler
+from z80da import disassemble, decode, decodeAll, encodings, _I_DUP, _I_UNDOC
+from z80emu import CPU
+import contextlib
+import argparse
+import platform
+import random
+import json
+import time
+import sys
+import io
+
+ORG = 0x4000
+SIZE = 0x4000
+EMULATED = 200000
+
+#-----------------------------------------------------------------------------
+
+def _instruction(opcodes, kind, n, rnd):
+    """
+    Bytes of an instruction with random operands.
+    """
+    operands = bytes(rnd.getrandbits(8) for i in range(n-len(opcodes)))
+    if len(opcodes) == 3:
+        # DDCB/FDCB: displacement before the opcode
+        return opcodes[:2] + operands + opcodes[2:]
+    return opcodes + operands
+
+def prefixImage(seed=1):
+    """
+    All the instructions of all the tables, repeated up to SIZE bytes.
+    """
+    rnd = random.Random(seed)
+    instructions = [_instruction(o, kind, n, rnd) for (o, op, t, kind, n, info) in encodings()]
+    res = bytearray()
+    while len(res) < SIZE:
+        for b in instructions:
+            res += b
+    return bytes(res[:SIZE])
+
+def randomImage(seed=2):
+    rnd = random.Random(seed)
+    return bytes(rnd.getrandbits(8) for i in range(SIZE))
+
+def dataImage(seed=5):
+    """
+    Sprites: rows of a few bytes (pixels of 4 colours), changing a little
+    from one row to the next.
+    """
+    rnd = random.Random(seed)
+    res = bytearray()
+    while len(res) < SIZE:
+        colours = [rnd.getrandbits(8) for i in range(4)]
+        row = [rnd.choice(colours) for i in range(rnd.randint(2, 8))]
+        for y in range(rnd.randint(8, 32)):
+            row = [rnd.choice(colours) if rnd.random() < 0.1 else b for b in row]
+            res += bytes(row)
+    return bytes(res[:SIZE])
+
+def codeImage(seed=3):
+    """
+    Routines made of documented instructions, mostly falling through, with
+    conditional jumps inside the routine, calls to previous routines and a
+    return at the end. Return (image, start adresses).
+    """
+    rnd = random.Random(seed)
+    plain = []
+    for (o, op, t, kind, n, info) in encodings():
+        if info & (_I_DUP | _I_UNDOC) or op in ('halt', 'jp', 'jr', 'djnz', 'call', 'ret', 'reti', 'retn', 'rst'):
+            continue
+        plain.append((o, kind, n))
+    res = bytearray()
+    routines = []
+    while len(res) < SIZE-64:
+        start = ORG+len(res)
+        routines.append(start)
+        body = []
+        for i in range(rnd.randint(8, 40)):
+            r = rnd.random()
+            pc = ORG+len(res)
+            if r < 0.08 and body:
+                # Conditional jump back in the routine
+                t = rnd.choice(body)
+                d = t-(pc+2)
+                if -128 <= d < 0:
+                    res += bytes((rnd.choice((0x20, 0x28, 0x30, 0x38)), d & 0xff))
+                    continue
+            if r < 0.15 and len(routines) > 1:
+                t = rnd.choice(routines[:-1])
+                res += bytes((0xcd, t & 0xff, t >> 8))
+                continue
+            body.append(pc)
+            res += _instruction(*rnd.choice(plain), rnd)
+        res.append(0xc9)
+    res += bytes(SIZE-len(res))
+    return (bytes(res[:SIZE]), routines)
+
+def corpus():
+    """
+    {name: (org, image, start adresses)}
+    """
+    (code, routines) = codeImage()
+    prefixes = prefixImage()
+    rnd = randomImage()
+    starts = list(range(ORG, ORG+SIZE, 0x100))
+    return {
+        'prefixes': (ORG, prefixes, starts),
+        'random': (ORG, rnd, starts),
+        'code': (ORG, code, routines),
+        'data': (ORG, dataImage(), [ORG]),
+        'snapshot': (0, rnd+code+prefixes+randomImage(4), routines),
+    }
+
+#-----------------------------------------------------------------------------
+
+def _best(fn, repeat):
+    """
+    Best time of repeat calls, and the value returned by fn.
+    """
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        v = fn()
+        t = time.perf_counter()-t0
+        if best is None or t < best:
+            best = t
+    return (best, v)
+
+def _sweep(fn, mem, org, end):
+    # The decoders read up to 4 bytes, not past the end of memory
+    end = min(end, len(mem)-4)
+    def run():
+        pc = org
+        n = 0
+        while pc < end:
+            pc += fn(mem, pc)[2 if fn is disassemble else 0]
+            n += 1
+        return n
+    return run
+
+def _codeBytes(d, org, end):
+    return sum(1 for v in d.memcode[org:end] if v > 0)
+
+def benchImage(org, image, starts, repeat=5):
+    """
+    Time each phase on one image loaded at org.
+    Return {phase: {'time': s, 'items': n, 'rate': n/s}}.
+    """
+    res = {}
+    end = org+len(image)
+    mem = bytearray(65536)
+    mem[org:end] = image
+
+    def add(name, t, items):
+        res[name] = {'time': t, 'items': items, 'rate': items/t if t > 0 else 0.0}
+
+    for (name, fn) in (('disassemble', disassemble), ('decode', decode)):
+        (t, n) = _best(_sweep(fn, mem, org, end), repeat)
+        add(name, t, n)
+
+    (t, v) = _best(lambda: decodeAll(mem), repeat)
+    add('superset', t, len(mem))
+
+    def trace():
+        d = Disassembler(platform='none')
+        d.load(image, org)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return (d, d.trace(starts))
+    (t, (d, n)) = _best(trace, repeat)
+    add('trace', t, n)
+
+    def emulate():
+        cpu = CPU(mem, org, end)
+        n = 0
+        for a in starts:
+            n += cpu.run(a, EMULATED-n)[1]
+            if n>=EMULATED:
+                break
+        return n
+    add('emulate', *_best(emulate, repeat))
+
+    best = None
+    for i in range(repeat):
+        p = Disassembler(platform='none')
+        p.load(image, org)
+        with contextlib.redirect_stdout(io.StringIO()):
+            p.trace(starts)
+            code = _codeBytes(p, org, end)
+            t0 = time.perf_counter()
+            p.scanPointers()
+            t = time.perf_counter()-t0
+        if best is None or t < best:
+            best = t
+    add('pointers', best, _codeBytes(p, org, end)-code)
+
+    def regions():
+        d.invalidate()
+        d.emit_regions(io.StringIO())
+        return len(d.regions())
+    add('regions', *_best(regions, repeat))
+
+    def asm():
+        d.invalidate()
+        f = io.StringIO()
+        d.emit_asm(f)
+        return f.getvalue().count('\n')
+    add('asm', *_best(asm, repeat))
+
+    def dot():
+        d.invalidate()
+        d.emit_dot(io.StringIO())
+        return len(d.cfg().blocks)
+    add('dot', *_best(dot, repeat))
+
+    def loops():
+        d.invalidate()
+        d.emit_loops(io.StringIO())
+        return len(d.cfg().blocks)
+    add('loops', *_best(loops, repeat))
+    return res
+
+def run(repeat=5, names=None):
+    results = {}
+    for (name, (org, image, starts)) in corpus().items():
+        if names and name not in names:
+            continue
+        results[name] = benchImage(org, image, starts, repeat)
+    return {'python': platform.python_version(), 'machine': platform.machine(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'repeat': repeat, 'results': results}
+
+def printResults(r):
+    print('%-10s %-12s %10s %8s %14s' % ('image', 'phase', 'time (ms)', 'items', 'items/s'))
+    for (name, phases) in r['results'].items():
+        for (phase, v) in phases.items():
+            print('%-10s %-12s %10.2f %8d %14.0f' % (name, phase, 1000*v['time'], v['items'], v['rate']))
+
+def compare(base, new, threshold=10.0):
+    """
+    Print the time changes between two results, flagging the phases slower
+    by more than threshold percent. Return the number of regressions.
+    """
+    regressions = 0
+    print('%-10s %-12s %10s %10s %8s' % ('image', 'phase', 'base (ms)', 'new (ms)', 'change'))
+    for (name, phases) in new['results'].items():
+        for (phase, v) in phases.items():
+            b = base['results'].get(name, {}).get(phase)
+            if b is None:
+                continue
+            change = 100.0*(v['time']-b['time'])/b['time'] if b['time'] > 0 else 0.0
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            elif b['items'] != v['items']:
+                flag = '  (%d items, was %d)' % (v['items'], b['items'])
+            print('%-10s %-12s %10.2f %10.2f %+7.1f%%%s' % (name, phase, 1000*b['time'], 1000*v['time'], change, flag))
+    print(regressions, 'regressions')
+    return regressions
+
+#-----------------------------------------------------------------------------
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmarks of the decoder, tracer and outputs')
+    sub = ap.add_subparsers(dest='command', required=True)
+    r = sub.add_parser('run', help='Run the benchmarks')
+    r.add_argument('-o', '--output', help='JSON results file')
+    r.add_argument('-r', '--repeat', type=int, default=5, help='Runs of each phase, the best one is kept')
+    r.add_argument('-i', '--images', nargs="+", choices=['prefixes', 'random', 'code', 'data', 'snapshot'], help='Images to run on (default: all)')
+    c = sub.add_parser('compare', help='Compare results with a baseline')
+    c.add_argument('baseline', help='Baseline JSON results')
+    c.add_argument('results', help='New JSON results')
+    c.add_argument('-t', '--threshold', type=float, default=10.0, help='Slowdown flagged as a regression, in percent')
+    args = vars(ap.parse_args())
+
+    if args['command'] == 'run':
+        res = run(args['repeat'], args['images'])
+        printResults(res)
+        if args['output'] != None:
+            with open(args['output'], 'w') as f:
+                json.dump(res, f, indent=1)
+    else:
+        with open(args['baseline']) as f:
+            base = json.load(f)
+        with open(args['results']) as f:
+            new = json.load(f)
+        if compare(base, new, args['threshold']):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
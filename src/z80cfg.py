@@ -0,0 +1,468 @@
+#-----------------------------------------------------------------------------
+"""
+Basic-block control flow graph
+
+Built once from the decoded instructions of a traced Disassembler, in one
+pass over the adresses. A block starts at a start adress, a jump or call
+target, or after an instruction that does not simply fall through, and
+ends with the instruction before the next block start or with a jump,
+call or return. Calls end blocks, so every edge leaves from the last
+instruction of a block.
+
+Edges are (from, to, kind) tuples, from being the adress of the block
+and kind one of edgeKinds. Graphs are written as DOT, JSON or GraphML,
+block by block.
+
+Blocks carry their static cost in T-states and CPC NOPs, depending on
+how they are left: through the branch of their last instruction or by
+falling through. Loops are found from the back edges of a depth first
+search of the jumps, and ranked by their cost per iteration.
+
+A CallGraph summarizes a CFG for large programs: one node per function,
+edges weighted by the number of call sites.
+"""
+#-----------------------------------------------------------------------------
+
+from z80da import FLOW_NEXT, FLOW_JUMP, FLOW_CJUMP, FLOW_CALL, FLOW_CRET, COND_NONE, timing
+from xml.sax.saxutils import escape
+import json
+
+# Edge kinds: the jump types of z80smart, then the fall through edge
+EDGE_JUMP, EDGE_JUMP_COND, EDGE_CALL, EDGE_CALL_COND, EDGE_NEXT = range(5)
+edgeKinds = ('jump', 'jump cond', 'call', 'call cond', 'next')
+
+class Block:
+    """
+    Basic block: adress range (end excluded), number of instructions,
+    adress of its last instruction, successor and predecessor edges,
+    T-states and CPC NOPs as (branch taken, not taken) pairs: only the
+    last instruction can branch, repeated block instructions inside are
+    counted once.
+    """
+    __slots__ = ('start', 'end', 'count', 'last', 'succ', 'pred', 'time', 'nops')
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.count = 0
+        self.last = start
+        self.succ = []
+        self.pred = []
+        self.time = (0, 0)
+        self.nops = (0, 0)
+
+    def cost(self, kind):
+        """
+        (T-states, NOPs) of the block when it is left through an edge of
+        that kind.
+        """
+        i = kind==EDGE_NEXT
+        return (self.time[i], self.nops[i])
+
+class Loop:
+    """
+    Natural loop: head block, adresses of the blocks jumping back to it,
+    adresses of its blocks, number of instructions, (min, max) T-states
+    and CPC NOPs of one iteration (the called functions excluded), number
+    of calls, and whether it is an inner loop (no other loop inside).
+    """
+    __slots__ = ('head', 'tails', 'blocks', 'count', 'time', 'nops', 'calls', 'inner')
+
+    def __init__(self, head):
+        self.head = head
+        self.tails = []
+        self.blocks = set()
+        self.count = 0
+        self.time = (0, 0)
+        self.nops = (0, 0)
+        self.calls = 0
+        self.inner = True
+
+class CFG:
+    """
+    Basic blocks of a traced Disassembler, by start adress.
+    """
+
+    def __init__(self, d):
+        oplen = d.oplen
+        memcode = d.memcode
+        mem = d.mem
+        flow = d.flow
+        cond = d.cond
+        target = d.target
+        size = len(oplen)
+
+        def isInstruction(a):
+            return a<size and oplen[a]>0 and memcode[a]>0
+
+        # Number of instructions falling through to each adress
+        fallIn = bytearray(size+8)
+        leader = bytearray(size+8)
+        pcs = [pc for pc in range(size) if oplen[pc] and memcode[pc]>0]
+        for pc in pcs:
+            f = flow[pc]
+            nxt = pc+oplen[pc]
+            if f==FLOW_NEXT:
+                fallIn[nxt] = min(fallIn[nxt]+1, 2)
+            else:
+                if f in (FLOW_JUMP, FLOW_CJUMP, FLOW_CALL):
+                    leader[target[pc]] = 1
+                leader[nxt] = 1
+        for a in d.starts:
+            leader[a] = 1
+
+        self.blocks = {}
+        for pc in pcs:
+            if not (leader[pc] or fallIn[pc]!=1):
+                continue
+            b = Block(pc)
+            t = n = 0
+            while True:
+                b.count += 1
+                b.last = pc
+                nxt = pc+oplen[pc]
+                (tt, nn) = timing(mem, pc)
+                if flow[pc]!=FLOW_NEXT or not isInstruction(nxt) or leader[nxt] or fallIn[nxt]!=1:
+                    break
+                t += tt[1]
+                n += nn[1]
+                pc = nxt
+            b.end = nxt
+            b.time = (t+tt[0], t+tt[1])
+            b.nops = (n+nn[0], n+nn[1])
+            f = flow[pc]
+            if f in (FLOW_JUMP, FLOW_CJUMP, FLOW_CALL):
+                kind = (EDGE_JUMP, EDGE_CALL)[f==FLOW_CALL] + (cond[pc]!=COND_NONE)
+                b.succ.append((target[pc], kind))
+            if f in (FLOW_NEXT, FLOW_CJUMP, FLOW_CALL, FLOW_CRET) and isInstruction(nxt):
+                b.succ.append((nxt, EDGE_NEXT))
+            self.blocks[b.start] = b
+
+        for b in self.blocks.values():
+            for (to, kind) in b.succ:
+                t = self.blocks.get(to)
+                if t is not None:
+                    t.pred.append((b.start, kind))
+
+    def edges(self):
+        """
+        Iterate over the (from, to, kind) edges, by adress.
+        """
+        for b in self.blocks.values():
+            for (to, kind) in b.succ:
+                yield (b.start, to, kind)
+
+    def nodes(self):
+        """
+        Adresses of all the nodes: blocks and targets outside the code.
+        """
+        res = set(self.blocks)
+        for b in self.blocks.values():
+            res.update(to for (to, kind) in b.succ)
+        return sorted(res)
+
+    def _jumps(self, b):
+        """
+        Successors of block b in the same function, with the edge kind.
+        """
+        return [(to, kind) for (to, kind) in b.succ
+                if kind not in (EDGE_CALL, EDGE_CALL_COND) and to in self.blocks]
+
+    def loops(self, roots=()):
+        """
+        Natural loops, most expensive first. Back edges are the jumps to a
+        block on the current path of a depth first search, run from the
+        roots and the call targets first, then from the other blocks by
+        adress. Calls are not followed. The loop of a head is made of the
+        blocks reaching one of its back edges without going through the
+        head, an iteration is a path from the head to a back edge, inner
+        loops being run once.
+        """
+        blocks = self.blocks
+        entries = list(roots) + sorted(to for (a, to, kind) in self.edges() if kind in (EDGE_CALL, EDGE_CALL_COND))
+        # 1: on the search path, 2: done
+        state = {}
+        back = set()
+        for r in entries+sorted(blocks):
+            if r not in blocks or r in state:
+                continue
+            state[r] = 1
+            stack = [(r, iter(self._jumps(blocks[r])))]
+            while stack:
+                (a, it) = stack[-1]
+                for (to, kind) in it:
+                    s = state.get(to)
+                    if s is None:
+                        state[to] = 1
+                        stack.append((to, iter(self._jumps(blocks[to]))))
+                        break
+                    elif s==1:
+                        back.add((a, to))
+                else:
+                    state[a] = 2
+                    stack.pop()
+
+        res = {}
+        for (a, head) in sorted(back):
+            loop = res.get(head)
+            if loop is None:
+                loop = res[head] = Loop(head)
+                loop.blocks.add(head)
+            loop.tails.append(a)
+            todo = [a]
+            while todo:
+                x = todo.pop()
+                if x in loop.blocks:
+                    continue
+                loop.blocks.add(x)
+                todo.extend(p for (p, kind) in blocks[x].pred
+                            if kind not in (EDGE_CALL, EDGE_CALL_COND) and p in blocks)
+
+        for loop in list(res.values()):
+            # Blocks after their successors, then the (min T, max T, min NOPs,
+            # max NOPs) of the rest of an iteration from each of them
+            order = []
+            seen = {loop.head}
+            stack = [(loop.head, iter(self._jumps(blocks[loop.head])))]
+            while stack:
+                (x, it) = stack[-1]
+                for (to, kind) in it:
+                    if to in loop.blocks and to not in seen and (x, to) not in back:
+                        seen.add(to)
+                        stack.append((to, iter(self._jumps(blocks[to]))))
+                        break
+                else:
+                    order.append(x)
+                    stack.pop()
+            rest = {}
+            for x in order:
+                b = blocks[x]
+                best = None
+                for (to, kind) in self._jumps(b):
+                    (t, n) = b.cost(kind)
+                    if to==loop.head and (x, to) in back:
+                        c = (t, t, n, n)
+                    elif to in rest and (x, to) not in back:
+                        r = rest[to]
+                        c = (t+r[0], t+r[1], n+r[2], n+r[3])
+                    else:
+                        continue
+                    if best is None:
+                        best = c
+                    else:
+                        best = (min(best[0], c[0]), max(best[1], c[1]), min(best[2], c[2]), max(best[3], c[3]))
+                if best is not None:
+                    rest[x] = best
+            best = rest.get(loop.head)
+            if best is None:
+                del res[loop.head]
+                continue
+            loop.time = best[:2]
+            loop.nops = best[2:]
+            for x in loop.blocks:
+                b = blocks[x]
+                loop.count += b.count
+                loop.calls += sum(1 for (to, kind) in b.succ if kind in (EDGE_CALL, EDGE_CALL_COND))
+        for loop in res.values():
+            for x in loop.blocks:
+                if x!=loop.head and x in res:
+                    loop.inner = False
+        return sorted(res.values(), key=lambda loop: (-loop.time[1], loop.head))
+
+    #-------------------------------------------------------------------------
+
+    def write_loops(self, f, names={}, roots=()):
+        """
+        Write the loops as a text report, most expensive iteration first,
+        with their (min-max) T-states and CPC NOPs per iteration.
+        """
+        def span(v):
+            return str(v[0]) if v[0]==v[1] else '%d-%d' % v
+
+        lines = ['; Loops by cost per iteration, called functions excluded\n',
+                 '; %-14s %6s %6s %5s %12s %10s  %s\n' % ('head', 'blocks', 'instr', 'calls', 'T-states', 'NOPs', 'back edges from')]
+        for loop in self.loops(roots):
+            lines.append('  %-14s %6d %6d %5d %12s %10s  %s%s\n' % (
+                names.get(loop.head) or '#%04x' % loop.head, len(loop.blocks), loop.count, loop.calls,
+                span(loop.time), span(loop.nops), ' '.join(names.get(a) or '#%04x' % a for a in loop.tails),
+                ' (inner)' if loop.inner else ''))
+        f.write(''.join(lines))
+
+    def write_dot(self, f, names={}):
+        """
+        Write the graph in graphviz dot format. Nodes are named with names
+        ({adress: name}) when possible, with their adress otherwise.
+        """
+        f.write('digraph G {\n')
+        for a in self.nodes():
+            b = self.blocks.get(a)
+            label = names.get(a) or '#%04x' % a
+            if b is None:
+                f.write('lab%04x [label="%s";shape=box];\n' % (a, label))
+            else:
+                f.write('lab%04x [label="%s\\n%d"];\n' % (a, label, b.count))
+        for b in self.blocks.values():
+            f.write(''.join([
+                ('lab%04x -> lab%04x [style=dotted];\n' % (b.start, to)) if kind==EDGE_NEXT else
+                ('lab%04x -> lab%04x [label="%s"];\n' % (b.start, to, edgeKinds[kind]))
+                for (to, kind) in b.succ]))
+        f.write('}\n')
+
+    def write_json(self, f):
+        """
+        Write the graph as a JSON object: a list of blocks, each with its
+        adress range, instruction count, [taken, not taken] T-states and
+        CPC NOPs, and successor edges.
+        """
+        f.write('{"blocks": [')
+        sep = '\n'
+        for b in self.blocks.values():
+            f.write(sep + json.dumps({'start': b.start, 'end': b.end, 'count': b.count, 'last': b.last,
+                                      'tstates': b.time, 'nops': b.nops,
+                                      'succ': [{'to': to, 'kind': edgeKinds[kind]} for (to, kind) in b.succ]}))
+            sep = ',\n'
+        f.write('\n]}\n')
+
+    def write_graphml(self, f, names={}):
+        """
+        Write the graph in GraphML format, names escaped as XML text.
+        """
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+                '<key id="label" for="node" attr.name="label" attr.type="string"/>\n'
+                '<key id="start" for="node" attr.name="start" attr.type="int"/>\n'
+                '<key id="end" for="node" attr.name="end" attr.type="int"/>\n'
+                '<key id="count" for="node" attr.name="count" attr.type="int"/>\n'
+                '<key id="kind" for="edge" attr.name="kind" attr.type="string"/>\n'
+                '<graph id="G" edgedefault="directed">\n')
+        for a in self.nodes():
+            b = self.blocks.get(a)
+            label = escape(names.get(a) or '#%04x' % a)
+            if b is None:
+                f.write('<node id="n%04x"><data key="label">%s</data><data key="start">%d</data></node>\n' % (a, label, a))
+            else:
+                f.write('<node id="n%04x"><data key="label">%s</data><data key="start">%d</data>'
+                        '<data key="end">%d</data><data key="count">%d</data></node>\n' % (a, label, a, b.end, b.count))
+        for b in self.blocks.values():
+            f.write(''.join(['<edge source="n%04x" target="n%04x"><data key="kind">%s</data></edge>\n'
+                             % (b.start, to, edgeKinds[kind]) for (to, kind) in b.succ]))
+        f.write('</graph>\n</graphml>\n')
+
+#-----------------------------------------------------------------------------
+
+class Function:
+    """
+    Function: entry adress, blocks, number of instructions, size in bytes,
+    and {callee entry: number of call sites}.
+    """
+    __slots__ = ('entry', 'blocks', 'count', 'size', 'calls')
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.blocks = []
+        self.count = 0
+        self.size = 0
+        self.calls = {}
+
+class CallGraph:
+    """
+    Functions of a control flow graph and the calls between them.
+    Function entries are the start adresses and the call targets, a
+    function is made of the blocks reached from its entry without calling,
+    a block reached from several entries belongs to the first one (by
+    adress). Jumps or falls through to another entry (tail calls) are
+    counted as calls.
+    Targets outside the traced code are functions without blocks.
+    """
+
+    def __init__(self, cfg, starts=()):
+        blocks = cfg.blocks
+        entries = set(a for a in starts if a in blocks)
+        for b in blocks.values():
+            for (to, kind) in b.succ:
+                if kind in (EDGE_CALL, EDGE_CALL_COND):
+                    entries.add(to)
+        self.functions = {}
+        owner = {}
+        for e in sorted(entries):
+            f = Function(e)
+            self.functions[e] = f
+            if e not in blocks or e in owner:
+                continue
+            stack = [e]
+            owner[e] = f
+            while stack:
+                b = blocks[stack.pop()]
+                f.blocks.append(b.start)
+                f.count += b.count
+                f.size += b.end-b.start
+                for (to, kind) in b.succ:
+                    if kind in (EDGE_CALL, EDGE_CALL_COND) or (to in entries and to!=e):
+                        f.calls[to] = f.calls.get(to, 0)+1
+                    elif to in blocks and to not in owner:
+                        owner[to] = f
+                        stack.append(to)
+        self.owner = {a: f.entry for (a, f) in owner.items()}
+
+    def edges(self):
+        """
+        Iterate over the (caller, callee, number of call sites) edges.
+        """
+        for f in self.functions.values():
+            for (to, n) in sorted(f.calls.items()):
+                yield (f.entry, to, n)
+
+    def around(self, root, depth=None, maxNodes=None):
+        """
+        Entries of the functions at most depth calls away from root, callers
+        or callees, nearest first, at most maxNodes of them.
+        """
+        callers = {}
+        for (a, b, n) in self.edges():
+            callers.setdefault(b, []).append(a)
+        res = {root: 0}
+        queue = [root]
+        for a in queue:
+            if depth is not None and res[a]>=depth:
+                continue
+            f = self.functions.get(a)
+            for b in list(f.calls if f else ()) + callers.get(a, []):
+                if b not in res:
+                    if maxNodes is not None and len(res)>=maxNodes:
+                        return set(res)
+                    res[b] = res[a]+1
+                    queue.append(b)
+        return set(res)
+
+    def write_dot(self, f, names={}, cluster=0, nodes=None):
+        """
+        Write the call graph in graphviz dot format, one node per function
+        with its size in instructions, edges labelled with the number of
+        call sites. cluster groups functions by adress ranges of that size,
+        nodes restricts the graph to a set of entries.
+        """
+        if nodes is None:
+            nodes = set(self.functions)
+        groups = {}
+        for a in sorted(nodes):
+            groups.setdefault(a//cluster if cluster else 0, []).append(a)
+        f.write('digraph G {\n')
+        for (g, entries) in sorted(groups.items()):
+            if cluster:
+                f.write('subgraph cluster_%d {\nlabel="#%04x-#%04x";\n' % (g, g*cluster, min(g*cluster+cluster, 0x10000)-1))
+            lines = []
+            for a in entries:
+                fn = self.functions.get(a)
+                label = names.get(a) or '#%04x' % a
+                if fn is None or not fn.blocks:
+                    lines.append('f%04x [label="%s";shape=box];\n' % (a, label))
+                else:
+                    lines.append('f%04x [label="%s\\n%d"];\n' % (a, label, fn.count))
+            f.write(''.join(lines))
+            if cluster:
+                f.write('}\n')
+        f.write(''.join([
+            ('f%04x -> f%04x [label="%d";penwidth=%d];\n' % (a, b, n, min(n, 8))) if n>1 else
+            ('f%04x -> f%04x;\n' % (a, b))
+            for (a, b, n) in self.edges() if a in nodes and b in nodes]))
+        f.write('}\n')
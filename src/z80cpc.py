@@ -1,3 +1,5 @@
+from z80platform import callTarget
+
 firmware_vectors = {
 "B900" : "KL_U_ROM_ENABLE",
 "B903" : "KL_U_ROM_DISABLE",
@@ -110,7 +112,7 @@ firmware_vectors = {
 "BBD8" : "GRA_GET_W_HEIGHT",
 "BBDB" : "GRA_CLEAR_WINDOW",
 "BBDE" : "GRA_SET_PEN",
-"BBEl" : "GRA_GET_PEN",
+"BBE1" : "GRA_GET_PEN",
 "BBE4" : "GRA_SET_PAPER",
 "BBE7" : "GRA_GET_PAPER",
 "BBEA" : "GRA_PLOT_ABSOLUTE",
@@ -143,9 +145,10 @@ firmware_vectors = {
 "BC3B" : "SCR_GET_BORDER",
 "BC3E" : "SCR_SET_FLASHING",
 "BC41" : "SCR_GET_FLASHING",
-"BC41" : "SCR_GET_FLASHING",
-"BC4A" : "SCR_CHAR_INVERT",
+"BC44" : "SCR_FILL_BOX",
+"BC47" : "SCR_FLOOD_BOX",
 "BC4A" : "SCR_CHAR_INVERT",
+"BC4D" : "SCR_HW_ROLL",
 "BC50" : "SCR_SW_ROLL",
 "BC53" : "SCR_UNPACK",
 "BC56" : "SCR_REPACK",
@@ -194,7 +197,7 @@ firmware_vectors = {
 "BCD7" : "KL_NEW_FRAME_FLY",
 "BCDA" : "KL_ADD_FRAME_FLY",
 "BCDD" : "KL_DEL_FRAME_FLY",
-"BCEO" : "KL_NEW_FAST_TICKER",
+"BCE0" : "KL_NEW_FAST_TICKER",
 "BCE3" : "KL_ADD_FAST_TICKER",
 "BCE6" : "KL_DEL_FAST_TICKER",
 "BCE9" : "KL_ADD_TICKER",
@@ -233,16 +236,17 @@ firmware_vectors = {
 "BD4C" : "GRA_SAUVER_PARAMETRES_MASQUE",
 "BD4F" : "GRA_CONVERTIR_COORD",
 "BD52" : "GRA_FILL",
-"BD5S" : "SCR_MODIFIER_DEBUT_ECRAN",
+"BD55" : "SCR_MODIFIER_DEBUT_ECRAN",
 "BD58" : "MC_AFFECTATION_DE_CARACTERES"
 }
 
+# Address indexed firmware tables
+# The jumpblock entries from #BD3A were added by the 664 and 6128 firmwares
+firmware_6128 = {int(k,16): v for (k,v) in firmware_vectors.items()}
+firmware_464 = {a: v for (a,v) in firmware_6128.items() if a < 0xBD3A}
 
 def checkFirmwareVector(s):
     """
+    Name of the firmware vector called by the asm line s, or False.
     """
-    s = s.upper()
-    for v in firmware_vectors.keys():
-        if v in s:
-            return firmware_vectors[v]
-    return False
+    return firmware_6128.get(callTarget(s), False)
@@ -4,9 +4,22 @@
 #-----------------------------------------------------------------------------
 """
 Z80 Disassembler
+
+The decoder is table driven: every prefix group (unprefixed, CB, ED, DD, FD,
+DDCB, FDCB) has a precomputed 256 entry table built once at import time.
+Each entry is a (mnemonic, template, nbytes, kind, flow, cond, target,
+source template, info, T-states, CPC NOPs) tuple, where kind tells which
+immediate bytes are substituted into the operand templates and timings
+are (taken, not taken) pairs. Operand text is only formatted when it is
+asked for: disassemble() for listings, source() for assembler source,
+decode() returns the numeric control flow information used by the tracer,
+decodeAll() decodes a whole memory image at every offset, timing() returns
+the T-states and CPC NOPs of an instruction, info() its encoding flags.
 """
 #-----------------------------------------------------------------------------
 
+from array import array
+
 _r = ('b', 'c', 'd', 'e', 'h', 'l', '(hl)', 'a')
 _rp = ('bc', 'de', 'hl', 'sp')
 _rp2 = ('bc', 'de', 'hl', 'af')
@@ -21,154 +34,164 @@ _bli = (
     ('ini', 'ind', 'inir', 'indr'), ('outi', 'outd', 'otir', 'otdr')
 )
 
+# Operand kinds: where the variable part of the operands comes from
+_K_NONE = 0 # fixed operand text
+_K_N = 1    # 8 bit immediate, last byte
+_K_NN = 2   # 16 bit immediate, last two bytes
+_K_E = 3    # relative jump displacement, last byte
+_K_D = 4    # index displacement, byte 2
+_K_DN = 5   # index displacement in byte 2, 8 bit immediate in byte 3
+
+# Control flow classes
+FLOW_NEXT = 0     # falls through to the next instruction
+FLOW_JUMP = 1     # jp nn, jr e, rst p
+FLOW_CJUMP = 2    # jp cc,nn, jr cc,e, djnz e
+FLOW_CALL = 3     # call nn, call cc,nn
+FLOW_RET = 4      # ret, reti, retn
+FLOW_CRET = 5     # ret cc
+FLOW_INDIRECT = 6 # jp (hl), jp (ix), jp (iy)
+
+# Condition codes: index in _cc, COND_B is the djnz condition (b != 0)
+COND_NONE = -1
+COND_B = 8
+
+# Table entry info flags
+_I_DUP = 1    # an assembler encodes the same source text differently
+_I_UNDOC = 2  # undocumented instruction
+
+# Signed index displacement text, indexed by the raw byte
+_disp = tuple(('+%02x' % d) if d < 0x80 else ('%02x' % (d - 256)) for d in range(256))
+_srcdisp = tuple(('+#%02x' % d) if d < 0x80 else ('-#%02x' % (256 - d)) for d in range(256))
+
 #-----------------------------------------------------------------------------
 
-def _da_normal(mem, pc):
+def _da_normal(m0):
     """
     Normal decode with no prefixes
     """
-    m0 = mem[pc]
-    m1 = mem[pc + 1]
-    m2 = mem[pc + 2]
     x = (m0 >> 6) & 3
     y = (m0 >> 3) & 7
     z = (m0 >> 0) & 7
     p = (m0 >> 4) & 3
     q = (m0 >> 3) & 1
-    n =  m1
-    nn = (m2 << 8) + m1
-    d = m1
-    if d & 0x80:
-        d = (d & 0x7f) - 128
-    d = (pc + d + 2) & 0xffff
 
     if x == 0:
         if z == 0:
             if y == 0:
-                return ('nop', '', 1)
+                return ('nop', '', 1, _K_NONE)
             elif y == 1:
-                return ('ex', 'af,af\'', 1)
+                return ('ex', 'af,af\'', 1, _K_NONE)
             elif y == 2:
-                return ('djnz', '%04x' % d, 2)
+                return ('djnz', '%04x', 2, _K_E)
             elif y == 3:
-                return ('jr', '%04x' % d, 2)
+                return ('jr', '%04x', 2, _K_E)
             else:
-                return ('jr', '%s,%04x' % (_cc[y - 4], d), 2)
+                return ('jr', _cc[y - 4] + ',%04x', 2, _K_E)
         elif z == 1:
             if q == 0:
-                return ('ld', '%s,%04x' % (_rp[p], nn), 3)
+                return ('ld', _rp[p] + ',%04x', 3, _K_NN)
             elif q == 1:
-                return ('add', 'hl,%s' % _rp[p], 1)
+                return ('add', 'hl,%s' % _rp[p], 1, _K_NONE)
         elif z == 2:
             if q == 0:
                 if p == 0:
-                    return ('ld', '(bc),a', 1)
+                    return ('ld', '(bc),a', 1, _K_NONE)
                 elif p == 1:
-                    return ('ld', '(de),a', 1)
+                    return ('ld', '(de),a', 1, _K_NONE)
                 elif p == 2:
-                    return ('ld', '(%04x),hl' % nn, 3)
+                    return ('ld', '(%04x),hl', 3, _K_NN)
                 else:
-                    return ('ld', '(%04x),a' % nn, 3)
+                    return ('ld', '(%04x),a', 3, _K_NN)
             else:
                 if p == 0:
-                    return ('ld', 'a,(bc)', 1)
+                    return ('ld', 'a,(bc)', 1, _K_NONE)
                 elif p == 1:
-                    return ('ld', 'a,(de)', 1)
+                    return ('ld', 'a,(de)', 1, _K_NONE)
                 elif p == 2:
-                    return ('ld', 'hl,(%04x)' % nn, 3)
+                    return ('ld', 'hl,(%04x)', 3, _K_NN)
                 else:
-                    return ('ld', 'a,(%04x)' % nn, 3)
+                    return ('ld', 'a,(%04x)', 3, _K_NN)
         elif z == 3:
             if q == 0:
-                return ('inc', _rp[p], 1)
+                return ('inc', _rp[p], 1, _K_NONE)
             else:
-                return ('dec', _rp[p], 1)
+                return ('dec', _rp[p], 1, _K_NONE)
         elif z == 4:
-            return ('inc', _r[y], 1)
+            return ('inc', _r[y], 1, _K_NONE)
         elif z == 5:
-            return ('dec', _r[y], 1)
+            return ('dec', _r[y], 1, _K_NONE)
         elif z == 6:
-            return ('ld', '%s,%02x' % (_r[y], n), 2)
+            return ('ld', _r[y] + ',%02x', 2, _K_N)
         else:
-            return (_rota[y], '', 1)
+            return (_rota[y], '', 1, _K_NONE)
     elif x == 1:
         if (z == 6) and (y == 6):
-            return ('halt', '', 1)
+            return ('halt', '', 1, _K_NONE)
         else:
-            return ('ld', '%s,%s' % (_r[y], _r[z]), 1)
+            return ('ld', '%s,%s' % (_r[y], _r[z]), 1, _K_NONE)
     elif x == 2:
-        return (_alu[y], '%s%s' % (_alux[y], _r[z]), 1)
+        return (_alu[y], '%s%s' % (_alux[y], _r[z]), 1, _K_NONE)
     else:
         if z == 0:
-            return ('ret', _cc[y], 1)
+            return ('ret', _cc[y], 1, _K_NONE)
         elif z == 1:
             if q == 0:
-                return ('pop', _rp2[p], 1)
+                return ('pop', _rp2[p], 1, _K_NONE)
             else:
                 if p == 0:
-                    return ('ret', '', 1)
+                    return ('ret', '', 1, _K_NONE)
                 elif p == 1:
-                    return ('exx', '', 1)
+                    return ('exx', '', 1, _K_NONE)
                 elif p == 2:
-                    return ('jp', 'hl', 1)
+                    return ('jp', 'hl', 1, _K_NONE)
                 else:
-                    return ('ld', 'sp,hl', 1)
+                    return ('ld', 'sp,hl', 1, _K_NONE)
         elif z == 2:
-            return ('jp', '%s,%04x' % (_cc[y], nn), 3)
+            return ('jp', _cc[y] + ',%04x', 3, _K_NN)
         elif z == 3:
             if y == 0:
-                return ('jp', '%04x' % nn, 3)
+                return ('jp', '%04x', 3, _K_NN)
             elif y == 2:
-                return ('out', '(%02x),a' % n, 2)
+                return ('out', '(%02x),a', 2, _K_N)
             elif y == 3:
-                return ('in', 'a,(%02x)' % n, 2)
+                return ('in', 'a,(%02x)', 2, _K_N)
             elif y == 4:
-                return ('ex', '(sp),hl', 1)
+                return ('ex', '(sp),hl', 1, _K_NONE)
             elif y == 5:
-                return ('ex', 'de,hl', 1)
+                return ('ex', 'de,hl', 1, _K_NONE)
             elif y == 6:
-                return ('di', '', 1)
+                return ('di', '', 1, _K_NONE)
             else:
-                return ('ei', '', 1)
+                return ('ei', '', 1, _K_NONE)
         elif z == 4:
-            return ('call', '%s,%04x' % (_cc[y], nn), 3)
+            return ('call', _cc[y] + ',%04x', 3, _K_NN)
         elif z == 5:
             if q == 0:
-                return ('push', _rp2[p], 1)
+                return ('push', _rp2[p], 1, _K_NONE)
             else:
                 if p == 0:
-                    return ('call', '%04x' % nn, 3)
+                    return ('call', '%04x', 3, _K_NN)
         elif z == 6:
-            return (_alu[y], '%s%02x' % (_alux[y], n), 2)
+            return (_alu[y], _alux[y] + '%02x', 2, _K_N)
         else:
-            return ('rst', '%02x' % (y << 3), 1)
+            return ('rst', '%02x' % (y << 3), 1, _K_NONE)
+    return None
 
 #-----------------------------------------------------------------------------
 
-def _da_index(mem, pc, ir):
+def _da_index(m0, ir):
     """
     Decode with index register substitutions
     """
-    m0 = mem[pc]
-    m1 = mem[pc + 1]
-    m2 = mem[pc + 2]
     x = (m0 >> 6) & 3
     y = (m0 >> 3) & 7
     z = (m0 >> 0) & 7
     p = (m0 >> 4) & 3
     q = (m0 >> 3) & 1
-    n0 = m1
-    n1 = m2
-    nn = (m2 << 8) + m1
-    d = m1
-    if d & 0x80:
-        d = (d & 0x7f) - 128
-    sign = ('', '+')[d >= 0]
-    dj = (pc + d + 2) & 0xffff
 
     # if using (hl) then: (hl)->(ix+d), h and l are unaffected.
     alt0_r = list(_r)
-    alt0_r[6] = '(%s%s%02x)' % (ir, sign, d)
+    alt0_r[6] = '(%s%%s)' % ir
 
     # if not using (hl) then: hl->ix, h->ixh, l->ixl
     alt1_r = list(_r)
@@ -183,271 +206,738 @@ def _da_index(mem, pc, ir):
     if x == 0:
         if z == 0:
             if y == 0:
-                return ('nop', '', 2)
+                return ('nop', '', 2, _K_NONE)
             elif y == 1:
-                return ('ex', 'af,af\'', 2)
+                return ('ex', 'af,af\'', 2, _K_NONE)
             elif y == 2:
-                return ('djnz', '%04x' % dj, 3)
+                return ('djnz', '%04x', 3, _K_E)
             elif y == 3:
-                return ('jr', '%04x' % dj, 3)
+                return ('jr', '%04x', 3, _K_E)
             else:
-                return ('jr', '%s,%04x' % (_cc[y - 4], dj), 3)
+                return ('jr', _cc[y - 4] + ',%04x', 3, _K_E)
         elif z == 1:
             if q == 0:
-                return ('ld', '%s,%04x' % (alt_rp[p], nn), 4)
+                return ('ld', alt_rp[p] + ',%04x', 4, _K_NN)
             elif q == 1:
-                return ('add', '%s,%s' % (ir, alt_rp[p]), 2)
+                return ('add', '%s,%s' % (ir, alt_rp[p]), 2, _K_NONE)
         elif z == 2:
             if q == 0:
                 if p == 0:
-                    return ('ld', '(bc),a', 2)
+                    return ('ld', '(bc),a', 2, _K_NONE)
                 elif p == 1:
-                    return ('ld', '(de),a', 2)
+                    return ('ld', '(de),a', 2, _K_NONE)
                 elif p == 2:
-                    return ('ld', '(%04x),%s' % (nn, ir), 4)
+                    return ('ld', '(%04x),' + ir, 4, _K_NN)
                 else:
-                    return ('ld', '(%04x),a' % nn, 4)
+                    return ('ld', '(%04x),a', 4, _K_NN)
             else:
                 if p == 0:
-                    return ('ld', 'a,(bc)', 2)
+                    return ('ld', 'a,(bc)', 2, _K_NONE)
                 elif p == 1:
-                    return ('ld', 'a,(de)', 2)
+                    return ('ld', 'a,(de)', 2, _K_NONE)
                 elif p == 2:
-                    return ('ld', '%s,(%04x)' % (ir, nn), 4)
+                    return ('ld', ir + ',(%04x)', 4, _K_NN)
                 else:
-                    return ('ld', 'a,(%04x)' % nn, 4)
+                    return ('ld', 'a,(%04x)', 4, _K_NN)
         elif z == 3:
             if q == 0:
-                return ('inc', alt_rp[p], 2)
+                return ('inc', alt_rp[p], 2, _K_NONE)
             else:
-                return ('dec', alt_rp[p], 2)
+                return ('dec', alt_rp[p], 2, _K_NONE)
         elif z == 4:
             if y == 6:
-                return ('inc', alt0_r[y], 3)
+                return ('inc', alt0_r[y], 3, _K_D)
             else:
-                return ('inc', alt1_r[y], 2)
+                return ('inc', alt1_r[y], 2, _K_NONE)
         elif z == 5:
             if y == 6:
-                return ('dec', alt0_r[y], 3)
+                return ('dec', alt0_r[y], 3, _K_D)
             else:
-                return ('dec', alt1_r[y], 2)
+                return ('dec', alt1_r[y], 2, _K_NONE)
         elif z == 6:
             if y == 6:
-                return ('ld', '%s,%02x' % (alt0_r[y], n1), 4)
+                return ('ld', alt0_r[y] + ',%02x', 4, _K_DN)
             else:
-                return ('ld', '%s,%02x' % (alt1_r[y], n0), 3)
+                return ('ld', alt1_r[y] + ',%02x', 3, _K_N)
         else:
-            return (_rota[y], '', 2)
+            return (_rota[y], '', 2, _K_NONE)
     elif x == 1:
         if (z == 6) and (y == 6):
-            return ('halt', '', 2)
+            return ('halt', '', 2, _K_NONE)
         else:
             if (y == 6) or (z == 6):
-                return ('ld', '%s,%s' % (alt0_r[y], alt0_r[z]), 3)
+                return ('ld', '%s,%s' % (alt0_r[y], alt0_r[z]), 3, _K_D)
             else:
-                return ('ld', '%s,%s' % (alt1_r[y], alt1_r[z]), 2)
+                return ('ld', '%s,%s' % (alt1_r[y], alt1_r[z]), 2, _K_NONE)
     elif x == 2:
         if z == 6:
-            return (_alu[y], '%s%s' % (_alux[y], alt0_r[z]), 3)
+            return (_alu[y], '%s%s' % (_alux[y], alt0_r[z]), 3, _K_D)
         else:
-            return (_alu[y], '%s%s' % (_alux[y], alt1_r[z]), 2)
+            return (_alu[y], '%s%s' % (_alux[y], alt1_r[z]), 2, _K_NONE)
     else:
         if z == 0:
-            return ('ret', _cc[y], 2)
+            return ('ret', _cc[y], 2, _K_NONE)
         elif z == 1:
             if q == 0:
-                return ('pop', alt_rp2[p], 2)
+                return ('pop', alt_rp2[p], 2, _K_NONE)
             else:
                 if p == 0:
-                    return ('ret', '', 2)
+                    return ('ret', '', 2, _K_NONE)
                 elif p == 1:
-                    return ('exx', '', 2)
+                    return ('exx', '', 2, _K_NONE)
                 elif p == 2:
-                    return ('jp', ir, 2)
+                    return ('jp', ir, 2, _K_NONE)
                 else:
-                    return ('ld', 'sp,%s' % ir, 2)
+                    return ('ld', 'sp,%s' % ir, 2, _K_NONE)
         elif z == 2:
-            return ('jp', '%s,%04x' % (_cc[y], nn), 4)
+            return ('jp', _cc[y] + ',%04x', 4, _K_NN)
         elif z == 3:
             if y == 0:
-                return ('jp', '%04x' % nn, 4)
+                return ('jp', '%04x', 4, _K_NN)
             elif y == 2:
-                return ('out', '(%02x),a' % n0, 3)
+                return ('out', '(%02x),a', 3, _K_N)
             elif y == 3:
-                return ('in', 'a,(%02x)' % n0, 3)
+                return ('in', 'a,(%02x)', 3, _K_N)
             elif y == 4:
-                return ('ex', '(sp),%s' % ir, 2)
+                return ('ex', '(sp),%s' % ir, 2, _K_NONE)
             elif y == 5:
-                return ('ex', 'de,hl', 2)
+                return ('ex', 'de,hl', 2, _K_NONE)
             elif y == 6:
-                return ('di', '', 2)
+                return ('di', '', 2, _K_NONE)
             else:
-                return ('ei', '', 2)
+                return ('ei', '', 2, _K_NONE)
         elif z == 4:
-            return ('call', '%s,%04x' % (_cc[y], nn), 4)
+            return ('call', _cc[y] + ',%04x', 4, _K_NN)
         elif z == 5:
             if q == 0:
-                return ('push', alt_rp2[p], 2)
+                return ('push', alt_rp2[p], 2, _K_NONE)
             else:
                 if p == 0:
-                    return ('call', '%04x' % nn, 4)
+                    return ('call', '%04x', 4, _K_NN)
         elif z == 6:
-            return (_alu[y], '%s%02x' % (_alux[y], n0), 3)
+            return (_alu[y], _alux[y] + '%02x', 3, _K_N)
         else:
-            return ('rst', '%02x' % (y << 3), 2)
+            return ('rst', '%02x' % (y << 3), 2, _K_NONE)
+    return None
 
 #-----------------------------------------------------------------------------
 
-def _da_cb_prefix(mem, pc):
+def _da_cb_prefix(m0):
     """
     0xCB <opcode>
     """
-    m0 = mem[pc]
     x = (m0 >> 6) & 3
     y = (m0 >> 3) & 7
     z = (m0 >> 0) & 7
 
     if x == 0:
-        return (_rot[y], _r[z], 2)
+        return (_rot[y], _r[z], 2, _K_NONE)
     elif x == 1:
-        return ('bit', '%d,%s' % (y, _r[z]), 2)
+        return ('bit', '%d,%s' % (y, _r[z]), 2, _K_NONE)
     elif x == 2:
-        return ('res', '%d,%s' % (y, _r[z]), 2)
+        return ('res', '%d,%s' % (y, _r[z]), 2, _K_NONE)
     else:
-        return ('set', '%d,%s' % (y, _r[z]), 2)
+        return ('set', '%d,%s' % (y, _r[z]), 2, _K_NONE)
 
 #-----------------------------------------------------------------------------
 
-def _da_ddcb_fdcb_prefix(mem, pc, ir):
+def _da_ddcb_fdcb_prefix(m1, ir):
     """
     0xDDCB <d> <opcode>
     0xFDCB <d> <opcode>
     """
-    m0 = mem[pc]
-    m1 = mem[pc + 1]
     x = (m1 >> 6) & 3
     y = (m1 >> 3) & 7
     z = (m1 >> 0) & 7
-    d = m0
-    if d & 0x80:
-        d = (d & 0x7f) - 128
-    sign = ('', '+')[d >= 0]
+    ird = '(%s%%s)' % ir
 
     if x == 0:
         if z == 6:
-            return(_rot[y], '(%s%s%02x)' % (ir, sign, d), 4)
+            return (_rot[y], ird, 4, _K_D)
         else:
-            return(_rot[y], '(%s%s%02x),%s' % (ir, sign, d, _r[z]), 4)
+            return (_rot[y], '%s,%s' % (ird, _r[z]), 4, _K_D)
     elif x == 1:
-        return ('bit', '%d,(%s%s%02x)' % (y, ir, sign, d), 4)
+        return ('bit', '%d,%s' % (y, ird), 4, _K_D)
     elif x == 2:
         if z == 6:
-            return ('res', '%d,(%s%s%02x)' % (y, ir, sign, d), 4)
+            return ('res', '%d,%s' % (y, ird), 4, _K_D)
         else:
-            return ('res', '%d,(%s%s%02x),%s' % (y, ir, sign, d, _r[z]), 4)
+            return ('res', '%d,%s,%s' % (y, ird, _r[z]), 4, _K_D)
     else:
         if z == 6:
-            return ('set', '%d,(%s%s%02x)' % (y, ir, sign, d), 4)
+            return ('set', '%d,%s' % (y, ird), 4, _K_D)
         else:
-            return ('set', '%d,(%s%s%02x),%s' % (y, ir, sign, d, _r[z]), 4)
+            return ('set', '%d,%s,%s' % (y, ird, _r[z]), 4, _K_D)
 
 #-----------------------------------------------------------------------------
 
-def _da_ed_prefix(mem, pc):
+def _da_ed_prefix(m0):
     """
     0xED <opcode>
     0xED <opcode> <nn>
     """
-    m0 = mem[pc]
-    m1 = mem[pc + 1]
-    m2 = mem[pc + 2]
     x = (m0 >> 6) & 3
     y = (m0 >> 3) & 7
     z = (m0 >> 0) & 7
     p = (m0 >> 4) & 3
     q = (m0 >> 3) & 1
-    nn = (m2 << 8) + m1
 
     if x == 1:
         if z == 0:
             if y == 6:
-                return ('in', '(c)', 2)
+                return ('in', '(c)', 2, _K_NONE)
             else:
-                return ('in', '%s,(c)' % _r[y], 2)
+                return ('in', '%s,(c)' % _r[y], 2, _K_NONE)
         elif z == 1:
             if y == 6:
-                return ('out', '(c)', 2)
+                return ('out', '(c)', 2, _K_NONE)
             else:
-                return ('out', '(c),%s' % _r[y], 2)
+                return ('out', '(c),%s' % _r[y], 2, _K_NONE)
         elif z == 2:
             if q == 0:
-                return ('sbc', 'hl,%s' % _rp[p], 2)
+                return ('sbc', 'hl,%s' % _rp[p], 2, _K_NONE)
             else:
-                return ('adc', 'hl,%s' % _rp[p], 2)
+                return ('adc', 'hl,%s' % _rp[p], 2, _K_NONE)
         elif z == 3:
             if q == 0:
-                return ('ld', '(%04x),%s' % (nn, _rp[p]), 4)
+                return ('ld', '(%04x),' + _rp[p], 4, _K_NN)
             else:
-                return ('ld', '%s,(%04x)' % (_rp[p], nn), 4)
+                return ('ld', _rp[p] + ',(%04x)', 4, _K_NN)
         elif z == 4:
-            return ('neg', '', 2)
+            return ('neg', '', 2, _K_NONE)
         elif z == 5:
             if y == 1:
-                return ('reti', '', 2)
+                return ('reti', '', 2, _K_NONE)
             else:
-                return ('retn', '', 2)
+                return ('retn', '', 2, _K_NONE)
         elif z == 6:
-            return ('im', _im[y], 2)
+            return ('im', _im[y], 2, _K_NONE)
         else:
             if y == 0:
-                return ('ld', 'i,a', 2)
+                return ('ld', 'i,a', 2, _K_NONE)
             elif y == 1:
-                return ('ld', 'r,a', 2)
+                return ('ld', 'r,a', 2, _K_NONE)
             elif y == 2:
-                return ('ld', 'a,i', 2)
+                return ('ld', 'a,i', 2, _K_NONE)
             elif y == 3:
-                return ('ld', 'a,r', 2)
+                return ('ld', 'a,r', 2, _K_NONE)
             elif y == 4:
-                return ('rrd', '', 2)
+                return ('rrd', '', 2, _K_NONE)
             elif y == 5:
-                return ('rld', '', 2)
+                return ('rld', '', 2, _K_NONE)
             else:
-                return ('nop', '', 2)
+                return ('nop', '', 2, _K_NONE)
     elif x == 2:
         if (z <= 3) and (y >= 4):
-            return (_bli[z][y - 4], '', 2)
-    return ('nop', '', 2)
+            return (_bli[z][y - 4], '', 2, _K_NONE)
+    return ('nop', '', 2, _K_NONE)
 
 #-----------------------------------------------------------------------------
 
-def _da_dd_fd_prefix(mem, pc, ir):
+def _t_normal(m0):
+    """
+    T-states of an unprefixed instruction: (taken, not taken)
+    """
+    x = (m0 >> 6) & 3
+    y = (m0 >> 3) & 7
+    z = (m0 >> 0) & 7
+    q = (m0 >> 3) & 1
+
+    if x == 0:
+        if z == 0:
+            return ((4, 4), (4, 4), (13, 8), (12, 12))[y] if y < 4 else (12, 7)
+        elif z == 1:
+            return (11, 11) if q else (10, 10)
+        elif z == 2:
+            return (7, 7) if y < 4 else (16, 16) if y < 6 else (13, 13)
+        elif z == 3:
+            return (6, 6)
+        elif z in (4, 5):
+            return (11, 11) if y == 6 else (4, 4)
+        elif z == 6:
+            return (10, 10) if y == 6 else (7, 7)
+        return (4, 4)
+    elif x in (1, 2):
+        if (z == 6) != (x == 1 and y == 6):
+            return (7, 7)
+        return (4, 4)
+    else:
+        if z == 0:
+            return (11, 5)
+        elif z == 1:
+            if q == 0:
+                return (10, 10)
+            return ((10, 10), (4, 4), (4, 4), (6, 6))[y >> 1]
+        elif z == 2:
+            return (10, 10)
+        elif z == 3:
+            return ((10, 10), None, (11, 11), (11, 11), (19, 19), (4, 4), (4, 4), (4, 4))[y]
+        elif z == 4:
+            return (17, 10)
+        elif z == 5:
+            return (17, 17) if q else (11, 11)
+        elif z == 6:
+            return (7, 7)
+        return (11, 11)
+
+def _t_ed(m0):
+    """
+    T-states of an 0xED instruction, a repeated block instruction is
+    taken while it repeats
+    """
+    x = (m0 >> 6) & 3
+    y = (m0 >> 3) & 7
+    z = (m0 >> 0) & 7
+
+    if x == 1:
+        if z == 7:
+            return (9, 9) if y < 4 else (18, 18) if y < 6 else (8, 8)
+        return ((12, 12), (12, 12), (15, 15), (20, 20), (8, 8), (14, 14), (8, 8))[z]
+    elif x == 2 and (z <= 3) and (y >= 4):
+        return (21, 16) if y >= 6 else (16, 16)
+    return (8, 8)
+
+def _memoryForm(m0):
+    """
+    True if the unprefixed instruction m0 reads or writes (hl), which
+    becomes (ix+d) after a 0xDD or 0xFD prefix.
+    """
+    x = (m0 >> 6) & 3
+    y = (m0 >> 3) & 7
+    z = (m0 >> 0) & 7
+    if x == 0:
+        return y == 6 and z in (4, 5, 6)
+    elif x in (1, 2):
+        return (z == 6) != (x == 1 and y == 6)
+    return False
+
+def _t_index(m0):
     """
-    0xDD <x>
-    0xFD <x>
+    T-states of an 0xDD or 0xFD instruction
     """
-    m0 = mem[pc]
-    if m0 in (0xdd, 0xed, 0xfd):
-        return ('nop', '', 1)
-    elif m0 == 0xcb:
-        return _da_ddcb_fdcb_prefix(mem, pc + 1, ir)
+    if _memoryForm(m0):
+        return (23, 23) if m0 in (0x34, 0x35) else (19, 19)
+    (t, t2) = _t_normal(m0)
+    return (t + 4, t2 + 4)
+
+# CPC NOP counts (a NOP is 4 T-states, memory accesses are aligned on them)
+# that are not the T-states rounded up
+_nops_main = {0x10: (4, 3), 0x22: (5, 5), 0x2a: (5, 5), 0xe3: (6, 6)}
+for _m in range(0xc0, 0x100, 8):
+    _nops_main[_m] = (4, 2)         # ret cc
+    _nops_main[_m | 7] = (4, 4)     # rst
+for _m in (0xc5, 0xd5, 0xe5, 0xf5):
+    _nops_main[_m] = (4, 4)         # push
+_nops_ed = {}
+for _m in range(0x40, 0x80, 8):
+    _nops_ed[_m] = _nops_ed[_m | 1] = (4, 4)    # in r,(c) out (c),r
+    _nops_ed[_m | 3] = (6, 6)       # ld (nn),rr ld rr,(nn)
+for _m in (0xa0, 0xa2, 0xa3, 0xa8, 0xaa, 0xab):
+    _nops_ed[_m] = (5, 5)           # ldi ini outi...
+    _nops_ed[_m | 0x10] = (6, 5)    # ldir inir otir...
+del _m
+
+def _nops(t):
+    return ((t[0] + 3) >> 2, (t[1] + 3) >> 2)
+
+def _timing(name, m):
+    """
+    ((T-states), (CPC NOPs)) of opcode m of table name, each as a (taken,
+    not taken) pair. Taken is the branch or the repetition of a block
+    instruction, both are the same for other instructions.
+    """
+    if name == 'main':
+        t = _t_normal(m)
+        return (t, _nops_main.get(m) or _nops(t))
+    elif name == 'cb':
+        t = (8, 8) if m & 7 != 6 else (12, 12) if m >> 6 == 1 else (15, 15)
+        return (t, _nops(t))
+    elif name == 'ed':
+        t = _t_ed(m)
+        return (t, _nops_ed.get(m) or _nops(t))
+    elif name in ('dd', 'fd'):
+        if m in (0xdd, 0xed, 0xfd):
+            return ((4, 4), (1, 1))
+        t = _t_index(m)
+        if _memoryForm(m):
+            return (t, (6, 6) if m in (0x34, 0x35, 0x36) else (5, 5))
+        (n, n2) = _nops_main.get(m) or _nops(_t_normal(m))
+        return (t, (n + 1, n2 + 1))
     else:
-        return _da_index(mem, pc, ir)
+        return ((20, 20), (6, 6)) if m >> 6 == 1 else ((23, 23), (7, 7))
+
+#-----------------------------------------------------------------------------
+
+def _flow(e):
+    """
+    Control flow information of a table entry: (flow, cond, target).
+    target is only set here when it does not depend on operand bytes (rst).
+    """
+    (op, t, n, kind) = e
+    if op in ('jp', 'jr'):
+        if kind == _K_NONE:
+            return (FLOW_INDIRECT, COND_NONE, -1)
+        if ',' in t:
+            return (FLOW_CJUMP, _cc.index(t.split(',')[0]), -1)
+        return (FLOW_JUMP, COND_NONE, -1)
+    elif op == 'djnz':
+        return (FLOW_CJUMP, COND_B, -1)
+    elif op == 'call':
+        if ',' in t:
+            return (FLOW_CALL, _cc.index(t.split(',')[0]), -1)
+        return (FLOW_CALL, COND_NONE, -1)
+    elif op == 'rst':
+        # Handled like a jump: the byte after a rst is often an inline argument
+        return (FLOW_JUMP, COND_NONE, int(t, 16))
+    elif op == 'ret':
+        if t:
+            return (FLOW_CRET, _cc.index(t), -1)
+        return (FLOW_RET, COND_NONE, -1)
+    elif op in ('reti', 'retn'):
+        return (FLOW_RET, COND_NONE, -1)
+    return (FLOW_NEXT, COND_NONE, -1)
+
+def _source(e):
+    """
+    Assembler source template of a table entry: hexadecimal immediates
+    get a # prefix, 16 bit adresses and jump targets are a %s slot for
+    a label or a number.
+    """
+    (op, t, n, kind) = e
+    if op == 'jp' and kind == _K_NONE:
+        return '(%s)' % t
+    elif op == 'rst':
+        return '#' + t
+    elif op == 'out' and t == '(c)':
+        return '(c),0'
+    return t.replace('%02x', '#%02x').replace('%04x', '%s')
+
+def _index_table(ir):
+    """
+    Build the 0xDD or 0xFD table.
+    A nested prefix (0xDD, 0xED, 0xFD) makes the first one a 1 byte nop,
+    the 0xCB entry is None and is resolved through the DDCB/FDCB table.
+    """
+    t = [_da_index(m, ir) for m in range(256)]
+    for m in (0xdd, 0xed, 0xfd):
+        t[m] = ('nop', '', 1, _K_NONE)
+    t[0xcb] = None
+    return t
+
+def _main_table():
+    """
+    Build the unprefixed table, prefix bytes are None entries.
+    """
+    t = [_da_normal(m) for m in range(256)]
+    for m in (0xcb, 0xdd, 0xed, 0xfd):
+        t[m] = None
+    return t
+
+def _undocumented(name, m, e):
+    """
+    True if entry e, opcode m of table name, is an undocumented instruction.
+    """
+    if e[0] == 'sll' or (name == 'ed' and m in (0x70, 0x71)):
+        return True
+    if name in ('dd', 'fd'):
+        return any(r in e[1] for r in ('ixh', 'ixl', 'iyh', 'iyl'))
+    if name in ('ddcb', 'fdcb'):
+        # rotations, res and set also copying the result in a register
+        return (m & 7) != 6 and (m >> 6) != 1
+    return False
+
+def _tables(raw):
+    """
+    Freeze the raw (name, entries) tables, in priority order, adding the
+    control flow fields, the source template, the info flags and the
+    timings.
+    An entry gets _I_DUP when an entry met before (in table order, the
+    documented (ix+d) forms first for DDCB/FDCB) has the same source text:
+    an assembler would encode that text with the other opcode.
+    """
+    seen = set()
+    res = {}
+    for (name, entries) in raw:
+        t = [None] * 256
+        order = range(256)
+        if name in ('ddcb', 'fdcb'):
+            order = sorted(order, key=lambda m: (m & 7) != 6)
+        for m in order:
+            e = entries[m]
+            if e is None:
+                continue
+            src = _source(e)
+            info = 0
+            key = (e[0], src, e[3])
+            if key in seen:
+                info |= _I_DUP
+            seen.add(key)
+            if _undocumented(name, m, e):
+                info |= _I_UNDOC
+            t[m] = e + _flow(e) + (src, info) + _timing(name, m)
+        res[name] = tuple(t)
+    return res
+
+_tabs = _tables((
+    ('main', _main_table()),
+    ('cb', [_da_cb_prefix(m) for m in range(256)]),
+    ('ed', [_da_ed_prefix(m) for m in range(256)]),
+    ('dd', _index_table('ix')),
+    ('fd', _index_table('iy')),
+    ('ddcb', [_da_ddcb_fdcb_prefix(m, 'ix') for m in range(256)]),
+    ('fdcb', [_da_ddcb_fdcb_prefix(m, 'iy') for m in range(256)]),
+))
+_tab_main = _tabs['main']
+_tab_cb = _tabs['cb']
+_tab_ed = _tabs['ed']
+_tab_dd = _tabs['dd']
+_tab_fd = _tabs['fd']
+_tab_ddcb = _tabs['ddcb']
+_tab_fdcb = _tabs['fdcb']
+
+# prefix byte -> (table indexed by the next byte, table indexed by the 4th byte)
+_prefix_tables = {
+    0xcb: (_tab_cb, None),
+    0xed: (_tab_ed, None),
+    0xdd: (_tab_dd, _tab_ddcb),
+    0xfd: (_tab_fd, _tab_fdcb),
+}
+
+#-----------------------------------------------------------------------------
+
+def _lookup(mem, pc):
+    """
+    Return the table entry of the instruction at mem[pc].
+    """
+    e = _tab_main[mem[pc]]
+    if e is None:
+        t, t4 = _prefix_tables[mem[pc]]
+        e = t[mem[pc + 1]]
+        if e is None:
+            e = t4[mem[pc + 3]]
+    return e
+
+def _fmt_n(t, mem, pc, n):
+    return t % mem[pc + n - 1]
+
+def _fmt_nn(t, mem, pc, n):
+    return t % ((mem[pc + n - 1] << 8) + mem[pc + n - 2])
+
+def _fmt_e(t, mem, pc, n):
+    d = mem[pc + n - 1]
+    if d & 0x80:
+        d -= 256
+    return t % ((pc + n + d) & 0xffff)
+
+def _fmt_d(t, mem, pc, n):
+    return t % _disp[mem[pc + 2]]
+
+def _fmt_dn(t, mem, pc, n):
+    return t % (_disp[mem[pc + 2]], mem[pc + 3])
+
+# operand kind -> formatter
+_fmt = (None, _fmt_n, _fmt_nn, _fmt_e, _fmt_d, _fmt_dn)
+
+def _src_n(t, mem, pc, n, labels):
+    return t % mem[pc + n - 1]
+
+def _src_nn(t, mem, pc, n, labels):
+    v = (mem[pc + n - 1] << 8) + mem[pc + n - 2]
+    return t % (labels.get(v) or '#%04x' % v)
+
+def _src_e(t, mem, pc, n, labels):
+    d = mem[pc + n - 1]
+    if d & 0x80:
+        d -= 256
+    v = (pc + n + d) & 0xffff
+    return t % (labels.get(v) or '#%04x' % v)
+
+def _src_d(t, mem, pc, n, labels):
+    return t % _srcdisp[mem[pc + 2]]
+
+def _src_dn(t, mem, pc, n, labels):
+    return t % (_srcdisp[mem[pc + 2]], mem[pc + 3])
+
+# operand kind -> source formatter
+_src = (None, _src_n, _src_nn, _src_e, _src_d, _src_dn)
 
 #-----------------------------------------------------------------------------
 
+def length(mem, pc):
+    """
+    Return the size in bytes of the instruction at mem[pc].
+    """
+    return _lookup(mem, pc)[2]
+
+def info(mem, pc):
+    """
+    Return the flags of the instruction at mem[pc] (_I_DUP, _I_UNDOC).
+    """
+    return _lookup(mem, pc)[8]
+
+def decode(mem, pc):
+    """
+    Decode the instruction at mem[pc] without building any text.
+    Return an (nbytes, flow, target, cond) tuple, target is the branch
+    address or -1, cond is one of the COND_ values.
+    """
+    (op, t, n, kind, flow, cond, target) = _lookup(mem, pc)[:7]
+    if flow and target < 0:
+        if kind == _K_NN:
+            target = (mem[pc + n - 1] << 8) + mem[pc + n - 2]
+        elif kind == _K_E:
+            target = mem[pc + n - 1]
+            if target & 0x80:
+                target -= 256
+            target = (pc + n + target) & 0xffff
+    return (n, flow, target, cond)
+
 def disassemble(mem, pc):
     """
     Disassemble z80 opcodes starting at mem[pc].
     Return an (operation, operands, nbytes) tuple.
     """
-    m0 = mem[pc]
-    if m0 == 0xcb:
-        return _da_cb_prefix(mem, pc + 1)
-    elif m0 == 0xdd:
-        return _da_dd_fd_prefix(mem, pc + 1, 'ix')
-    elif m0 == 0xed:
-        return _da_ed_prefix(mem, pc + 1)
-    elif m0 == 0xfd:
-        return _da_dd_fd_prefix(mem, pc + 1, 'iy')
-    else:
-        return _da_normal(mem, pc)
\ No newline at end of file
+    e = _lookup(mem, pc)
+    t = e[1]
+    if e[3]:
+        t = _fmt[e[3]](t, mem, pc, e[2])
+    return (e[0], t, e[2])
+
+def source(mem, pc, labels={}, undocumented=True):
+    """
+    Assembler source of the instruction at mem[pc], as an (operation,
+    operands) tuple. 16 bit values and jump targets found in labels (an
+    {address: name} dictionary) are written with their label.
+    Return None if an assembler would not give back the same bytes from
+    the source (redundant prefix, duplicate encoding), or if it is an
+    undocumented instruction and undocumented is False.
+    """
+    e = _lookup(mem, pc)
+    info = e[8]
+    if info & _I_DUP or (info & _I_UNDOC and not undocumented):
+        return None
+    t = e[7]
+    if e[3]:
+        t = _src[e[3]](t, mem, pc, e[2], labels)
+    return (e[0], t)
+
+def timing(mem, pc):
+    """
+    Timing of the instruction at mem[pc]: ((T-states), (CPC NOPs)), each
+    as a (taken, not taken) pair. Taken is a conditional branch (or djnz)
+    taken or a repeated block instruction repeating, both are the same
+    for the other instructions.
+    """
+    e = _lookup(mem, pc)
+    return (e[9], e[10])
+
+def addressOperand(mem, pc):
+    """
+    Return the (offset, size) of the operand of the instruction at mem[pc]
+    that changes when code is moved: 16 bit immediate or relative jump
+    displacement. (0, 0) if there is none.
+    """
+    e = _lookup(mem, pc)
+    if e[3] == _K_NN:
+        return (e[2] - 2, 2)
+    elif e[3] == _K_E:
+        return (e[2] - 1, 1)
+    return (0, 0)
+
+def masked(mem, start, end):
+    """
+    Bytes of the instructions in mem[start:end], with their adress operands
+    (see addressOperand()) zeroed: the same wherever the code is loaded.
+    """
+    b = bytearray(mem[start:end])
+    pc = start
+    while pc < end:
+        e = _lookup(mem, pc)
+        if e[3] == _K_NN:
+            b[pc - start + e[2] - 2:pc - start + e[2]] = b'\0\0'
+        elif e[3] == _K_E:
+            b[pc - start + e[2] - 1] = 0
+        pc += e[2]
+    return bytes(b)
+
+def encodings():
+    """
+    Generator of the (opcodes, mnemonic, source template, kind, nbytes, info)
+    tuples of all table entries, opcodes being the prefix and opcode bytes.
+    The index displacement comes after the opcodes, except for the DDCB and
+    FDCB instructions (3 opcode bytes) where it comes before the last one.
+    """
+    tables = (
+        (b'', _tab_main), (b'\xcb', _tab_cb), (b'\xed', _tab_ed),
+        (b'\xdd', _tab_dd), (b'\xfd', _tab_fd),
+        (b'\xdd\xcb', _tab_ddcb), (b'\xfd\xcb', _tab_fdcb),
+    )
+    for (prefix, t) in tables:
+        for m in range(256):
+            e = t[m]
+            if e is not None:
+                yield (prefix + bytes((m,)), e[0], e[7], e[3], e[2], e[8])
+
+#-----------------------------------------------------------------------------
+
+def _column(t, i):
+    """
+    Field i of the entries of a table, as a bytes.translate table.
+    """
+    return bytes(0 if e is None else e[i] for e in t)
+
+# Length and flow class by first byte, CB instructions are all 2 bytes long
+_len_main = bytearray(_column(_tab_main, 2))
+_len_main[0xcb] = 2
+_len_main = bytes(_len_main)
+_flow_main = _column(_tab_main, 4)
+# prefix byte => length and flow class by second byte
+_len_prefix = {}
+_flow_prefix = {}
+for _p in (0xed, 0xdd, 0xfd):
+    _t = bytearray(_column(_prefix_tables[_p][0], 2))
+    if _p != 0xed:
+        _t[0xcb] = 4
+    _len_prefix[_p] = bytes(_t)
+    _flow_prefix[_p] = _column(_prefix_tables[_p][0], 4)
+del _p, _t
+# flow class => 1 if there is a branch target or a condition
+_flow_decoded = bytes(1 if f in (FLOW_JUMP, FLOW_CJUMP, FLOW_CALL, FLOW_CRET) else 0 for f in range(256))
+
+def decodeAll(mem):
+    """
+    Superset decoding: decode the instruction starting at every offset of mem.
+    Return (lengths, flows, conds, targets) arrays indexed by offset: length
+    (0 if the instruction runs past the end of mem), flow class, condition
+    (COND_NONE if none) and branch target (0 if none), as decode() returns.
+    Lengths and flow classes are translated from the first two bytes all at
+    once, prefix by prefix, only branches are decoded one by one.
+    """
+    size = len(mem)
+    mem = bytes(mem)
+    lengths = bytearray(mem.translate(_len_main))
+    flows = bytearray(mem.translate(_flow_main))
+    second = mem[1:] + b'\0'
+    for (p, lt) in _len_prefix.items():
+        ll = second.translate(lt)
+        fl = second.translate(_flow_prefix[p])
+        pos = mem.find(p)
+        while pos >= 0:
+            lengths[pos] = ll[pos]
+            flows[pos] = fl[pos]
+            pos = mem.find(p, pos + 1)
+    for pc in range(max(0, size - 3), size):
+        if pc + lengths[pc] > size:
+            lengths[pc] = 0
+            flows[pc] = 0
+    conds = array('b', [COND_NONE]) * size
+    targets = array('H', bytes(2 * size))
+    mask = flows.translate(_flow_decoded)
+    pc = mask.find(1)
+    while pc >= 0:
+        (n, flow, target, cond) = decode(mem, pc)
+        conds[pc] = cond
+        if target >= 0:
+            targets[pc] = target
+        pc = mask.find(1, pc + 1)
+    return (lengths, flows, conds, targets)
@@ -0,0 +1,161 @@
+#-----------------------------------------------------------------------------
+"""
+Data classification
+
+The bytes the tracer did not reach are split into segments of one kind:
+    fill        runs of one repeated byte
+    text        printable characters, mostly letters, the last one may
+                have bit 7 set (CPC firmware strings)
+    pointers    words pointing inside the loaded binary, at least half
+                of them to code
+    compressed  high entropy bytes (packed data, random bytes)
+    unknown     everything else (graphics, tables...)
+
+Every byte gets a kind in a bytearray, written by slices: runs are found
+with bytes.translate, find and regular expressions over the whole region.
+Pointers are found the same way, on the words of each parity mapped to
+what they point to, so each byte is checked once, whatever the size of
+the region.
+"""
+#-----------------------------------------------------------------------------
+
+from collections import Counter
+from itertools import accumulate
+from array import array
+import math
+import sys
+import re
+
+UNKNOWN, FILL, TEXT, POINTERS, COMPRESSED = range(5)
+kindNames = ('unknown', 'fill', 'text', 'pointers', 'compressed')
+# Label prefix of the segments of each kind
+kindLabels = ('data', 'fill', 'text', 'ptrs', 'pack')
+
+# Shortest runs of each kind
+minFill = 8
+minText = 5
+# Part of letters and spaces in a text
+textLetters = 0.7
+minPointers = 2
+# Shortest unknown segment tested for compression, and the entropy ratio
+# (to the highest possible entropy for its size) above which it is compressed
+minCompressed = 64
+compressedRatio = 0.9
+
+# byte => 1 if printable (not " or \), 2 if printable with bit 7 set
+_printable = bytes(1 if 32<=v<127 and v not in (34, 92) else 0 for v in range(128))
+_printable = _printable + bytes(2*p for p in _printable)
+# byte => 1 for letters and spaces, with or without bit 7
+_letters = bytes(1 if (v & 0x7f)==32 or 65<=(v & 0x5f)<=90 else 0 for v in range(256))
+_nonZero = bytes((0,)) + bytes((1,)) * 255
+_bit7 = bytes(128) + bytes((1,)) * 128
+
+_reFill = re.compile(rb'\x00{%d,}' % (minFill-1))
+_reText = re.compile(rb'\x01{%d,}\x02?|\x01{%d,}\x02' % (minText, minText-1))
+# pointer flag (see classify) => 1 for code
+_codeFlag = bytes((0, 0, 1)) + bytes(253)
+_rePointers = re.compile(rb'[\x01\x02]{%d,}' % minPointers)
+_reRuns = re.compile(rb'(.)\1*', re.S)
+
+# Entropy is measured on the first bytes of a segment
+_entropySample = 1024
+_xlogx = [0.0] + [x*math.log2(x) for x in range(1, _entropySample+1)]
+
+def _entropy(b):
+    """
+    Entropy of b (at most _entropySample bytes) in bits per byte.
+    """
+    n = len(b)
+    return math.log2(n) - sum(map(_xlogx.__getitem__, Counter(b).values()))/n
+
+def _words(data, a, b):
+    """
+    Little endian words of data[a:b].
+    """
+    words = array('H', data[a:b])
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
+
+def _pointerTables(data, kinds, targets, p):
+    """
+    Pointer tables of parity p of data, in bytes not classified yet: the
+    (start, end) of the words from which, up to the end of their run of
+    words pointing inside the binary or to code, at least minPointers
+    words are there and half of them point to code.
+    """
+    m = (len(data)-p)//2
+    if m<minPointers:
+        return []
+    flags = bytes(map(targets.__getitem__, _words(data, p, p+2*m)))
+    # Words over a byte of another kind point nowhere
+    used = kinds[p:p+2*m].translate(_nonZero)
+    used = int.from_bytes(used[0::2], 'little') | int.from_bytes(used[1::2], 'little')
+    flags = (int.from_bytes(flags, 'little') & ~(used*255)).to_bytes(m, 'little')
+    res = []
+    for r in _rePointers.finditer(flags):
+        (a, b) = r.span()
+        end = p+2*b
+        # Number of code pointers in the last k words of the run
+        code = accumulate(flags[b-1:a-1 if a else None:-1].translate(_codeFlag))
+        res += [(end-2*k, end) for (k, c) in enumerate(code, 1) if k>=minPointers and 2*c>=k]
+    return res
+
+def classify(mem, start, end, targets):
+    """
+    Classify the data bytes mem[start:end].
+    targets is a 64Kb table of the adresses words can point to: 2 where a
+    code instruction starts, 1 elsewhere inside the loaded binary, 0
+    outside.
+    Return the list of (start, end, kind) segments, end excluded.
+    """
+    data = bytes(mem[start:end])
+    n = len(data)
+    kinds = bytearray(n)
+
+    # Fill: the xor of each byte with the next one is 0 inside the run
+    if n>=minFill:
+        x = int.from_bytes(data[:-1], 'little') ^ int.from_bytes(data[1:], 'little')
+        diff = x.to_bytes(n-1, 'little').translate(_nonZero)
+        for m in _reFill.finditer(diff):
+            kinds[m.start():m.end()+1] = bytes((FILL,)) * (m.end()+1-m.start())
+
+    # Text: printable (1), optionally ended by a bit 7 printable (2)
+    mask = data.translate(_printable)
+    for m in _reText.finditer(mask):
+        (a, b) = m.span()
+        if FILL not in kinds[a:b] and data[a:b].translate(_letters).count(1)>=textLetters*(b-a):
+            kinds[a:b] = bytes((TEXT,)) * (b-a)
+
+    # Pointers: words pointing inside the binary, half of them to code.
+    # The first table by adress is kept, then the first one after it...
+    taken = 0
+    for (a, b) in sorted(_pointerTables(data, kinds, targets, 0) + _pointerTables(data, kinds, targets, 1)):
+        if a>=taken:
+            kinds[a:b] = bytes((POINTERS,)) * (b-a)
+            taken = b
+
+    # Unknown runs with a high entropy are compressed
+    res = []
+    bit7 = data.translate(_bit7)
+    for m in _reRuns.finditer(kinds):
+        (a, b) = m.span()
+        k = kinds[a]
+        if k==UNKNOWN and b-a>=minCompressed:
+            sample = data[a:min(b, a+_entropySample)]
+            if _entropy(sample) >= compressedRatio*min(8.0, math.log2(len(sample))):
+                k = COMPRESSED
+        if k==TEXT:
+            # One segment per string, a string ends after a bit 7 character
+            e = bit7.find(1, a, b)
+            while e>=0:
+                res.append((start+a, start+e+1, k))
+                a = e+1
+                e = bit7.find(1, a, b)
+            if a<b:
+                res.append((start+a, start+b, k))
+        elif res and res[-1][2]==k:
+            res[-1] = (res[-1][0], start+b, k)
+        else:
+            res.append((start+a, start+b, k))
+    return res
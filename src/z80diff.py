@@ -0,0 +1,376 @@
+# Z80 Smart Disassembler - binary diff
+# by Stephane Sikora
+
+#-----------------------------------------------------------------------------
+"""
+Diff of two versions of a binary
+
+The old version is traced from its start adresses, the new one from the
+same start adresses found again in it. Then the basic blocks of both are
+matched by their operand masked bytes: 16 bit immediates and relative
+jump displacements are zeroed, so moved code keeps its key. Keys found
+once in each version anchor the matching, which is extended to the
+neighbours (successors and predecessors with the same key) of the matched
+blocks. Everything goes through dictionaries, so the diff is linear in
+the size of the code, however far the code moved.
+
+Functions (see z80cfg.CallGraph) are matched by the blocks they share:
+unchanged, moved (same masked bytes at another adress), changed, new or
+removed. Start adresses, excluded adresses and symbols of the old version
+are carried to the new one: an adress inside a matched block keeps its
+offset in the block, code is searched with any adress operands, then the
+entry of a changed function becomes the new entry, and data adresses are
+found by the bytes around them.
+
+    python3 z80diff.py old.bin new.bin -O 4000 -a 4000 4003 -x b941 -s game.sym
+
+writes new.bin.diff.txt (the functions and the carried options) and, with
+-s, new.bin.sym (the symbols at their new adresses).
+"""
+#-----------------------------------------------------------------------------
+
+from z80smart import Disassembler, hx
+from z80da import addressOperand, masked
+from z80cfg import CallGraph
+from z80platform import platforms, defaultPlatform
+from collections import Counter
+from bisect import bisect_right
+import contextlib
+import argparse
+import io
+import re
+
+# Function status
+UNCHANGED, MOVED, CHANGED, NEW, REMOVED = range(5)
+functionStatus = ('unchanged', 'moved', 'changed', 'new', 'removed')
+
+# Bytes of code searched for a start adress, around a data adress
+searchCode = 32
+searchData = 16
+# Shortest block anchoring the matching, shorter ones are only matched
+# next to other blocks
+minAnchor = 4
+
+def blockKeys(d):
+    """
+    {block adress: operand masked bytes} of a traced Disassembler.
+    """
+    return {a: masked(d.mem, a, b.end) for (a, b) in d.cfg().blocks.items()}
+
+def _unique(pattern, data):
+    """
+    Offset of the only match of pattern in data, None if there are none
+    or several.
+    """
+    it = pattern.finditer(data)
+    m = next(it, None)
+    if m is None or next(it, None) is not None:
+        return None
+    return m.start()
+
+def locateCode(old, new, a):
+    """
+    Adress in Disassembler new of the code at adress a of the traced
+    Disassembler old: the instructions following a, up to searchCode
+    bytes, found once in the new image with any adress operands, or the
+    load adress for the load adress. None if they are not found, or found
+    several times.
+    """
+    mem = old.mem
+    parts = []
+    pc = a
+    while pc<a+searchCode and old.memcode[pc]>0 and old.oplen[pc]:
+        (o, n) = addressOperand(mem, pc)
+        size = old.oplen[pc]
+        if n:
+            parts += [re.escape(bytes(mem[pc:pc+o])), b'.' * n, re.escape(bytes(mem[pc+o+n:pc+size]))]
+        else:
+            parts.append(re.escape(bytes(mem[pc:pc+size])))
+        pc += size
+    if pc==a:
+        return locateData(old, new, a)
+    pos = _unique(re.compile(b''.join(parts), re.S), new.data)
+    if pos is None:
+        # The entry point of the binary stays the entry point
+        return new.org if a==old.org else None
+    return new.org+pos
+
+def locateData(old, new, a):
+    """
+    Adress in Disassembler new of adress a of Disassembler old, found by
+    the searchData bytes from a (or before a) found once in the new image.
+    """
+    lo = old.org
+    hi = old.org+len(old.data)
+    if not lo<=a<hi:
+        return None
+    for (start, end) in ((a, min(a+searchData, hi)), (max(a-searchData, lo), a)):
+        if start<end:
+            pos = _unique(re.compile(re.escape(bytes(old.mem[start:end]))), new.data)
+            if pos is not None:
+                return new.org+pos+a-start
+    return None
+
+#-----------------------------------------------------------------------------
+
+class Diff:
+    """
+    Matched blocks and functions of two traced Disassemblers.
+    blocks: {old block adress: new block adress}
+    entries: {old function entry: new function entry} of the matched functions
+    functions: list of (status, old entry, new entry) by adress, status
+    being one of functionStatus, entries None when there are none.
+    """
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+        oldCfg = old.cfg()
+        newCfg = new.cfg()
+        oldKeys = blockKeys(old)
+        newKeys = blockKeys(new)
+        self.oldKeys = oldKeys
+        self.newKeys = newKeys
+
+        # Anchors: keys found once in each version, long enough not to be
+        # found by chance
+        oldBy = {}
+        for (a, k) in oldKeys.items():
+            oldBy.setdefault(k, []).append(a)
+        newBy = {}
+        for (a, k) in newKeys.items():
+            newBy.setdefault(k, []).append(a)
+        match = {}
+        back = {}
+        for (k, olds) in oldBy.items():
+            news = newBy.get(k)
+            if len(olds)==1 and news is not None and len(news)==1 and len(k)>=minAnchor:
+                match[olds[0]] = news[0]
+                back[news[0]] = olds[0]
+
+        # Neighbours of the matched blocks with the same key and edge kind
+        queue = list(match.items())
+        while queue:
+            (a, b) = queue.pop()
+            ob = oldCfg.blocks[a]
+            nb = newCfg.blocks[b]
+            pairs = [(x, y) for ((x, kx), (y, ky)) in zip(ob.succ, nb.succ) if kx==ky]
+            for (x, kx) in ob.pred:
+                if x in match:
+                    continue
+                ys = [y for (y, ky) in nb.pred if ky==kx and y not in back and newKeys[y]==oldKeys[x]]
+                if len(ys)==1:
+                    pairs.append((x, ys[0]))
+            for (x, y) in pairs:
+                if x in oldKeys and y in newKeys and x not in match and y not in back and oldKeys[x]==newKeys[y]:
+                    match[x] = y
+                    back[y] = x
+                    queue.append((x, y))
+        self.blocks = match
+        self._starts = sorted(match)
+
+        # Functions: the old function owning most of the matched blocks of
+        # a new function, at least half of the blocks of one of them
+        oldCalls = CallGraph(oldCfg, old.starts)
+        newCalls = CallGraph(newCfg, new.starts)
+        oldFun = {e: f for (e, f) in oldCalls.functions.items() if f.blocks}
+        newFun = {e: f for (e, f) in newCalls.functions.items() if f.blocks}
+        votes = []
+        for (e, g) in newFun.items():
+            owners = Counter(oldCalls.owner.get(back.get(b)) for b in g.blocks)
+            owners.pop(None, None)
+            for (o, n) in owners.items():
+                if o in oldFun and 2*n>=min(len(oldFun[o].blocks), len(g.blocks)):
+                    votes.append((-n, o, e))
+        votes.sort()
+        pairs = {}
+        used = set()
+        for (n, o, e) in votes:
+            if o not in pairs and e not in used:
+                pairs[o] = e
+                used.add(e)
+        res = []
+        for (o, f) in oldFun.items():
+            e = pairs.get(o)
+            if e is None:
+                res.append((REMOVED, o, None))
+                continue
+            same = [oldKeys[a] for a in f.blocks]==[newKeys[b] for b in newFun[e].blocks]
+            res.append((CHANGED if not same else UNCHANGED if o==e else MOVED, o, e))
+        res += [(NEW, None, e) for e in newFun if e not in used]
+        self.entries = pairs
+        self.functions = sorted(res, key=lambda r: (r[2] if r[2] is not None else r[1], r[0]))
+
+    def mapAdress(self, a):
+        """
+        Adress in the new version of adress a of the old version, None if
+        it was not found.
+        """
+        i = bisect_right(self._starts, a)-1
+        if i>=0:
+            start = self._starts[i]
+            if a<self.old.cfg().blocks[start].end:
+                return self.blocks[start]+a-start
+        if self.old.memcode[a]>0 and self.old.oplen[a]:
+            b = locateCode(self.old, self.new, a)
+            if b is not None:
+                return b
+        if a in self.entries:
+            return self.entries[a]
+        return locateData(self.old, self.new, a)
+
+    def counts(self):
+        """
+        {status: number of functions}
+        """
+        res = Counter(r[0] for r in self.functions)
+        return {s: res[i] for (i, s) in enumerate(functionStatus)}
+
+#-----------------------------------------------------------------------------
+
+_reSymbol = re.compile(r'\s*([A-Za-z_][\w.]*):?\s+(?:equ\s+)?([#$&]?[0-9a-f]+h?|0x[0-9a-f]+)\s*(;.*)?$', re.I)
+
+def readSymbols(fileName):
+    """
+    Return the [(name, adress)] of a symbol file: one "name #adress" or
+    "name equ #adress" per line.
+    """
+    res = []
+    with open(fileName) as f:
+        for line in f:
+            m = _reSymbol.match(line)
+            if m is None:
+                continue
+            v = m.group(2).lower()
+            if v[:2]=='0x':
+                v = v[2:]
+            res.append((m.group(1), int(v.strip('#$&h'), 16)))
+    return res
+
+def _trace(d, starts, verbose):
+    if verbose:
+        d.trace(starts)
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            d.trace(starts)
+
+def carry(old, new, starts, excluded, symbols, newStarts=(), verbose=0):
+    """
+    Trace the new version from the start adresses of the old one found
+    in it (and newStarts), the old one being traced from starts, and diff
+    them. excluded adresses and symbols ([(name, adress)]) are carried to
+    the new version.
+    Return (diff, new start adresses, new excluded adresses, new symbols,
+    [lost (name, old adress)]).
+    """
+    old.exclude(excluded)
+    _trace(old, starts, verbose)
+    # Exclusions are data, start adresses code: both are found again
+    # before tracing, then through the matched blocks
+    lost = []
+    newExcluded = []
+    for x in excluded:
+        a = locateData(old, new, x)
+        if a is None:
+            lost.append(('exclude', x))
+        else:
+            newExcluded.append(a)
+    new.exclude(newExcluded)
+    first = [a for a in (locateCode(old, new, s) for s in starts) if a is not None]
+    _trace(new, first+list(newStarts), verbose)
+    diff = Diff(old, new)
+
+    def carried(items):
+        res = []
+        for (name, a) in items:
+            b = diff.mapAdress(a)
+            if b is None:
+                lost.append((name, a))
+            else:
+                res.append((name, b))
+        return res
+
+    mappedStarts = [b for (name, b) in carried(('start', s) for s in starts)]
+    more = [a for a in mappedStarts if a not in first]
+    if more:
+        # Found through the blocks only: trace them too
+        _trace(new, more, verbose)
+        diff = Diff(old, new)
+    mappedStarts = sorted(set(mappedStarts+list(newStarts)))
+    return (diff, mappedStarts, sorted(set(newExcluded)), carried(symbols), lost)
+
+def writeReport(f, diff, starts, excluded, lost, names={}):
+    """
+    Write the functions of a diff and the options carried to the new
+    version.
+    """
+    def name(a):
+        return names.get(a) or hx(a)
+
+    counts = diff.counts()
+    lines = ['; Functions: '+', '.join('%d %s' % (n, s) for (s, n) in counts.items())+'\n']
+    for (status, o, e) in diff.functions:
+        if status==UNCHANGED:
+            continue
+        if o is None:
+            lines.append('%-10s %s\n' % (functionStatus[status], hx(e)))
+        elif e is None:
+            lines.append('%-10s %s\n' % (functionStatus[status], name(o)))
+        else:
+            lines.append('%-10s %s -> %s\n' % (functionStatus[status], name(o), hx(e)))
+    lines.append('; Carried over: -a %s' % ' '.join('%x' % a for a in starts))
+    if excluded:
+        lines.append(' -x %s' % ' '.join('%x' % a for a in excluded))
+    lines.append('\n')
+    for (n, a) in lost:
+        lines.append('; Not found: %s %s\n' % (n, hx(a)))
+    f.write(''.join(lines))
+
+#-----------------------------------------------------------------------------
+
+def main():
+    ap = argparse.ArgumentParser(description='Diff two versions of a binary, carrying start adresses, exclusions and symbols')
+    ap.add_argument('old_file', help='Old version of the binary')
+    ap.add_argument('new_file', help='New version of the binary')
+    ap.add_argument('-O', '--org', default='0', help='Load adress of the old version (in hex format)')
+    ap.add_argument('-N', '--new-org', help='Load adress of the new version (in hex format), the old one if not set')
+    ap.add_argument('-a', '--start-adresses', nargs="+", help='Start adresses of the old version (in hex format)')
+    ap.add_argument('-A', '--new-start-adresses', nargs="+", help='Additional start adresses of the new version (in hex format)')
+    ap.add_argument('-x', '--exclude-adresses', nargs="+", help='Excluded adresses of the old version (in hex format)')
+    ap.add_argument('-s', '--symbols', help='Symbol file of the old version')
+    ap.add_argument('-o', '--output-prefix', help='Prefix used for generating output files')
+    ap.add_argument('-P', '--platform', default=defaultPlatform, choices=sorted(platforms), help='Platform whose firmware calls are named')
+    ap.add_argument('-v', '--verbose', default=0, action='count', help='Increase Verbosity')
+    args = vars(ap.parse_args())
+
+    org = int(args['org'], 16)
+    newOrg = int(args['new_org'], 16) if args['new_org'] != None else org
+    starts = [int(a, 16) for a in args['start_adresses'] or []]
+    newStarts = [int(a, 16) for a in args['new_start_adresses'] or []]
+    excluded = [int(a, 16) for a in args['exclude_adresses'] or []]
+    symbols = readSymbols(args['symbols']) if args['symbols'] != None else []
+    prefix = args['output_prefix'] or args['new_file']
+    if not starts:
+        starts = [org]
+
+    old = Disassembler(args['verbose'], args['platform'])
+    old.load(args['old_file'], org)
+    new = Disassembler(args['verbose'], args['platform'])
+    new.load(args['new_file'], newOrg)
+    (diff, newStarts, newExcluded, newSymbols, lost) = carry(old, new, starts, excluded, symbols, newStarts, args['verbose'])
+
+    names = old.labels()
+    names.update((a, n) for (n, a) in symbols)
+    print(', '.join('%d %s' % (n, s) for (s, n) in diff.counts().items()), 'functions')
+    print('Generating', prefix+'.diff.txt')
+    with open(prefix+'.diff.txt', 'w') as f:
+        writeReport(f, diff, newStarts, newExcluded, lost, names)
+    if args['symbols'] != None:
+        print('Generating', prefix+'.sym')
+        with open(prefix+'.sym', 'w') as f:
+            f.write(''.join('%s #%04x\n' % (n, a) for (n, a) in newSymbols))
+    for (n, a) in lost:
+        print('Not found in the new version:', n, hx(a))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1058 @@
+#-----------------------------------------------------------------------------
+"""
+Z80 emulation core, for finding the code static tracing cannot reach
+
+The CPU runs a copy of the memory image. Every instruction is one call of
+a handler function found in a 256 entry table by its opcode (one table for
+each prefix group, as in z80da). Handlers take the adress of the
+instruction and return the adress of the next one; registers live in a
+list, memory in a bytearray, both bound to the handlers when the tables
+are built.
+
+    cpu = CPU(mem, lo, hi, stubs=firmware)
+    (pc, count) = cpu.run(0x4000, 1000000)
+
+Memory outside the loaded binary (lo-hi) is filled with HALT, so a run
+stops when the code goes there, unless the program has written something
+else first (relocated code). The stub adresses (firmware jumpblock) hold a
+RET: firmware calls return at once, without changing any register.
+A run also stops when the code returns from the start adress, executes a
+HALT or reaches the instruction limit.
+
+Executed instruction adresses are set in the executed bytearray, the
+targets of the indirect jumps (jp (hl), jp (ix), jp (iy)) in the indirect
+{adress: set of targets} dictionary. Interrupts are not emulated, IN reads
+#ff, OUT does nothing, and block instructions (ldir, cpir...) run as one
+instruction.
+"""
+#-----------------------------------------------------------------------------
+
+# Register indexes in CPU.regs: 8 bit registers in the order of the opcode
+# fields (F takes the place of (hl)), then the index registers, 16 bit
+# SP, and the alternate registers at ALT+B .. ALT+A
+B, C, D, E, H, L, F, A = range(8)
+IXH, IXL, IYH, IYL = range(8, 12)
+SP, I, RFSH, IFF, IM = range(12, 17)
+ALT = 24
+
+# Flags
+CF = 0x01
+NF = 0x02
+PF = 0x04
+HF = 0x10
+ZF = 0x40
+SF = 0x80
+# Undocumented flags, copies of bits 3 and 5 of a result
+XYF = 0x28
+
+HALT = 0x76
+RET = 0xc9
+
+_signed = tuple(v-256 if v>127 else v for v in range(256))
+# Sign, zero and undocumented flags of a result
+_sz = tuple((v & (SF | XYF)) | (ZF if v==0 else 0) for v in range(256))
+# Same with the parity
+_szp = tuple(_sz[v] | (0 if bin(v).count('1') & 1 else PF) for v in range(256))
+# Flags of inc and dec (but the carry), by result
+_inc = tuple(_sz[v] | (HF if v & 0x0f==0 else 0) | (PF if v==0x80 else 0) for v in range(256))
+_dec = tuple(_sz[v] | NF | (HF if v & 0x0f==0x0f else 0) | (PF if v==0x7f else 0) for v in range(256))
+# Flags of bit, by the tested bit value (but the carry and undocumented flags)
+_bit = tuple((_sz[v] & (SF | ZF)) | (PF if v==0 else 0) | HF for v in range(256))
+# Condition codes: (flag, value when true) in the order of z80da._cc
+_cc = ((ZF, 0), (ZF, ZF), (CF, 0), (CF, CF), (PF, 0), (PF, PF), (SF, 0), (SF, SF))
+
+class _Stop(Exception):
+    pass
+
+#-----------------------------------------------------------------------------
+
+def _aluOps(r):
+    """
+    Functions of the 8 bit arithmetic and logic operations (add, adc, sub,
+    sbc, and, xor, or, cp) of A with a value.
+    """
+    def add(v):
+        a = r[A]
+        res = a+v
+        r[F] = _sz[res & 0xff] | (res >> 8) | ((a ^ v ^ res) & HF) | (((a ^ v ^ 0x80) & (a ^ res) & 0x80) >> 5)
+        r[A] = res & 0xff
+
+    def adc(v):
+        a = r[A]
+        res = a+v+(r[F] & CF)
+        r[F] = _sz[res & 0xff] | (res >> 8) | ((a ^ v ^ res) & HF) | (((a ^ v ^ 0x80) & (a ^ res) & 0x80) >> 5)
+        r[A] = res & 0xff
+
+    def sub(v):
+        a = r[A]
+        res = a-v
+        r[F] = _sz[res & 0xff] | NF | ((res >> 8) & CF) | ((a ^ v ^ res) & HF) | (((a ^ v) & (a ^ res) & 0x80) >> 5)
+        r[A] = res & 0xff
+
+    def sbc(v):
+        a = r[A]
+        res = a-v-(r[F] & CF)
+        r[F] = _sz[res & 0xff] | NF | ((res >> 8) & CF) | ((a ^ v ^ res) & HF) | (((a ^ v) & (a ^ res) & 0x80) >> 5)
+        r[A] = res & 0xff
+
+    def and_(v):
+        r[A] = res = r[A] & v
+        r[F] = _szp[res] | HF
+
+    def xor(v):
+        r[A] = res = r[A] ^ v
+        r[F] = _szp[res]
+
+    def or_(v):
+        r[A] = res = r[A] | v
+        r[F] = _szp[res]
+
+    def cp(v):
+        a = r[A]
+        res = a-v
+        r[F] = (_sz[res & 0xff] & ~XYF) | (v & XYF) | NF | ((res >> 8) & CF) | ((a ^ v ^ res) & HF) | (((a ^ v) & (a ^ res) & 0x80) >> 5)
+
+    return (add, adc, sub, sbc, and_, xor, or_, cp)
+
+def _rotOps(r):
+    """
+    Functions of the CB rotations and shifts (rlc, rrc, rl, rr, sla, sra,
+    sll, srl): return the result of a value, and set the flags.
+    """
+    def rlc(v):
+        res = ((v << 1) | (v >> 7)) & 0xff
+        r[F] = _szp[res] | (v >> 7)
+        return res
+
+    def rrc(v):
+        res = (v >> 1) | ((v & 1) << 7)
+        r[F] = _szp[res] | (v & 1)
+        return res
+
+    def rl(v):
+        res = ((v << 1) | (r[F] & CF)) & 0xff
+        r[F] = _szp[res] | (v >> 7)
+        return res
+
+    def rr(v):
+        res = (v >> 1) | ((r[F] & CF) << 7)
+        r[F] = _szp[res] | (v & 1)
+        return res
+
+    def sla(v):
+        res = (v << 1) & 0xff
+        r[F] = _szp[res] | (v >> 7)
+        return res
+
+    def sra(v):
+        res = (v >> 1) | (v & 0x80)
+        r[F] = _szp[res] | (v & 1)
+        return res
+
+    def sll(v):
+        res = ((v << 1) | 1) & 0xff
+        r[F] = _szp[res] | (v >> 7)
+        return res
+
+    def srl(v):
+        res = v >> 1
+        r[F] = _szp[res] | (v & 1)
+        return res
+
+    return (rlc, rrc, rl, rr, sla, sra, sll, srl)
+
+#-----------------------------------------------------------------------------
+
+def _mainTable(cpu, hi, lo, k):
+    """
+    Handlers of the unprefixed instructions, or of the DD/FD ones if k is 1
+    (the prefix length): hi and lo replace H and L, (hl) is (ix+d).
+    """
+    r = cpu.regs
+    m = cpu.mem
+    alu = cpu._alu
+    indirect = cpu.indirect
+    o = 1+k
+
+    def reg(i):
+        return hi if i==H else lo if i==L else i
+
+    def mem(pc):
+        # adress of the (hl) or (ix+d) operand
+        if k:
+            return (((r[hi] << 8) | r[lo]) + _signed[m[pc+2]]) & 0xffff
+        return (r[H] << 8) | r[L]
+
+    # (hl) operands are one byte longer with a displacement
+    mo = o+k
+
+    def nop(n):
+        n += k
+        def op(pc):
+            return pc+n
+        return op
+
+    def ex_af(pc):
+        (r[A], r[F], r[ALT+A], r[ALT+F]) = (r[ALT+A], r[ALT+F], r[A], r[F])
+        return pc+o
+
+    def djnz(pc):
+        r[B] = b = (r[B]-1) & 0xff
+        if b:
+            return (pc+2+k+_signed[m[pc+o]]) & 0xffff
+        return pc+2+k
+
+    def jr(pc):
+        return (pc+2+k+_signed[m[pc+o]]) & 0xffff
+
+    def jr_cc(flag, value):
+        def op(pc):
+            if r[F] & flag == value:
+                return (pc+2+k+_signed[m[pc+o]]) & 0xffff
+            return pc+2+k
+        return op
+
+    def ld_rp_nn(h, l):
+        def op(pc):
+            r[l] = m[pc+o]
+            r[h] = m[pc+o+1]
+            return pc+o+2
+        return op
+
+    def ld_sp_nn(pc):
+        r[SP] = m[pc+o] | (m[pc+o+1] << 8)
+        return pc+o+2
+
+    def add_hl(h, l):
+        def op(pc):
+            a = (r[hi] << 8) | r[lo]
+            v = (r[h] << 8) | r[l] if h is not None else r[SP]
+            res = a+v
+            r[F] = (r[F] & (SF | ZF | PF)) | (((a ^ v ^ res) >> 8) & HF) | (res >> 16) | ((res >> 8) & XYF)
+            r[hi] = (res >> 8) & 0xff
+            r[lo] = res & 0xff
+            return pc+o
+        return op
+
+    def ld_rp_a(h, l):
+        def op(pc):
+            m[(r[h] << 8) | r[l]] = r[A]
+            return pc+o
+        return op
+
+    def ld_a_rp(h, l):
+        def op(pc):
+            r[A] = m[(r[h] << 8) | r[l]]
+            return pc+o
+        return op
+
+    def ld_nn_hl(pc):
+        a = m[pc+o] | (m[pc+o+1] << 8)
+        m[a] = r[lo]
+        m[(a+1) & 0xffff] = r[hi]
+        return pc+o+2
+
+    def ld_nn_a(pc):
+        m[m[pc+o] | (m[pc+o+1] << 8)] = r[A]
+        return pc+o+2
+
+    def ld_hl_nnp(pc):
+        a = m[pc+o] | (m[pc+o+1] << 8)
+        r[lo] = m[a]
+        r[hi] = m[(a+1) & 0xffff]
+        return pc+o+2
+
+    def ld_a_nnp(pc):
+        r[A] = m[m[pc+o] | (m[pc+o+1] << 8)]
+        return pc+o+2
+
+    def inc_rp(h, l):
+        def op(pc):
+            v = r[l]+1
+            if v==256:
+                r[l] = 0
+                r[h] = (r[h]+1) & 0xff
+            else:
+                r[l] = v
+            return pc+o
+        return op
+
+    def dec_rp(h, l):
+        def op(pc):
+            v = r[l]-1
+            if v<0:
+                r[l] = 0xff
+                r[h] = (r[h]-1) & 0xff
+            else:
+                r[l] = v
+            return pc+o
+        return op
+
+    def inc_sp(pc):
+        r[SP] = (r[SP]+1) & 0xffff
+        return pc+o
+
+    def dec_sp(pc):
+        r[SP] = (r[SP]-1) & 0xffff
+        return pc+o
+
+    def inc_r(i):
+        def op(pc):
+            r[i] = v = (r[i]+1) & 0xff
+            r[F] = (r[F] & CF) | _inc[v]
+            return pc+o
+        return op
+
+    def dec_r(i):
+        def op(pc):
+            r[i] = v = (r[i]-1) & 0xff
+            r[F] = (r[F] & CF) | _dec[v]
+            return pc+o
+        return op
+
+    def inc_m(pc):
+        a = mem(pc)
+        m[a] = v = (m[a]+1) & 0xff
+        r[F] = (r[F] & CF) | _inc[v]
+        return pc+mo
+
+    def dec_m(pc):
+        a = mem(pc)
+        m[a] = v = (m[a]-1) & 0xff
+        r[F] = (r[F] & CF) | _dec[v]
+        return pc+mo
+
+    def ld_r_n(i):
+        def op(pc):
+            r[i] = m[pc+o]
+            return pc+o+1
+        return op
+
+    def ld_m_n(pc):
+        m[mem(pc)] = m[pc+mo]
+        return pc+mo+1
+
+    def rlca(pc):
+        a = r[A]
+        r[A] = res = ((a << 1) | (a >> 7)) & 0xff
+        r[F] = (r[F] & (SF | ZF | PF)) | (res & XYF) | (a >> 7)
+        return pc+o
+
+    def rrca(pc):
+        a = r[A]
+        r[A] = res = (a >> 1) | ((a & 1) << 7)
+        r[F] = (r[F] & (SF | ZF | PF)) | (res & XYF) | (a & 1)
+        return pc+o
+
+    def rla(pc):
+        a = r[A]
+        r[A] = res = ((a << 1) | (r[F] & CF)) & 0xff
+        r[F] = (r[F] & (SF | ZF | PF)) | (res & XYF) | (a >> 7)
+        return pc+o
+
+    def rra(pc):
+        a = r[A]
+        r[A] = res = (a >> 1) | ((r[F] & CF) << 7)
+        r[F] = (r[F] & (SF | ZF | PF)) | (res & XYF) | (a & 1)
+        return pc+o
+
+    def daa(pc):
+        a = r[A]
+        f = r[F]
+        diff = 0
+        c = f & CF
+        if f & HF or a & 0x0f > 9:
+            diff = 6
+        if c or a > 0x99:
+            diff |= 0x60
+            c = CF
+        if f & NF:
+            h = HF if f & HF and a & 0x0f < 6 else 0
+            res = (a-diff) & 0xff
+        else:
+            h = HF if a & 0x0f > 9 else 0
+            res = (a+diff) & 0xff
+        r[A] = res
+        r[F] = _szp[res] | (f & NF) | h | c
+        return pc+o
+
+    def cpl(pc):
+        r[A] = a = r[A] ^ 0xff
+        r[F] = (r[F] & (SF | ZF | PF | CF)) | HF | NF | (a & XYF)
+        return pc+o
+
+    def scf(pc):
+        r[F] = (r[F] & (SF | ZF | PF)) | (r[A] & XYF) | CF
+        return pc+o
+
+    def ccf(pc):
+        f = r[F]
+        r[F] = ((f & (SF | ZF | PF | CF)) | ((f & CF) << 4) | (r[A] & XYF)) ^ CF
+        return pc+o
+
+    def ld_r_r(d, s):
+        def op(pc):
+            r[d] = r[s]
+            return pc+o
+        return op
+
+    def ld_r_m(d):
+        def op(pc):
+            r[d] = m[mem(pc)]
+            return pc+mo
+        return op
+
+    def ld_m_r(s):
+        def op(pc):
+            m[mem(pc)] = r[s]
+            return pc+mo
+        return op
+
+    def halt(pc):
+        raise _Stop(pc)
+
+    def alu_r(fn, s):
+        def op(pc):
+            fn(r[s])
+            return pc+o
+        return op
+
+    def alu_m(fn):
+        def op(pc):
+            fn(m[mem(pc)])
+            return pc+mo
+        return op
+
+    def alu_n(fn):
+        def op(pc):
+            fn(m[pc+o])
+            return pc+o+1
+        return op
+
+    def ret(pc):
+        sp = r[SP]
+        r[SP] = (sp+2) & 0xffff
+        return m[sp] | (m[(sp+1) & 0xffff] << 8)
+
+    def ret_cc(flag, value):
+        def op(pc):
+            if r[F] & flag == value:
+                sp = r[SP]
+                r[SP] = (sp+2) & 0xffff
+                return m[sp] | (m[(sp+1) & 0xffff] << 8)
+            return pc+o
+        return op
+
+    def pop(h, l):
+        def op(pc):
+            sp = r[SP]
+            r[l] = m[sp]
+            r[h] = m[(sp+1) & 0xffff]
+            r[SP] = (sp+2) & 0xffff
+            return pc+o
+        return op
+
+    def push(h, l):
+        def op(pc):
+            r[SP] = sp = (r[SP]-2) & 0xffff
+            m[sp] = r[l]
+            m[(sp+1) & 0xffff] = r[h]
+            return pc+o
+        return op
+
+    def exx(pc):
+        r[B:L+1], r[ALT+B:ALT+L+1] = r[ALT+B:ALT+L+1], r[B:L+1]
+        return pc+o
+
+    def jp_hl(pc):
+        t = (r[hi] << 8) | r[lo]
+        s = indirect.get(pc)
+        if s is None:
+            indirect[pc] = {t}
+        else:
+            s.add(t)
+        return t
+
+    def ld_sp_hl(pc):
+        r[SP] = (r[hi] << 8) | r[lo]
+        return pc+o
+
+    def jp(pc):
+        return m[pc+o] | (m[pc+o+1] << 8)
+
+    def jp_cc(flag, value):
+        def op(pc):
+            if r[F] & flag == value:
+                return m[pc+o] | (m[pc+o+1] << 8)
+            return pc+o+2
+        return op
+
+    def out_n(pc):
+        return pc+o+1
+
+    def in_n(pc):
+        r[A] = 0xff
+        return pc+o+1
+
+    def ex_sp_hl(pc):
+        sp = r[SP]
+        s1 = (sp+1) & 0xffff
+        (r[lo], m[sp], r[hi], m[s1]) = (m[sp], r[lo], m[s1], r[hi])
+        return pc+o
+
+    def ex_de_hl(pc):
+        # Not changed by a DD/FD prefix
+        (r[D], r[E], r[H], r[L]) = (r[H], r[L], r[D], r[E])
+        return pc+o
+
+    def di(pc):
+        r[IFF] = 0
+        return pc+o
+
+    def ei(pc):
+        r[IFF] = 1
+        return pc+o
+
+    def call(pc):
+        ret = pc+o+2
+        r[SP] = sp = (r[SP]-2) & 0xffff
+        m[sp] = ret & 0xff
+        m[(sp+1) & 0xffff] = (ret >> 8) & 0xff
+        return m[pc+o] | (m[pc+o+1] << 8)
+
+    def call_cc(flag, value):
+        def op(pc):
+            if r[F] & flag == value:
+                return call(pc)
+            return pc+o+2
+        return op
+
+    def rst(t):
+        def op(pc):
+            ret = pc+o
+            r[SP] = sp = (r[SP]-2) & 0xffff
+            m[sp] = ret & 0xff
+            m[(sp+1) & 0xffff] = (ret >> 8) & 0xff
+            return t
+        return op
+
+    t = [None]*256
+    for opcode in range(256):
+        x = opcode >> 6
+        y = (opcode >> 3) & 7
+        z = opcode & 7
+        p = y >> 1
+        q = y & 1
+        # pairs bc, de, hl (or ix/iy), sp as (high, low) registers
+        rp = ((B, C), (D, E), (hi, lo), (None, None))[p]
+        if x==0:
+            if z==0:
+                t[opcode] = (nop(1), ex_af, djnz, jr)[y] if y<4 else jr_cc(*_cc[y-4])
+            elif z==1:
+                if q==0:
+                    t[opcode] = ld_sp_nn if p==3 else ld_rp_nn(*rp)
+                else:
+                    t[opcode] = add_hl(*rp)
+            elif z==2:
+                t[opcode] = ((ld_rp_a(B, C), ld_rp_a(D, E), ld_nn_hl, ld_nn_a),
+                             (ld_a_rp(B, C), ld_a_rp(D, E), ld_hl_nnp, ld_a_nnp))[q][p]
+            elif z==3:
+                if p==3:
+                    t[opcode] = (inc_sp, dec_sp)[q]
+                else:
+                    t[opcode] = (inc_rp, dec_rp)[q](*rp)
+            elif z==4:
+                t[opcode] = inc_m if y==6 else inc_r(reg(y))
+            elif z==5:
+                t[opcode] = dec_m if y==6 else dec_r(reg(y))
+            elif z==6:
+                t[opcode] = ld_m_n if y==6 else ld_r_n(reg(y))
+            else:
+                t[opcode] = (rlca, rrca, rla, rra, daa, cpl, scf, ccf)[y]
+        elif x==1:
+            if y==6 and z==6:
+                t[opcode] = halt
+            elif y==6:
+                # ld (ix+d),h: the other register is not replaced
+                t[opcode] = ld_m_r(z)
+            elif z==6:
+                t[opcode] = ld_r_m(y)
+            else:
+                t[opcode] = ld_r_r(reg(y), reg(z))
+        elif x==2:
+            t[opcode] = alu_m(alu[y]) if z==6 else alu_r(alu[y], reg(z))
+        else:
+            if z==0:
+                t[opcode] = ret_cc(*_cc[y])
+            elif z==1:
+                if q==0:
+                    t[opcode] = pop(A, F) if p==3 else pop(*rp)
+                else:
+                    t[opcode] = (ret, exx, jp_hl, ld_sp_hl)[p]
+            elif z==2:
+                t[opcode] = jp_cc(*_cc[y])
+            elif z==3:
+                t[opcode] = (jp, None, out_n, in_n, ex_sp_hl, ex_de_hl, di, ei)[y]
+            elif z==4:
+                t[opcode] = call_cc(*_cc[y])
+            elif z==5:
+                if q==0:
+                    t[opcode] = push(A, F) if p==3 else push(*rp)
+                elif p==0:
+                    t[opcode] = call
+            elif z==6:
+                t[opcode] = alu_n(alu[y])
+            else:
+                t[opcode] = rst(y << 3)
+    return t
+
+def _cbTable(cpu):
+    """
+    Handlers of the CB instructions.
+    """
+    r = cpu.regs
+    m = cpu.mem
+    rot = cpu._rot
+
+    def rot_r(fn, i):
+        def op(pc):
+            r[i] = fn(r[i])
+            return pc+2
+        return op
+
+    def rot_m(fn):
+        def op(pc):
+            a = (r[H] << 8) | r[L]
+            m[a] = fn(m[a])
+            return pc+2
+        return op
+
+    def bit_r(b, i):
+        def op(pc):
+            v = r[i]
+            r[F] = (r[F] & CF) | _bit[v & b] | (v & XYF)
+            return pc+2
+        return op
+
+    def bit_m(b):
+        def op(pc):
+            v = m[(r[H] << 8) | r[L]]
+            r[F] = (r[F] & CF) | _bit[v & b] | (v & XYF)
+            return pc+2
+        return op
+
+    def res_r(mask, i):
+        def op(pc):
+            r[i] &= mask
+            return pc+2
+        return op
+
+    def res_m(mask):
+        def op(pc):
+            a = (r[H] << 8) | r[L]
+            m[a] &= mask
+            return pc+2
+        return op
+
+    def set_r(b, i):
+        def op(pc):
+            r[i] |= b
+            return pc+2
+        return op
+
+    def set_m(b):
+        def op(pc):
+            a = (r[H] << 8) | r[L]
+            m[a] |= b
+            return pc+2
+        return op
+
+    t = [None]*256
+    for opcode in range(256):
+        x = opcode >> 6
+        y = (opcode >> 3) & 7
+        z = opcode & 7
+        if x==0:
+            t[opcode] = rot_m(rot[y]) if z==6 else rot_r(rot[y], z)
+        elif x==1:
+            t[opcode] = bit_m(1 << y) if z==6 else bit_r(1 << y, z)
+        elif x==2:
+            t[opcode] = res_m(0xff ^ (1 << y)) if z==6 else res_r(0xff ^ (1 << y), z)
+        else:
+            t[opcode] = set_m(1 << y) if z==6 else set_r(1 << y, z)
+    return t
+
+def _indexCbTable(cpu, hi, lo):
+    """
+    Handlers of the DDCB or FDCB instructions (hi, lo: index register),
+    indexed by their 4th byte. The undocumented forms also copy the result
+    to a register.
+    """
+    r = cpu.regs
+    m = cpu.mem
+    rot = cpu._rot
+
+    def rot_m(fn, z):
+        def op(pc):
+            a = (((r[hi] << 8) | r[lo]) + _signed[m[pc+2]]) & 0xffff
+            m[a] = v = fn(m[a])
+            if z!=6:
+                r[z] = v
+            return pc+4
+        return op
+
+    def bit_m(b):
+        def op(pc):
+            a = (((r[hi] << 8) | r[lo]) + _signed[m[pc+2]]) & 0xffff
+            r[F] = (r[F] & CF) | _bit[m[a] & b] | ((a >> 8) & XYF)
+            return pc+4
+        return op
+
+    def res_m(mask, z):
+        def op(pc):
+            a = (((r[hi] << 8) | r[lo]) + _signed[m[pc+2]]) & 0xffff
+            m[a] = v = m[a] & mask
+            if z!=6:
+                r[z] = v
+            return pc+4
+        return op
+
+    def set_m(b, z):
+        def op(pc):
+            a = (((r[hi] << 8) | r[lo]) + _signed[m[pc+2]]) & 0xffff
+            m[a] = v = m[a] | b
+            if z!=6:
+                r[z] = v
+            return pc+4
+        return op
+
+    t = [None]*256
+    for opcode in range(256):
+        x = opcode >> 6
+        y = (opcode >> 3) & 7
+        z = opcode & 7
+        if x==0:
+            t[opcode] = rot_m(rot[y], z)
+        elif x==1:
+            t[opcode] = bit_m(1 << y)
+        elif x==2:
+            t[opcode] = res_m(0xff ^ (1 << y), z)
+        else:
+            t[opcode] = set_m(1 << y, z)
+    return t
+
+#-----------------------------------------------------------------------------
+
+def _edTable(cpu):
+    """
+    Handlers of the ED instructions.
+    """
+    r = cpu.regs
+    m = cpu.mem
+    sub = cpu._alu[2]
+
+    def nop(pc):
+        return pc+2
+
+    def in_r(i):
+        def op(pc):
+            if i!=F:
+                r[i] = 0xff
+            r[F] = (r[F] & CF) | _szp[0xff]
+            return pc+2
+        return op
+
+    def pair(p):
+        if p==3:
+            return r[SP]
+        (h, l) = ((B, C), (D, E), (H, L))[p]
+        return (r[h] << 8) | r[l]
+
+    def sbc_hl(p):
+        def op(pc):
+            a = (r[H] << 8) | r[L]
+            v = pair(p)
+            res = a-v-(r[F] & CF)
+            w = res & 0xffff
+            r[F] = ((w >> 8) & (SF | XYF)) | (0 if w else ZF) | NF | (((a ^ v ^ res) >> 8) & HF) \
+                   | (((a ^ v) & (a ^ res) & 0x8000) >> 13) | ((res >> 16) & CF)
+            r[H] = w >> 8
+            r[L] = w & 0xff
+            return pc+2
+        return op
+
+    def adc_hl(p):
+        def op(pc):
+            a = (r[H] << 8) | r[L]
+            v = pair(p)
+            res = a+v+(r[F] & CF)
+            w = res & 0xffff
+            r[F] = ((w >> 8) & (SF | XYF)) | (0 if w else ZF) | (((a ^ v ^ res) >> 8) & HF) \
+                   | (((a ^ v ^ 0x8000) & (a ^ res) & 0x8000) >> 13) | (res >> 16)
+            r[H] = w >> 8
+            r[L] = w & 0xff
+            return pc+2
+        return op
+
+    def ld_nn_rp(p):
+        def op(pc):
+            a = m[pc+2] | (m[pc+3] << 8)
+            v = pair(p)
+            m[a] = v & 0xff
+            m[(a+1) & 0xffff] = v >> 8
+            return pc+4
+        return op
+
+    def ld_rp_nn(p):
+        def op(pc):
+            a = m[pc+2] | (m[pc+3] << 8)
+            v = m[a] | (m[(a+1) & 0xffff] << 8)
+            if p==3:
+                r[SP] = v
+            else:
+                (h, l) = ((B, C), (D, E), (H, L))[p]
+                r[h] = v >> 8
+                r[l] = v & 0xff
+            return pc+4
+        return op
+
+    def neg(pc):
+        v = r[A]
+        r[A] = 0
+        sub(v)
+        return pc+2
+
+    def retn(pc):
+        sp = r[SP]
+        r[SP] = (sp+2) & 0xffff
+        return m[sp] | (m[(sp+1) & 0xffff] << 8)
+
+    def im(mode):
+        def op(pc):
+            r[IM] = mode
+            return pc+2
+        return op
+
+    def ld_ir_a(i):
+        def op(pc):
+            r[i] = r[A]
+            return pc+2
+        return op
+
+    def ld_a_ir(i):
+        def op(pc):
+            r[A] = v = r[i]
+            r[F] = (r[F] & CF) | _sz[v] | (PF if r[IFF] else 0)
+            return pc+2
+        return op
+
+    def rrd(pc):
+        a = (r[H] << 8) | r[L]
+        v = m[a]
+        x = r[A]
+        m[a] = ((x << 4) | (v >> 4)) & 0xff
+        r[A] = x = (x & 0xf0) | (v & 0x0f)
+        r[F] = (r[F] & CF) | _szp[x]
+        return pc+2
+
+    def rld(pc):
+        a = (r[H] << 8) | r[L]
+        v = m[a]
+        x = r[A]
+        m[a] = ((v << 4) | (x & 0x0f)) & 0xff
+        r[A] = x = (x & 0xf0) | (v >> 4)
+        r[F] = (r[F] & CF) | _szp[x]
+        return pc+2
+
+    def ld_block(step, repeat):
+        def op(pc):
+            hl = (r[H] << 8) | r[L]
+            de = (r[D] << 8) | r[E]
+            bc = (r[B] << 8) | r[C]
+            n = (bc or 0x10000) if repeat else 1
+            if step>0:
+                (s, d) = (hl, de)
+            else:
+                (s, d) = (hl-n+1, de-n+1)
+            # One slice, unless the copy wraps or overwrites its source
+            if 0<=s and 0<=d and s+n<=0x10000 and d+n<=0x10000 and not (n>1 and 0<(d-s)*step<n):
+                m[d:d+n] = m[s:s+n]
+            else:
+                for i in range(n):
+                    m[(de+i*step) & 0xffff] = m[(hl+i*step) & 0xffff]
+            v = m[(de+(n-1)*step) & 0xffff] + r[A]
+            hl = (hl+n*step) & 0xffff
+            de = (de+n*step) & 0xffff
+            bc = (bc-n) & 0xffff
+            (r[H], r[L], r[D], r[E], r[B], r[C]) = (hl >> 8, hl & 0xff, de >> 8, de & 0xff, bc >> 8, bc & 0xff)
+            r[F] = (r[F] & (SF | ZF | CF)) | (PF if bc else 0) | (v & 0x08) | ((v & 0x02) << 4)
+            return pc+2
+        return op
+
+    def cp_block(step, repeat):
+        def op(pc):
+            hl = (r[H] << 8) | r[L]
+            bc = (r[B] << 8) | r[C]
+            a = r[A]
+            n = (bc or 0x10000) if repeat else 1
+            # Bytes compared: up to the first one equal to A
+            if step>0 and hl+n<=0x10000:
+                i = m.find(a, hl, hl+n)
+                if i>=0:
+                    n = i-hl+1
+            elif step<0 and hl-n+1>=0:
+                i = m.rfind(a, hl-n+1, hl+1)
+                if i>=0:
+                    n = hl-i+1
+            else:
+                for i in range(n):
+                    if m[(hl+i*step) & 0xffff]==a:
+                        n = i+1
+                        break
+            v = m[(hl+(n-1)*step) & 0xffff]
+            hl = (hl+n*step) & 0xffff
+            bc = (bc-n) & 0xffff
+            (r[H], r[L], r[B], r[C]) = (hl >> 8, hl & 0xff, bc >> 8, bc & 0xff)
+            res = (a-v) & 0xff
+            h = (a ^ v ^ res) & HF
+            x = (res-(1 if h else 0)) & 0xff
+            r[F] = (r[F] & CF) | NF | (_sz[res] & (SF | ZF)) | h | (PF if bc else 0) | (x & 0x08) | ((x & 0x02) << 4)
+            return pc+2
+        return op
+
+    def io_block(step, repeat, write):
+        def op(pc):
+            hl = (r[H] << 8) | r[L]
+            b = r[B]
+            n = (b or 0x100) if repeat else 1
+            if write:
+                # Input: every read gives #ff
+                for i in range(n):
+                    m[(hl+i*step) & 0xffff] = 0xff
+            hl = (hl+n*step) & 0xffff
+            r[B] = b = (b-n) & 0xff
+            (r[H], r[L]) = (hl >> 8, hl & 0xff)
+            r[F] = _sz[b] | NF
+            return pc+2
+        return op
+
+    t = [nop]*256
+    for opcode in range(256):
+        x = opcode >> 6
+        y = (opcode >> 3) & 7
+        z = opcode & 7
+        p = y >> 1
+        q = y & 1
+        if x==1:
+            if z==0:
+                t[opcode] = in_r(y)
+            elif z==2:
+                t[opcode] = (sbc_hl, adc_hl)[q](p)
+            elif z==3:
+                t[opcode] = (ld_nn_rp, ld_rp_nn)[q](p)
+            elif z==4:
+                t[opcode] = neg
+            elif z==5:
+                t[opcode] = retn
+            elif z==6:
+                t[opcode] = im((0, 0, 1, 2, 0, 0, 1, 2)[y])
+            elif z==7:
+                t[opcode] = (ld_ir_a(I), ld_ir_a(RFSH), ld_a_ir(I), ld_a_ir(RFSH), rrd, rld, nop, nop)[y]
+        elif x==2 and z<=3 and y>=4:
+            step = -1 if y & 1 else 1
+            repeat = y>=6
+            if z==0:
+                t[opcode] = ld_block(step, repeat)
+            elif z==1:
+                t[opcode] = cp_block(step, repeat)
+            else:
+                t[opcode] = io_block(step, repeat, z==2)
+    return t
+
+#-----------------------------------------------------------------------------
+
+class CPU:
+    """
+    Z80 running a copy of the memory image mem, whose loaded binary is at
+    lo-hi. stubs are the adresses of the firmware entry points.
+    """
+
+    def __init__(self, mem, lo=0, hi=0x10000, stubs=()):
+        self.mem = bytearray((HALT,)) * 0x10000
+        self.mem[lo:hi] = mem[lo:hi]
+        for a in stubs:
+            if not lo<=a<hi:
+                self.mem[a] = RET
+        self.lo = lo
+        self.hi = hi
+        self.regs = [0]*32
+        self.executed = bytearray(0x10000)
+        self.indirect = {}
+        # Return adress of the runs: a HALT outside the binary
+        self.exit = None
+        for a in range(hi, 0x10000) if hi<0x10000 else range(0, lo):
+            if self.mem[a]==HALT:
+                self.exit = a
+                break
+        self._alu = _aluOps(self.regs)
+        self._rot = _rotOps(self.regs)
+        m = self.mem
+        main = _mainTable(self, H, L, 0)
+        cb = _cbTable(self)
+        ed = _edTable(self)
+        dd = _mainTable(self, IXH, IXL, 1)
+        fd = _mainTable(self, IYH, IYL, 1)
+        ddcb = _indexCbTable(self, IXH, IXL)
+        fdcb = _indexCbTable(self, IYH, IYL)
+        main[0xcb] = lambda pc: cb[m[pc+1]](pc)
+        main[0xed] = lambda pc: ed[m[pc+1]](pc)
+        main[0xdd] = lambda pc: dd[m[pc+1]](pc)
+        main[0xfd] = lambda pc: fd[m[pc+1]](pc)
+        dd[0xcb] = lambda pc: ddcb[m[pc+3]](pc)
+        fd[0xcb] = lambda pc: fdcb[m[pc+3]](pc)
+        # A prefix followed by another one does nothing
+        for t in (dd, fd):
+            t[0xdd] = t[0xed] = t[0xfd] = lambda pc: pc+1
+        self._main = main
+
+    def stack(self):
+        """
+        Default stack adress: the top of the largest area outside the binary.
+        """
+        if self.lo > 0x10000-self.hi:
+            return self.lo
+        return 0
+
+    def run(self, pc, limit, sp=None):
+        """
+        Run from pc, with all registers at 0, for at most limit instructions.
+        The stack holds the adress of a HALT, so that a return from pc stops.
+        Return (adress where the run stopped, number of instructions executed).
+        """
+        r = self.regs
+        r[:] = [0]*len(r)
+        m = self.mem
+        sp = (self.stack() if sp is None else sp)-2 & 0xffff
+        r[SP] = sp
+        if self.exit is not None:
+            m[sp] = self.exit & 0xff
+            m[(sp+1) & 0xffff] = self.exit >> 8
+        main = self._main
+        executed = self.executed
+        count = 0
+        while True:
+            try:
+                for count in range(count, limit):
+                    executed[pc] = 1
+                    pc = main[m[pc]](pc)
+                count = limit
+            except _Stop as e:
+                pc = e.args[0]
+            except IndexError:
+                if pc>0xffff:
+                    # Sequential execution wrapping to 0
+                    pc &= 0xffff
+                    continue
+                # Instruction running past the end of memory
+            break
+        return (pc, count)
@@ -0,0 +1,126 @@
+#-----------------------------------------------------------------------------
+"""
+Execution logs of emulators
+
+A log is the list of the PC values an emulator ran, in one of two formats:
+    text    one hexadecimal adress per line (4000, #4000, $4000, &4000,
+            0x4000 or 4000h), empty lines are ignored
+    binary  16 bit little endian adresses, one after the other
+A .gz log is decompressed on the fly.
+
+Logs are read by chunks, so memory does not depend on the size of the log,
+and reduced to a 64Kb bitmap of the executed adresses. Most of a log is
+repeated loops: a text chunk is first cut after the lines ending with 0,
+the identical pieces are merged with a set and only the different ones
+are split into lines. Binary chunks are read as arrays of words, first
+merged by groups of 4 words (64 bit integers) when they repeat.
+"""
+#-----------------------------------------------------------------------------
+
+from array import array
+import gzip
+import sys
+
+# Bytes read at once
+chunkSize = 1 << 24
+# Binary chunks: groups of 4 adresses looked at, and the part of them that
+# must be different for the chunk to be read adress by adress
+sampleGroups = 8192
+repeatRatio = 0.25
+
+_hexDigits = b'0123456789abcdefABCDEF'
+# Characters of a text log
+_textChars = _hexDigits + b'#$&xXhH:\r\n\t '
+
+def _open(fileName):
+    if fileName.endswith('.gz'):
+        return gzip.open(fileName, 'rb')
+    return open(fileName, 'rb')
+
+def guessFormat(fileName):
+    """
+    'text' if the beginning of the log only has text log characters,
+    'binary' otherwise.
+    """
+    with _open(fileName) as f:
+        sample = f.read(4096)
+    if sample.translate(None, _textChars):
+        return 'binary'
+    return 'text'
+
+def parseAdress(token):
+    """
+    Value of a hexadecimal adress of a text log.
+    """
+    t = token.strip(b':').lower()
+    if t[:1] in (b'#', b'$', b'&'):
+        t = t[1:]
+    elif t[:2] == b'0x':
+        t = t[2:]
+    elif t[-1:] == b'h':
+        t = t[:-1]
+    if t == b'' or t.translate(None, _hexDigits) or len(t) > 4:
+        raise ValueError('bad adress in execution log: %r' % token)
+    return int(t, 16)
+
+def _textTokens(chunk, cut):
+    """
+    Set of the different lines of a text chunk (made of whole lines).
+    """
+    pieces = chunk.split(cut)
+    last = pieces.pop()
+    if not pieces:
+        return set(last.split())
+    return set((cut.join(set(pieces)) + cut + last).split())
+
+def _binaryValues(data):
+    """
+    Set of the adresses of a binary chunk (of even size). If its beginning
+    repeats, the groups of 4 adresses (64 bit integers) are merged first,
+    so there is not one object per adress.
+    """
+    n = len(data) & ~7
+    groups = memoryview(data)[:n].cast('Q')
+    sample = groups[:sampleGroups]
+    if len(sample) and len(set(sample)) <= repeatRatio*len(sample):
+        data = array('Q', set(groups)).tobytes() + data[n:]
+    words = array('H', data)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return set(words)
+
+def readLog(fileName, fmt='auto', executed=None):
+    """
+    Read an execution log, setting executed[pc] to 1 for each adress in it.
+    executed is a 64Kb bytearray, created if None.
+    Return (executed, number of bytes read).
+    """
+    if executed is None:
+        executed = bytearray(65536)
+    if fmt == 'auto':
+        fmt = guessFormat(fileName)
+    size = 0
+    with _open(fileName) as f:
+        rest = b''
+        cut = None
+        while True:
+            data = f.read(chunkSize)
+            size += len(data)
+            chunk = rest + data
+            if fmt == 'text':
+                if cut is None:
+                    cut = b'0\r\n' if b'\r\n' in chunk else b'0\n'
+                # Whole lines only, the last one is kept for the next chunk
+                end = chunk.rfind(b'\n')+1 if data else len(chunk)
+                values = map(parseAdress, _textTokens(chunk[:end], cut))
+            else:
+                end = len(chunk) & ~1
+                values = _binaryValues(chunk[:end])
+            for pc in values:
+                executed[pc] = 1
+            rest = chunk[end:]
+            if not data:
+                break
+        if rest:
+            raise ValueError('%s: odd number of bytes in a binary execution log' % fileName)
+    return (executed, size)
@@ -0,0 +1,58 @@
+#-----------------------------------------------------------------------------
+"""
+Platform firmware tables
+
+Each platform maps to an address indexed table of firmware entry points,
+living in a platform module (z80cpc for the Amstrad CPC). The module is
+only imported when its platform is selected.
+"""
+#-----------------------------------------------------------------------------
+
+import importlib
+
+# platform => (module, firmware table), None if there is no firmware
+platforms = {
+    'none': None,
+    'cpc464': ('z80cpc', 'firmware_464'),
+    'cpc664': ('z80cpc', 'firmware_6128'),
+    'cpc6128': ('z80cpc', 'firmware_6128'),
+}
+
+defaultPlatform = 'cpc6128'
+
+_tables = {}
+
+def callTarget(s):
+    """
+    Numeric target of the call in an asm line (call nn or call cc,nn with
+    nn in #, &, $, 0x or h hexadecimal notation), None if there is none.
+    """
+    s = s.lower()
+    i = s.find('call')
+    if i < 0:
+        return None
+    arg = s[i+4:].split(';')[0].split(',')[-1].strip()
+    try:
+        if arg[:1] in ('#', '&', '$'):
+            return int(arg[1:], 16)
+        if arg[:2] == '0x':
+            return int(arg[2:], 16)
+        if arg[-1:] == 'h' and arg[:1].isdigit():
+            return int(arg[:-1], 16)
+    except ValueError:
+        pass
+    return None
+
+def firmware(platform):
+    """
+    Return the {address: name} firmware table of a platform.
+    """
+    t = _tables.get(platform)
+    if t is None:
+        p = platforms[platform]
+        if p is None:
+            t = {}
+        else:
+            t = getattr(importlib.import_module(p[0]), p[1])
+        _tables[platform] = t
+    return t
@@ -0,0 +1,251 @@
+# Z80 Smart Disassembler - routine signatures
+# by Stephane Sikora
+
+#-----------------------------------------------------------------------------
+"""
+Signatures of known routines
+
+A signature is the hash of the instructions of a function (see
+z80cfg.CallGraph), block after block in the order they are reached from
+its entry, with their adress operands zeroed (see z80da.masked): the same
+routine loaded at another adress, or calling routines at other adresses,
+has the same signature. Functions of less than minSize bytes are too
+common to be signed.
+
+A signature file is an open addressing hash table of (64 bit hash, name
+offset, size) slots, at least twice as many as the signatures, followed
+by the names. It is memory-mapped and looked up in place: a lookup reads
+one or two slots, whatever the number of signatures, and opening the file
+reads nothing.
+
+Signatures are added from labelled assembler sources: by adress, every
+label of an instruction which is called, or not reached from the entries
+before it, is a function entry named after the label.
+
+    python3 z80sig.py add routines.sig player.asm -p ay_
+    python3 z80sig.py list routines.sig
+    python3 z80-smart-disassembler.py -i game.bin -a 4000 -K routines.sig
+"""
+#-----------------------------------------------------------------------------
+
+from z80smart import Disassembler
+from z80da import masked
+from z80cfg import CallGraph, EDGE_CALL, EDGE_CALL_COND
+from z80asm import assemble
+import contextlib
+import argparse
+import hashlib
+import struct
+import mmap
+import io
+import os
+
+# Smallest signed function, in bytes
+minSize = 16
+
+_MAGIC = b'Z80SIGS1'
+# magic, number of slots, number of signatures
+_HEADER = struct.Struct('<8sII')
+_HEADER_SIZE = 32
+# hash, name offset, size
+_SLOT = struct.Struct('<QII')
+
+def signature(data):
+    """
+    Hash of masked instruction bytes, never 0 (the empty slot).
+    """
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little') or 1
+
+def functionSignatures(d, calls=None):
+    """
+    Return {function entry: (hash, size)} of the functions of at least
+    minSize bytes of the traced Disassembler d, calls being its call
+    graph (d.callGraph() if None).
+    """
+    if calls is None:
+        calls = d.callGraph()
+    blocks = d.cfg().blocks
+    res = {}
+    for (e, f) in calls.functions.items():
+        if f.size<minSize:
+            continue
+        data = b''.join(masked(d.mem, a, blocks[a].end) for a in f.blocks)
+        res[e] = (signature(data), f.size)
+    return res
+
+#-----------------------------------------------------------------------------
+
+class Signatures:
+    """
+    Signature file, memory-mapped. An empty set if fileName is None or
+    does not exist.
+    """
+
+    def __init__(self, fileName=None):
+        self.mm = None
+        self.slots = 0
+        self.count = 0
+        if fileName is None or not os.path.exists(fileName):
+            return
+        with open(fileName, mode='rb') as file:
+            self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.slots, self.count) = _HEADER.unpack_from(self.mm)
+        if magic!=_MAGIC:
+            self.close()
+            raise ValueError('%s: not a signature file' % fileName)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def __len__(self):
+        return self.count
+
+    def _name(self, offset):
+        mm = self.mm
+        end = mm.find(b'\0', offset)
+        return mm[offset:end].decode('utf-8')
+
+    def lookup(self, h):
+        """
+        Return the (name, size) of the signature with hash h, None if there
+        is none.
+        """
+        if not self.slots:
+            return None
+        mask = self.slots-1
+        i = h & mask
+        while True:
+            (sh, offset, size) = _SLOT.unpack_from(self.mm, _HEADER_SIZE+i*_SLOT.size)
+            if sh==h:
+                return (self._name(offset), size)
+            if sh==0:
+                return None
+            i = (i+1) & mask
+
+    def items(self):
+        """
+        Iterate over the (hash, name, size) signatures.
+        """
+        for i in range(self.slots):
+            (sh, offset, size) = _SLOT.unpack_from(self.mm, _HEADER_SIZE+i*_SLOT.size)
+            if sh:
+                yield (sh, self._name(offset), size)
+
+def write(fileName, signatures):
+    """
+    Write a signature file from a {hash: (name, size)} dictionary.
+    """
+    slots = 16
+    while slots<2*len(signatures):
+        slots *= 2
+    table = [None] * slots
+    names = bytearray()
+    base = _HEADER_SIZE+slots*_SLOT.size
+    for (h, (name, size)) in signatures.items():
+        i = h & (slots-1)
+        while table[i] is not None:
+            i = (i+1) & (slots-1)
+        table[i] = _SLOT.pack(h, base+len(names), size)
+        names += name.encode('utf-8')+b'\0'
+    empty = _SLOT.pack(0, 0, 0)
+    with open(fileName, mode='wb') as file:
+        file.write(_HEADER.pack(_MAGIC, slots, len(signatures)).ljust(_HEADER_SIZE, b'\0'))
+        file.write(b''.join(empty if s is None else s for s in table))
+        file.write(names)
+
+#-----------------------------------------------------------------------------
+
+def match(d, sigs):
+    """
+    Name the functions of the traced Disassembler d found in the signature
+    file sigs (in d.symbols). A routine found several times gets a number
+    after the first one. Return the number of functions found.
+    """
+    used = set(d.symbols.values())
+    n = 0
+    for (e, (h, size)) in sorted(functionSignatures(d).items()):
+        s = sigs.lookup(h)
+        if s is None or s[1]!=size or e in d.symbols:
+            continue
+        name = s[0]
+        k = 2
+        while name in used:
+            name = '%s_%d' % (s[0], k)
+            k += 1
+        used.add(name)
+        d.symbols[e] = name
+        n += 1
+    d.stats.add('signature_matches', n)
+    return n
+
+def fromSource(lines, prefix=''):
+    """
+    Return the {hash: (name, size)} signatures of the functions of a
+    labelled assembler source, named prefix+label.
+    """
+    symbols = {}
+    code = set()
+    (org, data) = assemble(lines, symbols, code)
+    d = Disassembler(platform='none')
+    d.load(data, org)
+    entries = sorted(a for a in set(symbols.values()) if a in code)
+    with contextlib.redirect_stdout(io.StringIO()):
+        d.trace(entries)
+    # Labels reached from an entry without calling (loops...) are not
+    # entries, unless they are called
+    cfg = d.cfg()
+    called = set(to for (a, to, kind) in cfg.edges() if kind in (EDGE_CALL, EDGE_CALL_COND))
+    roots = []
+    reached = set()
+    for a in entries:
+        if a in reached and a not in called:
+            continue
+        roots.append(a)
+        stack = [a]
+        while stack:
+            b = cfg.blocks.get(stack.pop())
+            if b is None or b.start in reached:
+                continue
+            reached.add(b.start)
+            stack.extend(to for (to, kind) in b.succ if kind not in (EDGE_CALL, EDGE_CALL_COND))
+    names = {}
+    for (name, a) in symbols.items():
+        names.setdefault(a, name)
+    res = {}
+    for (e, (h, size)) in functionSignatures(d, CallGraph(cfg, roots)).items():
+        if e in names:
+            res.setdefault(h, (prefix+names[e], size))
+    return res
+
+#-----------------------------------------------------------------------------
+
+def main():
+    ap = argparse.ArgumentParser(description='Signatures of known routines')
+    sub = ap.add_subparsers(dest='command', required=True)
+    a = sub.add_parser('add', help='Add the functions of labelled assembler sources')
+    a.add_argument('signatures', help='Signature file, created if needed')
+    a.add_argument('sources', nargs='+', help='Assembler sources')
+    a.add_argument('-p', '--prefix', default='', help='Prefix of the signature names')
+    l = sub.add_parser('list', help='List the signatures')
+    l.add_argument('signatures', help='Signature file')
+    args = vars(ap.parse_args())
+
+    sigs = Signatures(args['signatures'])
+    signatures = {h: (name, size) for (h, name, size) in sigs.items()}
+    sigs.close()
+    if args['command'] == 'add':
+        n = len(signatures)
+        for source in args['sources']:
+            with open(source) as f:
+                for (h, s) in fromSource(f.read().splitlines(), args['prefix']).items():
+                    signatures.setdefault(h, s)
+        write(args['signatures'], signatures)
+        print(len(signatures)-n, 'signatures added,', len(signatures), 'in', args['signatures'])
+    else:
+        for (h, (name, size)) in sorted(signatures.items(), key=lambda s: s[1]):
+            print('%016x %5d %s' % (h, size, name))
+
+if __name__ == '__main__':
+    main()
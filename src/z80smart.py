@@ -0,0 +1,1125 @@
+# Z80 Smart Disassembler engine
+# by Stephane Sikora
+# Disark Documentaiton: http://julien-nevo.com/disark/
+
+#-----------------------------------------------------------------------------
+"""
+Z80 Smart Disassembler engine
+
+A Disassembler holds one 64Kb memory image and its code coverage state,
+so a long running process can analyze many images in a row:
+
+    d = Disassembler()
+    d.load('game.bin', org=0x4000)
+    d.trace([0x4000])
+    with open('game.asm', 'w') as f:
+        d.emit_asm(f)
+"""
+#-----------------------------------------------------------------------------
+
+from z80da import disassemble, decode, decodeAll, length, source, timing, info, _I_DUP, _I_UNDOC
+from z80da import FLOW_NEXT, FLOW_JUMP, FLOW_CJUMP, FLOW_CALL, FLOW_RET, FLOW_CRET, FLOW_INDIRECT, COND_NONE
+from z80platform import firmware, defaultPlatform, callTarget
+from z80asm import assemble, mismatches
+from z80cfg import CFG, CallGraph
+from z80data import classify, kindLabels, UNKNOWN, FILL, TEXT, POINTERS, COMPRESSED
+from z80emu import CPU
+from z80log import readLog
+from collections import deque, Counter
+from bisect import bisect_right
+from array import array
+import contextlib
+import re
+import sys
+import subprocess
+import time
+
+#Jump types
+JUMP, JUMP_COND, CALL, CALL_COND = range(4)
+jumpTypeNames = ('jump', 'jump cond', 'call', 'call cond')
+
+# Flow classes with a branch target
+flowWithTarget = frozenset((FLOW_JUMP, FLOW_CJUMP, FLOW_CALL))
+# Flow classes followed by the next instruction
+flowWithNext = frozenset((FLOW_NEXT, FLOW_CJUMP, FLOW_CALL, FLOW_CRET))
+# flow class => (jump type, jump type if conditional)
+flowJumpTypes = {FLOW_JUMP: (JUMP, JUMP), FLOW_CJUMP: (JUMP_COND, JUMP_COND), FLOW_CALL: (CALL, CALL_COND)}
+
+# ld r,r with the same source and destination (after an optional dd/fd prefix)
+selfLoads = frozenset((0x40, 0x49, 0x52, 0x5b, 0x64, 0x6d, 0x7f))
+# Opcodes code often repeats: inc, dec, add hl,hl, add a,a and rotations
+# of a (plus the cb shifts)
+repeatable = frozenset((0x03, 0x13, 0x23, 0x33, 0x0b, 0x1b, 0x2b, 0x3b,
+                        0x04, 0x0c, 0x14, 0x1c, 0x24, 0x2c, 0x34, 0x3c,
+                        0x05, 0x0d, 0x15, 0x1d, 0x25, 0x2d, 0x35, 0x3d,
+                        0x07, 0x0f, 0x17, 0x1f, 0x29, 0x87))
+
+def hx( v ):
+   "Converts a number to an hex string"
+   return '#'+format(v, '02x')
+
+def costText(t, n, sep='/'):
+    """
+    Text of (taken, not taken) T-states and CPC NOPs: 12/7T 3/2N, 7T 2N
+    """
+    tt = '%d' % t[0] if t[0]==t[1] else '%d%s%d' % (t[0], sep, t[1])
+    nn = '%d' % n[0] if n[0]==n[1] else '%d%s%d' % (n[0], sep, n[1])
+    return tt+'T '+nn+'N'
+
+def parseRegion(a):
+    """
+    Parse a region definition: addr1-addr2 or addr1+nbytes, in hexadecimal.
+    Return a (start, end) tuple, end excluded, or None if it is malformed.
+    """
+    if '-' in a:
+        ar = a.split('-')
+        return (int(ar[0],16), int(ar[1],16))
+    elif '+' in a:
+        ar = a.split('+')
+        start = int(ar[0],16)
+        return (start, start+int(ar[1],16))
+    return None
+
+# db operand and comment character of each byte value
+_dbHex = tuple(hx(v) for v in range(256))
+_dbChar = tuple(chr(v) if 65<=(v & 0xdf)<65+26 else '.' for v in range(256))
+# db operand text => byte value, for the notations found in assembler sources
+_dbValues = {}
+for v in range(256):
+    for f in ('#%02x', '#%02X', '#%x', '#%X', '&%02x', '&%02X', '$%02x', '$%02X', '%d'):
+        _dbValues[f % v] = v
+del v, f
+
+# Prefixes of the generated labels
+labelPrefixes = ('start_', 'lab') + kindLabels
+
+def bytesAsDB(b):
+    """
+    db directive for the bytes b, commented with the letters they contain.
+    """
+    res = 'db ' + ','.join([_dbHex[v] for v in b])
+    st = ''.join([_dbChar[v] for v in b])
+    if st.strip('.'):
+        res += ' ;'+st
+    return res
+
+# memcode byte => 1 for code, 0 for data (not reached or excluded)
+_isCode = bytes(1 if 0<v<128 else 0 for v in range(256))
+# memcode byte => 1 where an instruction can start (not reached, or instruction start)
+_canStart = bytes(1 if v in (0, 1) else 0 for v in range(256))
+_nonZero = bytes((0,)) + bytes((1,)) * 255
+# code<<1 | inside the binary => what a word points to (see z80data.classify)
+_targets = bytes((0, 1, 2, 2)) + bytes(252)
+
+def runs(mask):
+    """
+    Return the runs of zero bytes of mask, as (start, end) tuples, end excluded.
+    """
+    res = []
+    n = len(mask)
+    pos = mask.find(0)
+    while pos>=0:
+        end = mask.find(1, pos)
+        if end<0:
+            end = n
+        res.append((pos, end))
+        pos = mask.find(0, end)
+    return res
+
+def mergeRegions(reg, gap):
+    """
+    Merge the (start, end) regions separated by less than gap bytes.
+    """
+    if gap<=0 or len(reg)==0:
+        return list(reg)
+    res = [reg[0]]
+    for (start, end) in reg[1:]:
+        if start-res[-1][1]<gap:
+            res[-1] = (res[-1][0], end)
+        else:
+            res.append((start, end))
+    return res
+
+class Stats:
+    """
+    Wall time of the phases of an analysis, and counters.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager adding the time spent in its block to phase name.
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.0) + time.perf_counter()-t0
+
+    def add(self, name, v):
+        self.counters[name] = self.counters.get(name, 0) + v
+
+    def peak(self, name, v):
+        self.counters[name] = max(self.counters.get(name, 0), v)
+
+    def asdict(self):
+        return {'times': dict(self.times), 'counters': dict(self.counters)}
+
+#-----------------------------------------------------------------------------
+
+class Disassembler:
+    """
+    Memory image, code coverage and decoded instructions of one binary.
+    Everything is stored in typed arrays indexed by address, the jump
+    lists are derived from the decoded instructions.
+    """
+
+    def __init__(self, verbose=0, platform=defaultPlatform, superset=False):
+        self.verbose = verbose
+        #Trace with a superset decoding of the whole image, see superset()
+        self.useSuperset = superset
+        #Firmware entry points: adress => name
+        self.platform = platform
+        self.firmware = firmware(platform)
+        self._reset()
+        #Phase times and counters
+        self.stats = Stats()
+
+    def _reset(self):
+        """
+        Allocate the memory image and the analysis state of a new binary.
+        """
+        # Memory = 64Kb
+        self.mem = bytearray(65536)
+        # Code areas
+        # Exceptions: memcode[pc] = -1. will be ignored
+        self.memcode = array('b', [-1]) * 65536
+        # Decoded instructions: size (0 if no instruction starts here),
+        # flow class, condition code and branch target
+        self.oplen = array('B', bytes(65536))
+        self.flow = array('b', bytes(65536))
+        self.cond = array('b', bytes(65536))
+        self.target = array('H', bytes(2*65536))
+        #Jump destinations, for generating labels and dot graph
+        self.jpto = bytearray(65536)
+        #Adresses already queued for tracing
+        self.seen = bytearray(65536)
+        #Traced start adresses
+        self.starts = []
+        #Targets of the indirect jumps seen by the emulation: adress => set of targets
+        self.indirect = {}
+        #Adresses seen executed, by the emulation or in execution logs
+        self.executed = bytearray(65536)
+        #Names given to adresses (known routines): adress => name
+        self.symbols = {}
+        #Loaded file
+        self.data = b''
+        self.org = 0
+        #Data regions and control flow graph, computed on demand
+        self.invalidate()
+
+    def load(self, data, org=0):
+        """
+        Load a binary (file name or bytes) at address org, replacing the
+        image and the analysis of the binary loaded before, if any.
+        """
+        if isinstance(data, str):
+            with open(data, mode='rb') as file:
+                data = file.read()
+        end = org+len(data)
+        if org<0 or end>len(self.mem):
+            raise ValueError('Binary does not fit in memory: %s-%s' % (hx(org), hx(end)))
+        self._reset()
+        self.data = data
+        self.org = org
+        self.mem[org:end] = data
+        self.memcode[org:end] = array('b', bytes(len(data)))
+
+    def zero(self, start, end):
+        """
+        Fill mem[start:end] with zeroes.
+        """
+        end = min(end, len(self.mem))
+        if start<end:
+            self.mem[start:end] = bytes(end-start)
+            self._superset = None
+
+    def save_image(self, fileName):
+        """
+        Write the loaded part of the memory image to a binary file.
+        """
+        with open(fileName, mode='wb') as file:
+            file.write(memoryview(self.mem)[self.org:self.org+len(self.data)])
+
+    def exclude(self, adresses):
+        """
+        Mark adresses as never being code.
+        """
+        for a in adresses:
+            self.memcode[a] = -1
+        self.invalidate(memory=False)
+
+    def instructionCount(self):
+        return len(self.oplen) - self.oplen.count(0)
+
+    def codeBytes(self):
+        """
+        Number of bytes covered by code.
+        """
+        return self.memcode.tobytes().translate(_isCode).count(1)
+
+    def statistics(self):
+        """
+        Return the phase times and counters, with the coverage counters,
+        as a dictionary that can be saved as JSON.
+        """
+        res = self.stats.asdict()
+        res['counters']['instructions'] = self.instructionCount()
+        res['counters']['code_bytes'] = self.codeBytes()
+        res['counters']['data_regions'] = len(self.regions())
+        return res
+
+    def jumpType(self, pc):
+        """
+        Jump type (JUMP, JUMP_COND, CALL, CALL_COND) of the instruction at pc,
+        None if it is not a jump with a known target.
+        """
+        types = flowJumpTypes.get(self.flow[pc])
+        if self.oplen[pc]==0 or types is None:
+            return None
+        return types[self.cond[pc]!=COND_NONE]
+
+    def jumps(self):
+        """
+        Iterate over the (adrfrom, adrto, jptype) jumps, by address.
+        """
+        oplen = self.oplen
+        flow = self.flow
+        cond = self.cond
+        target = self.target
+        for pc in range(len(oplen)):
+            if oplen[pc] and flow[pc] in flowWithTarget:
+                yield (pc, target[pc], flowJumpTypes[flow[pc]][cond[pc]!=COND_NONE])
+
+    def nextPC(self, pc):
+        """
+        Adress of the instruction executed after the one at pc when no jump
+        is taken, None if there is no such instruction.
+        """
+        if self.oplen[pc] and self.flow[pc] in flowWithNext:
+            return pc + self.oplen[pc]
+        return None
+
+    def trace(self, starts, record=True):
+        """
+        Follow the code flow from the start adresses, marking code in memcode.
+        Tracing is incremental: calling it again with new start adresses only
+        explores the code that was not reached yet.
+        If record is True, the adresses are added to the start adresses.
+        Return the number of instructions decoded.
+        """
+        mem = self.mem
+        memcode = self.memcode
+        oplen = self.oplen
+        flowa = self.flow
+        conda = self.cond
+        targeta = self.target
+        jpto = self.jpto
+        seen = self.seen
+        verbose = self.verbose
+        pcstack = deque()
+        self.invalidate(memory=False)
+        useSuperset = self.useSuperset
+        if useSuperset:
+            (slen, sflow, scond, starget) = self.superset()
+        pushes = 0
+        pops = 0
+        peak = 0
+        duplicates = 0
+        indirect = 0
+        for a in starts:
+            if record and a not in self.starts:
+                self.starts.append(a)
+            if not seen[a]:
+                seen[a] = 1
+                pcstack.append(a)
+                pushes += 1
+            else:
+                duplicates += 1
+        peak = len(pcstack)
+        count = 0
+        while pcstack:
+            start_pc = pc =pcstack.popleft()
+            pops += 1
+            while True:
+                # decoder l'instruction en PC de facon simple
+                try:
+                    if useSuperset:
+                        sz = slen[pc]
+                        if sz==0:
+                            raise IndexError('instruction past the end of memory')
+                        flow = sflow[pc]
+                        target = starget[pc]
+                        cond = scond[pc]
+                    else:
+                        (sz,flow,target,cond) = decode(mem,pc)
+                        if pc+sz>len(mem):
+                            raise IndexError('instruction past the end of memory')
+                    if verbose>2:
+                        print(hx(pc),disassemble(mem,pc),hx(mem[pc]))
+                except Exception as e:
+                    print(e,pc)
+                    break;
+
+                if memcode[pc]<0:
+                    break;
+
+                if memcode[pc]>1: # and memcode[pc]!=1:
+                    print(hx(start_pc), hx(pc), 'Warning: Jumping in the middle of an instruction!' )
+                    break;
+
+                if memcode[pc]>0:
+                    break;
+
+                #Mark as code (>0)
+                for i in range(0,sz):
+                    memcode[pc+i] = 1+i
+
+                oplen[pc] = sz
+                flowa[pc] = flow
+                conda[pc] = cond
+                count += 1
+
+                m = mem[pc]
+                if m in selfLoads or (sz==2 and (m==0xdd or m==0xfd) and mem[pc+1] in selfLoads):
+                    print(hx(start_pc), hx(pc), 'Warning, unusual instruction:', *disassemble(mem,pc)[:2])
+
+                if flow==FLOW_NEXT:
+                    pc += sz
+                elif flow==FLOW_JUMP:
+                    targeta[pc] = target
+                    jpto[target] = 1
+                    pc = target
+                    start_pc = pc
+                elif flow==FLOW_CJUMP or flow==FLOW_CALL:
+                    targeta[pc] = target
+                    jpto[target] = 1
+                    # Only queue targets that are neither queued yet nor known code
+                    if not seen[target] and memcode[target]!=1:
+                        seen[target] = 1
+                        pcstack.append(target)
+                        pushes += 1
+                        if len(pcstack)>peak:
+                            peak = len(pcstack)
+                    else:
+                        duplicates += 1
+                    pc += sz
+                elif flow==FLOW_RET:
+                    break
+                elif flow==FLOW_INDIRECT:
+                    print(hx(start_pc), hx(pc), 'JP ('+disassemble(mem,pc)[1]+') encoutered')
+                    indirect += 1
+                    break;
+                else:
+                    # Conditional ret
+                    pc += sz
+        stats = self.stats
+        stats.add('instructions_decoded', count)
+        stats.add('worklist_pushes', pushes)
+        stats.add('worklist_pops', pops)
+        stats.peak('worklist_peak', peak)
+        stats.add('duplicate_targets', duplicates)
+        stats.add('indirect_jumps', indirect)
+        return count
+
+    def invalidate(self, memory=True):
+        """
+        Forget the data derived from the coverage (regions, control flow
+        graph) and, if memory is True, from the memory image (superset
+        decoding), after the arrays were changed from outside.
+        """
+        self._regions = None
+        self._segments = None
+        self._cfg = None
+        self._calls = None
+        if memory:
+            self._superset = None
+
+    def superset(self):
+        """
+        Return the (lengths, flows, conds, targets) arrays of the instructions
+        starting at every adress of the memory image (see z80da.decodeAll),
+        built once for the image.
+        """
+        if self._superset is None:
+            self._superset = decodeAll(self.mem)
+        return self._superset
+
+    def _plausible(self, a, avoid, minRun):
+        """
+        True if the code starting at adress a looks like code: traced code
+        entered from a branch or a start adress, or minRun instructions in
+        a row (fewer if a jump or a return ends them, or if they reach
+        traced code), none of them junk (an encoding no assembler gives, as
+        ED or index prefixes followed by an opcode they do not change, an
+        undocumented instruction, a register loaded with itself, or the
+        same instruction twice, unless it is a shift or an increment), in
+        undecoded bytes (not excluded, nor in an avoid segment).
+        """
+        (slen, sflow) = self.superset()[:2]
+        memcode = self.memcode
+        mem = self.mem
+        hi = self.org+len(self.data)
+        if memcode[a]==1:
+            # Not in the middle of a routine
+            return bool(self.jpto[a] or self.seen[a])
+        for i in range(minRun):
+            if a>=hi:
+                return False
+            if memcode[a]==1:
+                return True
+            n = slen[a]
+            if memcode[a] or n==0 or a+n>hi or info(mem, a) & (_I_DUP | _I_UNDOC) or any(avoid[a:a+n]) or memcode[a+1:a+n].count(0)<n-1:
+                return False
+            m = mem[a]
+            if m in selfLoads or (n==2 and m in (0xdd, 0xfd) and mem[a+1] in selfLoads):
+                return False
+            if i and mem[a-n:a]==mem[a:a+n] and not (m==0xcb or m in repeatable or (n==2 and m in (0xdd, 0xfd) and mem[a+1] in repeatable)):
+                return False
+            # rst calls a routine more often than it jumps
+            if sflow[a] in (FLOW_JUMP, FLOW_RET, FLOW_INDIRECT) and m & 0xc7!=0xc7:
+                return True
+            a += n
+        return True
+
+    def _decodable(self, a, avoid, budget=512):
+        """
+        True if the code reached from adress a, following jumps, calls and
+        fall through, decodes cleanly: no junk (see _plausible), no
+        instructions overlapping each other or traced instructions, no
+        excluded adresses or avoid segments, without running past the end
+        of the binary. Traced code and branches outside the binary
+        (firmware) end the walk, so does a budget of instructions.
+        """
+        (slen, sflow, scond, starget) = self.superset()
+        memcode = self.memcode
+        mem = self.mem
+        lo = self.org
+        hi = self.org+len(self.data)
+        reached = bytearray(65536)
+        stack = [a]
+        count = 0
+        while stack:
+            a = stack.pop()
+            if reached[a]==1 or not lo<=a<hi or memcode[a]==1:
+                continue
+            n = slen[a]
+            if reached[a] or memcode[a] or n==0 or a+n>=hi or info(mem, a) & (_I_DUP | _I_UNDOC) or any(avoid[a:a+n]) or memcode[a+1:a+n].count(0)<n-1 or any(reached[a+1:a+n]):
+                return False
+            m = mem[a]
+            if m in selfLoads or (n==2 and m in (0xdd, 0xfd) and mem[a+1] in selfLoads):
+                return False
+            reached[a] = 1
+            reached[a+1:a+n] = bytes((2,))*(n-1)
+            count += 1
+            if count>=budget:
+                return True
+            f = sflow[a]
+            if f in (FLOW_JUMP, FLOW_CJUMP, FLOW_CALL):
+                stack.append(starget[a])
+            if f in flowWithNext:
+                stack.append(a+n)
+        return True
+
+    def pointerTables(self, minWords=4, minRun=4):
+        """
+        Find the pointer tables of the data regions: runs of at least minWords
+        little-endian words (at even or odd adresses) pointing where code can
+        start: inside the loaded binary, on a complete instruction, neither
+        excluded nor in the middle of a traced instruction, nor in text,
+        fills or compressed data (see z80data), and to code that looks like
+        code (see _plausible), with at least minWords different words,
+        more than half of the words. Words whose bytes mostly go up by 1 or
+        2 from one word to the next are byte ramps (counters, prefixed
+        opcodes), not tables. The targets of a table must then decode
+        cleanly as far as their code reaches (see _decodable). Fills and
+        compressed data have no tables.
+        Return the list of (adress, words) tables.
+        """
+        lo = self.org
+        hi = self.org+len(self.data)
+        mem = self.mem
+        slen = self.superset()[0]
+        # Data segments targets cannot be in, and the spans of data tables
+        # can be in: not fills nor compressed data
+        avoid = bytearray(65536)
+        spans = []
+        for (start, end, kind) in self.dataSegments():
+            if kind in (TEXT, FILL, COMPRESSED):
+                avoid[start:end] = bytes((1,)) * (end-start)
+            if kind in (FILL, COMPRESSED):
+                continue
+            if spans and spans[-1][1]==start:
+                spans[-1] = (spans[-1][0], end)
+            else:
+                spans.append((start, end))
+        # Adresses where code can start
+        valid = (int.from_bytes(self.memcode.tobytes().translate(_canStart), 'little')
+                 & int.from_bytes(slen.translate(_nonZero), 'little')
+                 & ~int.from_bytes(avoid, 'little')
+                 & int.from_bytes(bytes(lo)+bytes((1,))*(hi-lo), 'little')).to_bytes(65536, 'little')
+        run = re.compile(b'\x01{%d,}' % minWords)
+        memcode = self.memcode
+        plausible = {}
+        decodable = {}
+        res = []
+        for (start, end) in spans:
+            for a in (start, start+1):
+                n = (end-a)//2
+                if n<minWords:
+                    continue
+                words = array('H', bytes(mem[a:a+2*n]))
+                if sys.byteorder=='big':
+                    words.byteswap()
+                flags = bytearray(map(valid.__getitem__, words))
+                for m in run.finditer(flags):
+                    for i in range(m.start(), m.end()):
+                        w = words[i]
+                        if w not in plausible:
+                            plausible[w] = self._plausible(w, avoid, minRun)
+                        flags[i] = plausible[w]
+                for m in run.finditer(flags):
+                    table = words[m.start():m.end()].tolist()
+                    # Rows of repeated bytes are not tables
+                    if len(set(table))<max(minWords, len(table)//2+1):
+                        continue
+                    (step, n) = Counter([(v-u) & 0xffff for (u, v) in zip(table, table[1:])]).most_common(1)[0]
+                    if 2*n>len(table)-1 and step & 0xff<=2 and step>>8<=2:
+                        continue
+                    for w in table:
+                        if w not in decodable:
+                            decodable[w] = memcode[w]==1 or self._decodable(w, avoid)
+                    if all(decodable[w] for w in table):
+                        res.append((a+2*m.start(), table))
+        return res
+
+    def scanPointers(self, minWords=4, maxRounds=16):
+        """
+        Trace the targets of the pointer tables of the data regions, until
+        no new table is found (tracing changes the data regions).
+        The targets are not added to the start adresses.
+        Return the list of traced targets.
+        """
+        memcode = self.memcode
+        seen = self.seen
+        res = []
+        for i in range(maxRounds):
+            new = set()
+            for (a, words) in self.pointerTables(minWords):
+                new.update(w for w in words if memcode[w]==0 and not seen[w])
+            if not new:
+                break
+            new = sorted(new)
+            if self.verbose>0:
+                print('Pointer tables: tracing', len(new), 'targets')
+            self.trace(new, record=False)
+            res += new
+        self.stats.add('pointer_targets', len(res))
+        return res
+
+    def emulate(self, starts, limit=1000000):
+        """
+        Run the code from the start adresses on an emulated Z80 (see z80emu),
+        at most limit instructions from each one, with the firmware entry
+        points returning at once. Then trace from the executed instructions
+        the tracer did not reach, except those the program changed before
+        running them. The targets of the indirect jumps are kept in indirect.
+        Return the list of the executed adresses that were traced.
+        """
+        lo = self.org
+        hi = self.org+len(self.data)
+        cpu = CPU(self.mem, lo, hi, self.firmware)
+        count = 0
+        for a in starts:
+            (pc, n) = cpu.run(a, limit)
+            count += n
+            if self.verbose>0:
+                print('Emulation from', hx(a)+':', n, 'instructions, stopped at', hx(pc))
+        targets = 0
+        for (pc, t) in cpu.indirect.items():
+            self.indirect.setdefault(pc, set()).update(t)
+            targets += len(t)
+            for a in t:
+                self.jpto[a] = 1
+        # Bytes of the binary changed by the program
+        x = int.from_bytes(cpu.mem[lo:hi], 'little') ^ int.from_bytes(self.mem[lo:hi], 'little')
+        changed = x.to_bytes(hi-lo, 'little').translate(_nonZero)
+        slen = self.superset()[0]
+        memcode = self.memcode
+        executed = cpu.executed
+        res = []
+        overlaps = 0
+        pc = executed.find(1, lo, hi)
+        while pc>=0:
+            if memcode[pc]==0 and slen[pc] and changed.find(1, pc-lo, pc-lo+slen[pc])<0:
+                res.append(pc)
+                self.executed[pc] = 1
+            elif memcode[pc]>1:
+                overlaps += 1
+            pc = executed.find(1, pc+1, hi)
+        if overlaps:
+            print('Warning: emulation ran', overlaps, 'instructions in the middle of traced ones')
+        if self.verbose>0:
+            print('Emulation: tracing', len(res), 'new instructions')
+        self.trace(res, record=False)
+        stats = self.stats
+        stats.add('emulated_instructions', count)
+        stats.add('emulated_code', len(res))
+        stats.add('indirect_targets', targets)
+        return res
+
+    def importLog(self, fileName, fmt='auto'):
+        """
+        Read an emulator execution log (see z80log) and trace from the
+        executed adresses of the loaded binary, as confirmed code.
+        Return the number of executed adresses in the binary.
+        """
+        (executed, size) = readLog(fileName, fmt, self.executed)
+        lo = self.org
+        hi = self.org+len(self.data)
+        pcs = []
+        pc = executed.find(1, lo, hi)
+        while pc>=0:
+            pcs.append(pc)
+            pc = executed.find(1, pc+1, hi)
+        if self.verbose>0:
+            print('Execution log', fileName+':', size, 'bytes,', len(pcs), 'adresses in the binary')
+        self.trace(pcs, record=False)
+        self.stats.add('log_bytes', size)
+        self.stats.add('log_adresses', len(pcs))
+        return len(pcs)
+
+    def regions(self):
+        """
+        Return the data regions as a list of (start, end) tuples, end excluded.
+        The list is computed once from the coverage and shared by all the
+        outputs, until the coverage changes.
+        """
+        if self._regions is None:
+            self._regions = runs(self.memcode.tobytes().translate(_isCode))
+        return self._regions
+
+    def dataSegments(self):
+        """
+        Return the data regions inside the loaded binary split by kind
+        (see z80data), as a list of (start, end, kind) tuples, end excluded.
+        """
+        if self._segments is None:
+            lo = self.org
+            hi = self.org+len(self.data)
+            # What a word can point to: 2 code, 1 inside the binary, 0 outside
+            code = int.from_bytes(self.memcode.tobytes().translate(_isCode), 'little')
+            code &= int.from_bytes(bytes(self.oplen).translate(_nonZero), 'little')
+            inside = int.from_bytes(bytes(lo) + bytes((1,))*(hi-lo), 'little')
+            targets = ((code<<1) | inside).to_bytes(65536, 'little').translate(_targets)
+            self._segments = []
+            for (start, end) in self.regions():
+                if start<hi and end>lo:
+                    self._segments += classify(self.mem, max(start, lo), min(end, hi), targets)
+        return self._segments
+
+    def emit_regions(self, symfile, merge=0):
+        """
+        Write a region file (disark symbol file) with start labels, data
+        segment labels (named after their kind) and data regions.
+        Data regions separated by less than merge bytes of code are written
+        as one region.
+        """
+        lines = []
+        for a in self.starts:
+            lines.append('start_%X #%x\n' % (a, a))
+        for (a, name) in sorted(self.symbols.items()):
+            lines.append('%s #%x\n' % (name, a))
+
+        reg = mergeRegions(self.regions(), merge)
+        last = None
+        if len(reg)>0 and reg[-1][1]==len(self.memcode):
+            last = reg.pop()
+        for (start, end, kind) in self.dataSegments():
+            lines.append('%s%04X #%02x\n' % (kindLabels[kind], start, start))
+        for (start, end) in reg:
+            lines.append('DisarkByteRegionStart#%02x #%02x\nDisarkByteRegionEnd#%02x #%02x\n' % (start, start, start, end))
+        if last is not None:
+            lines.append('DisarkByteRegionStartLast #%02x\nDisarkByteRegionEndLast #%02x\n' % (last[0], last[1]-1))
+        symfile.write(''.join(lines))
+
+    def labels(self):
+        """
+        Return the {adress: label} dictionary of the loaded binary: start
+        adresses, jump and call targets, code adresses found in pointer tables,
+        and beginnings of data segments, named after their kind. Adresses
+        with a symbol get its name.
+        """
+        lo = self.org
+        hi = self.org+len(self.data)
+        memcode = self.memcode
+        oplen = self.oplen
+        jpto = self.jpto
+        res = {}
+        mem = self.mem
+        targets = bytearray(jpto)
+        for (start, end, kind) in self.dataSegments():
+            res[start] = kindLabels[kind]+format(start,'04X')
+            if kind==POINTERS:
+                for i in range(start, end-1, 2):
+                    targets[mem[i] + 256*mem[i+1]] = 1
+        for a in range(lo, hi):
+            if targets[a] and memcode[a]>0 and oplen[a]>0:
+                res[a] = 'lab'+format(a,'04X')
+        for a in self.starts:
+            if lo<=a<hi:
+                res[a] = 'start_'+format(a,'X')
+        for (a, name) in self.symbols.items():
+            if lo<=a<hi:
+                res[a] = name
+        return res
+
+    def _dataLines(self, start, end, kind, labels):
+        """
+        Generator of the directives for the data bytes mem[start:end], all
+        of one kind (see z80data): strings, ds for fills, dw for pointers
+        (with their labels), db lines of 8 bytes otherwise.
+        """
+        mem = self.mem
+        if kind==TEXT:
+            # A last character with bit 7 set is written as a number
+            last = end-1 if mem[end-1]>=128 else end
+            line = '  db "'+mem[start:last].decode('ascii')+'"'
+            if last<end:
+                line += ','+hx(mem[last])
+            yield line+'\n'
+            return
+        if kind==FILL:
+            yield '  ds %d,%s\n' % (end-start, hx(mem[start]))
+            return
+        i = start
+        if kind==POINTERS:
+            for i in range(start, end-1, 8):
+                words = []
+                for j in range(i, min(i+8, end-1), 2):
+                    w = mem[j] + 256*mem[j+1]
+                    words.append(labels.get(w) or '#%04x' % w)
+                yield '  dw '+','.join(words)+'\n'
+            i = start+(end-start)//2*2
+        for i in range(i, end, 8):
+            yield '  '+bytesAsDB(mem[i:min(i+8, end)])+'\n'
+
+    def asmLines(self, undocumented=True, cycles=False):
+        """
+        Generator of the lines of an assembler source (rasm syntax) of the
+        loaded binary, with labels, grouped data and firmware comments.
+        Overlapping instructions, instructions with a label inside them
+        and encodings an assembler would not give back are written as db.
+        If undocumented is False, undocumented instructions are also
+        written as db. If cycles is True, instructions get their T-states
+        and CPC NOPs in a comment, basic blocks a comment line with their
+        cost and loop heads the cost of an iteration.
+        """
+        mem = self.mem
+        memcode = self.memcode
+        oplen = self.oplen
+        flow = self.flow
+        target = self.target
+        firmware = self.firmware
+        indirect = self.indirect
+        labels = self.labels()
+        bounds = sorted(labels)
+        segments = self.dataSegments()
+        segStarts = [seg[0] for seg in segments]
+        reg = self.regions()
+        regStarts = [r[0] for r in reg]
+        hi = self.org+len(self.data)
+        k = 0
+        blocks = self.cfg().blocks if cycles else {}
+        loops = {loop.head: loop for loop in self.cfg().loops(self.starts)} if cycles else {}
+
+        yield '  org '+hx(self.org)+'\n'
+        i = self.org
+        while i<hi:
+            name = labels.get(i)
+            if name is not None:
+                yield name+':\n'
+            # Next label after i
+            while k<len(bounds) and bounds[k]<=i:
+                k += 1
+            nxt = bounds[k] if k<len(bounds) else hi
+            sz = oplen[i] if memcode[i]>0 else 0
+            src = None
+            if sz>0 and i+sz<=nxt:
+                src = source(mem, i, labels, undocumented)
+            if src is not None:
+                b = blocks.get(i)
+                if b is not None:
+                    yield '  ; block: %d instructions, %s\n' % (b.count, costText(b.time, b.nops))
+                    if i in loops:
+                        loop = loops[i]
+                        yield '  ; loop: %s per iteration\n' % costText(loop.time, loop.nops, '-')
+                line = '  '+src[0]
+                if src[1]:
+                    line += ' '+src[1]
+                if cycles:
+                    line += ' ; '+costText(*timing(mem, i))
+                if flow[i] in flowWithTarget:
+                    name = firmware.get(target[i])
+                    if name is not None:
+                        line += ' ; Call to firmware: '+name
+                elif flow[i]==FLOW_INDIRECT and i in indirect:
+                    line += ' ; Jumps to: '+' '.join(labels.get(a) or hx(a) for a in sorted(indirect[i]))
+                yield line+'\n'
+                i += sz
+            else:
+                # Data up to the next instruction or label
+                j = i+max(sz, 1)
+                while j<nxt and not (memcode[j]>0 and oplen[j]>0):
+                    if memcode[j]>0:
+                        j += 1
+                    else:
+                        # Skip the whole data region
+                        j = reg[bisect_right(regStarts, j)-1][1]
+                j = min(j, nxt)
+                kind = UNKNOWN
+                n = bisect_right(segStarts, i)-1
+                if n>=0 and segments[n][0]<=i<segments[n][1]:
+                    kind = segments[n][2]
+                yield from self._dataLines(i, j, kind, labels)
+                i = j
+
+    def emit_asm(self, asmfile, undocumented=True, chunk=4096, cycles=False):
+        """
+        Write the assembler source of the loaded binary, by chunks of lines.
+        """
+        buf = []
+        for line in self.asmLines(undocumented, cycles):
+            buf.append(line)
+            if len(buf)>=chunk:
+                asmfile.write(''.join(buf))
+                buf.clear()
+        asmfile.write(''.join(buf))
+
+    def run_disark(self, binfilename, tmpfilename, symfilename, path='Disark', undocumentedOpcodes=True):
+        """
+        Disassemble binfilename with Disark, using symfilename for the regions.
+        """
+        print('Now running disark...', path, tmpfilename, symfilename)
+        options = [path, binfilename, tmpfilename, "--loadAddress", str(self.org) , "--genLabels", "--src8bitsValuesInHex", "--src16bitsValuesInHex", "--symbolFile",symfilename]
+        if undocumentedOpcodes==False:
+            options.append("--undocumentedOpcodesToBytes")
+
+        print(options)
+        res = subprocess.run(options)
+        print(res)
+        return res
+
+    def _labelAdress(self, label):
+        """
+        Adress encoded in a generated label (start_XXXX, labXXXX, dataXXXX...),
+        if it is inside the loaded binary.
+        """
+        for prefix in labelPrefixes:
+            if label.startswith(prefix):
+                try:
+                    a = int(label[len(prefix):], 16)
+                except ValueError:
+                    return None
+                break
+        else:
+            return None
+        if self.org <= a < self.org+len(self.data):
+            return a
+        return None
+
+    def disarkLines(self, lines):
+        """
+        Generator turning Disark output lines into the final asm lines.
+        Consecutive db lines are grouped 8 by 8, from the bytes in mem: the
+        adress of each line is followed from the labels and instruction sizes,
+        and the value written by Disark is only used to check it.
+        """
+        mem = self.mem
+        memcode = self.memcode
+        oplen = self.oplen
+        firmware = self.firmware
+        adr = self.org
+        dbl = bytearray()
+        drift = False
+
+        #TODO: handle dw
+        for l in lines:
+            ll=l.strip()
+            # starts by a label?
+            if ll.startswith(labelPrefixes):
+                if dbl:
+                    yield '  '+bytesAsDB(dbl)+'\n'
+                    dbl.clear()
+                spl = ll.split(' ')
+                yield spl[0]+':\n'
+                ll = ll[len(spl[0])+1:]
+                a = self._labelAdress(spl[0])
+                if a is not None and not ll.startswith('equ'):
+                    adr = a
+
+            if ll.startswith('db'):
+                v = mem[adr & 0xffff]
+                t = _dbValues.get(ll[3:].split(';')[0].strip())
+                if t is not None and t != v:
+                    if not drift:
+                        print('Warning: Disark output does not match memory at', hx(adr))
+                        drift = True
+                    v = t
+                dbl.append(v)
+                adr += 1
+                if len(dbl)==8:
+                    yield '  '+bytesAsDB(dbl)+'\n'
+                    dbl.clear()
+            else:
+                if dbl:
+                    yield '  '+bytesAsDB(dbl)+'\n'
+                    dbl.clear()
+                if ll=='' or ll.startswith((';', 'org', 'equ')):
+                    yield '  '+ll+'\n'
+                    continue
+                # Add comments
+                comment=''
+                if ll.startswith('call'):
+                    name = firmware.get(callTarget(ll))
+                    if name is not None:
+                        comment=' ; Call to firmware: '+name
+                yield '  '+ll+comment+'\n'
+                a = adr & 0xffff
+                if memcode[a]>0 and oplen[a]>0:
+                    adr += oplen[a]
+                else:
+                    try:
+                        adr += length(mem, a)
+                    except IndexError:
+                        adr += 1
+        if dbl:
+            yield '  '+bytesAsDB(dbl)+'\n'
+
+    def postprocess_disark(self, tmpfilename, asmfile, chunk=4096):
+        """
+        Group the db lines of a Disark output and add firmware comments,
+        streaming the file and writing the result by chunks of lines.
+        """
+        with open(tmpfilename, mode='rt') as file:
+            buf = []
+            for line in self.disarkLines(file):
+                buf.append(line)
+                if len(buf)>=chunk:
+                    asmfile.write(''.join(buf))
+                    buf.clear()
+            asmfile.write(''.join(buf))
+
+    def compare(self, start, data):
+        """
+        Compare bytes assembled at adress start with the loaded binary.
+        Return the list of mismatching (start, end) adress ranges, end excluded.
+        """
+        res = []
+        if start != self.org:
+            print('Warning! Start adress not matching', hx(self.org), hx(start))
+        if len(data) != len(self.data):
+            print('Warning! File Length not matching', len(self.data), len(data))
+        for (s, e) in mismatches(self.data, data):
+            res.append((s+self.org, e+self.org))
+        return res
+
+    def verify(self, undocumented=True):
+        """
+        Assemble the source written by emit_asm in memory and compare it
+        with the loaded binary. Return the mismatching adress ranges.
+        """
+        (start, data) = assemble(self.asmLines(undocumented))
+        return self.compare(start, data)
+
+    def check(self, outasm):
+        """
+        Assemble the source file outasm and compare it with the loaded binary.
+        Print and return the mismatching adress ranges.
+        """
+        print('- assembling', outasm)
+        with open(outasm) as f:
+            (start, data) = assemble(f)
+        print('- comparing')
+        res = self.compare(start, data)
+        for (s, e) in res:
+            print(hx(s)+'-'+hx(e-1), 'Not Matching!', e-s, 'bytes')
+        if not res:
+            print('Reassembled binary matches')
+        return res
+
+    def cfg(self):
+        """
+        Return the basic-block control flow graph (z80cfg.CFG), built once
+        after tracing.
+        """
+        if self._cfg is None:
+            self._cfg = CFG(self)
+        return self._cfg
+
+    def callGraph(self):
+        """
+        Return the function call graph (z80cfg.CallGraph).
+        """
+        if self._calls is None:
+            self._calls = CallGraph(self.cfg(), self.starts)
+        return self._calls
+
+    def _nodeNames(self):
+        names = dict(self.firmware)
+        names.update(self.labels())
+        return names
+
+    def emit_dot(self, dotfile):
+        """
+        Write a dot (graphviz) graph of the basic blocks, with all calls & jps.
+        """
+        self.cfg().write_dot(dotfile, self._nodeNames())
+
+    def emit_json(self, jsonfile):
+        """
+        Write the basic blocks and their edges as JSON.
+        """
+        self.cfg().write_json(jsonfile)
+
+    def emit_graphml(self, graphfile):
+        """
+        Write a GraphML graph of the basic blocks.
+        """
+        self.cfg().write_graphml(graphfile, self._nodeNames())
+
+    def emit_loops(self, loopfile):
+        """
+        Write the loops of the control flow graph, most expensive first.
+        """
+        self.cfg().write_loops(loopfile, self._nodeNames(), self.starts)
+
+    def emit_callgraph(self, dotfile, cluster=0, root=None, depth=None, maxNodes=None):
+        """
+        Write a dot (graphviz) graph of the functions and their calls.
+        cluster: size of the adress ranges functions are grouped by (0: none).
+        root: only keep the functions at most depth calls away from root,
+        at most maxNodes of them.
+        """
+        cg = self.callGraph()
+        nodes = None
+        if root is not None:
+            nodes = cg.around(root, depth, maxNodes)
+        elif maxNodes is not None:
+            # Biggest functions
+            nodes = set(sorted(cg.functions, key=lambda a: -cg.functions[a].count)[:maxNodes])
+        cg.write_dot(dotfile, self._nodeNames(), cluster, nodes)
@@ -0,0 +1,121 @@
+#-----------------------------------------------------------------------------
+"""
+Persistent analysis state
+
+The state of a Disassembler (memory image, code coverage, decoded
+instructions, queued adresses and start adresses) is saved in a compact
+binary file made of typed arrays indexed by address, at fixed offsets, so
+it can be read back instead of tracing the binary again.
+
+The state is keyed by the SHA-256 of the input binary and of the analysis
+options (org, zeroed regions, excluded adresses...): a state file built
+from another binary or with other options is detected as stale and ignored.
+The sections are the Disassembler arrays themselves: saving writes them
+and reloading reads each section straight into the array of the same type
+the Disassembler allocated, one read per array. Arrays are stored in
+native byte order.
+"""
+#-----------------------------------------------------------------------------
+
+from array import array
+import hashlib
+import struct
+import os
+
+_MAGIC = b'Z80STAT2'
+# magic, binary sha256, options sha256, org, size, number of start adresses
+_HEADER = struct.Struct('<8s32s32sHII')
+_HEADER_SIZE = 128
+
+# Sections, indexed by address: (Disassembler attribute, array type code)
+_SECTIONS = (
+    ('mem', 'B'),      # memory image
+    ('memcode', 'b'),  # code coverage
+    ('oplen', 'B'),    # size of the instruction starting here, 0 if none
+    ('flow', 'b'),     # flow class
+    ('cond', 'b'),     # condition code
+    ('target', 'H'),   # branch target
+    ('jpto', 'B'),     # jump destinations
+    ('seen', 'B'),     # adresses queued for tracing
+)
+
+def _layout():
+    offsets = {}
+    pos = _HEADER_SIZE
+    for (name, tc) in _SECTIONS:
+        offsets[name] = pos
+        pos += 65536 * array(tc).itemsize
+    offsets['starts'] = pos
+    return offsets
+
+_offsets = _layout()
+
+#-----------------------------------------------------------------------------
+
+def _digests(data, options):
+    return (hashlib.sha256(data).digest(), hashlib.sha256(repr(options).encode()).digest())
+
+def save(d, fileName, options):
+    """
+    Save the analysis state of Disassembler d.
+    options: the analysis options the state depends on (any repr-able value).
+    """
+    (hbin, hopt) = _digests(d.data, options)
+    with open(fileName, mode='wb') as file:
+        file.write(_HEADER.pack(_MAGIC, hbin, hopt, d.org, len(d.data), len(d.starts)).ljust(_HEADER_SIZE, b'\0'))
+        for (name, tc) in _SECTIONS:
+            file.write(getattr(d, name))
+        file.write(array('H', d.starts))
+
+def check(fileName, data, options, starts=None):
+    """
+    Return None if the state file matches the binary data and the options,
+    or the reason why it is stale.
+    If starts is given, the saved start adresses must all be part of it:
+    new start adresses can be traced incrementally, removed ones cannot.
+    """
+    try:
+        with open(fileName, mode='rb') as file:
+            header = file.read(_HEADER.size)
+            if len(header) < _HEADER.size or header[:len(_MAGIC)] != _MAGIC:
+                return 'not a state file'
+            (magic, hbin, hopt, org, size, nstarts) = _HEADER.unpack(header)
+            file.seek(_offsets['starts'])
+            saved = array('H')
+            saved.frombytes(file.read(2 * nstarts))
+            if os.fstat(file.fileno()).st_size != _offsets['starts'] + 2 * nstarts:
+                return 'truncated state file'
+    except FileNotFoundError:
+        return 'no state file yet'
+    except OSError as e:
+        return str(e)
+    (cbin, copt) = _digests(data, options)
+    if hbin != cbin:
+        return 'binary changed'
+    if hopt != copt:
+        return 'options changed'
+    if starts is not None and not set(saved) <= set(starts):
+        return 'start adresses removed'
+    return None
+
+def load(d, fileName, options, starts=None):
+    """
+    Restore the analysis state into Disassembler d, on which the binary has
+    already been loaded. Return None on success, or the reason why the state
+    file could not be used (see check()), in which case d is left untouched.
+    """
+    reason = check(fileName, d.data, options, starts)
+    if reason is not None:
+        return reason
+    with open(fileName, mode='rb') as file:
+        (magic, hbin, hopt, org, size, nstarts) = _HEADER.unpack(file.read(_HEADER.size))
+        d.org = org
+        for (name, tc) in _SECTIONS:
+            file.seek(_offsets[name])
+            file.readinto(getattr(d, name))
+        file.seek(_offsets['starts'])
+        starts = array('H')
+        starts.frombytes(file.read(2 * nstarts))
+    d.starts = starts.tolist()
+    d.invalidate()
+    return None
@@ -0,0 +1,49 @@
+"""
+Assembler tests: every instruction the disassembler writes as source
+assembles back to its bytes, and so does the source of the benchmark
+images.
+"""
+import contextlib
+import io
+import random
+
+import pytest
+
+from z80asm import assemble, mismatches
+from z80da import source, length
+from z80smart import Disassembler
+import z80bench
+
+def test_instructions():
+    rnd = random.Random(1)
+    for i in range(20000):
+        mem = bytearray(rnd.getrandbits(8) for j in range(4)) + bytes(4)
+        s = source(mem, 0)
+        if s is None:
+            continue
+        (org, data) = assemble(['  org 0', '  '+s[0]+' '+s[1]])
+        assert data == bytes(mem[:length(mem, 0)]), s
+
+def test_labels():
+    symbols = {}
+    code = set()
+    (org, data) = assemble(['  org #4000', 'start:', '  ld b,3', 'loop:', '  djnz loop',
+                            '  jp start', 'text:', '  db "ab",#80'], symbols, code)
+    assert org == 0x4000
+    assert data == b'\x06\x03\x10\xfe\xc3\x00\x40ab\x80'
+    assert symbols == {'start': 0x4000, 'loop': 0x4002, 'text': 0x4007}
+    assert code == {0x4000, 0x4002, 0x4004}
+
+def test_mismatches():
+    assert mismatches(b'abcdef', b'abcdef') == []
+    assert mismatches(b'abcdef', b'abXdeY') == [(2, 3), (5, 6)]
+    assert mismatches(b'abcdef', b'abcd') == [(4, 6)]
+
+@pytest.mark.parametrize('name', sorted(z80bench.corpus()))
+def test_round_trip(name):
+    (org, image, starts) = z80bench.corpus()[name]
+    d = Disassembler(platform='none')
+    d.load(image, org)
+    with contextlib.redirect_stdout(io.StringIO()):
+        d.trace(starts)
+    assert d.verify() == []
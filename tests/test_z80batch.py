@@ -0,0 +1,51 @@
+"""
+Batch mode tests: manifest parsing and failure isolation.
+"""
+import os
+
+import z80batch
+import z80bench
+
+def test_bad_manifest_line(tmp_path, capsys):
+    manifest = tmp_path / 'games.txt'
+    manifest.write_text('# file options\n'
+                        'game.bin -O 4000 -a 4000 4003\n'
+                        'bad.bin -O\n'
+                        'other.bin --unknown 1\n'
+                        'quote.bin -a "4000\n'
+                        '\n'
+                        'loader.bin -O 170 -z 200+40\n')
+    jobs = z80batch.readManifest(str(manifest))
+    assert [os.path.basename(j['input_file']) for j in jobs] == ['game.bin', 'loader.bin']
+    assert jobs[0]['start_adresses'] == ['4000', '4003']
+    assert jobs[1]['zero'] == ['200+40']
+    out = capsys.readouterr().out
+    for n in (3, 4, 5):
+        assert 'line %d skipped' % n in out
+
+class _Crash:
+    """
+    Kills the worker process unpickling it.
+    """
+    def __reduce__(self):
+        return (os._exit, (3,))
+
+def _job(fileName, **kw):
+    job = {'input_file': fileName, 'org': '4000', 'start_adresses': None, 'exclude_adresses': None,
+           'zero': None, 'platform': 'none', 'scan_pointers': False, 'emulate': False, 'signatures': None}
+    job.update(kw)
+    return job
+
+def test_failures_are_isolated(tmp_path):
+    (org, image, routines) = z80bench.corpus()['code']
+    binary = tmp_path / 'code.bin'
+    binary.write_bytes(image)
+    jobs = [_job(str(binary)), _job(str(tmp_path / 'missing.bin')),
+            _job(str(binary), crash=_Crash()), _job(str(binary), start_adresses=['%x' % a for a in routines])]
+    results = z80batch.run(jobs, str(tmp_path / 'out'), 2)
+    assert [r['file'] for r in results] == [j['input_file'] for j in jobs]
+    assert results[0]['error'] == '' and results[0]['code'] > 0
+    assert results[1]['error'].startswith('FileNotFoundError')
+    # The job killing its worker fails alone
+    assert results[2]['error'].startswith('BrokenProcessPool')
+    assert results[3]['error'] == '' and results[3]['code'] > results[0]['code']
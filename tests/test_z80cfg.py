@@ -0,0 +1,96 @@
+"""
+Control flow graph and call graph tests.
+"""
+import contextlib
+import io
+import xml.etree.ElementTree as ET
+
+from z80cfg import EDGE_JUMP, EDGE_JUMP_COND, EDGE_CALL, EDGE_NEXT, edgeKinds
+from z80smart import Disassembler
+
+# #4000 call #4008 / jr z,#4006 / nop / #4006 jr #4006 / #4008 ret
+_program = bytes.fromhex('cd0840' '2801' '00' '18fe' 'c9')
+
+def _traced(image=_program, starts=(0x4000,)):
+    d = Disassembler(platform='none')
+    d.load(image, 0x4000)
+    with contextlib.redirect_stdout(io.StringIO()):
+        d.trace(list(starts))
+    return d
+
+def test_blocks_and_edges():
+    cfg = _traced().cfg()
+    assert sorted((b.start, b.end, b.count) for b in cfg.blocks.values()) == [
+        (0x4000, 0x4003, 1), (0x4003, 0x4005, 1), (0x4005, 0x4006, 1), (0x4006, 0x4008, 1), (0x4008, 0x4009, 1)]
+    assert sorted(cfg.edges()) == [
+        (0x4000, 0x4003, EDGE_NEXT), (0x4000, 0x4008, EDGE_CALL),
+        (0x4003, 0x4005, EDGE_NEXT), (0x4003, 0x4006, EDGE_JUMP_COND),
+        (0x4005, 0x4006, EDGE_NEXT), (0x4006, 0x4006, EDGE_JUMP)]
+    assert sorted(cfg.blocks[0x4006].pred) == [(0x4003, EDGE_JUMP_COND), (0x4005, EDGE_NEXT), (0x4006, EDGE_JUMP)]
+
+def test_graphml_is_valid_xml():
+    cfg = _traced().cfg()
+    f = io.StringIO()
+    cfg.write_graphml(f, {0x4000: 'a<b & "c"', 0x4008: "d>'e'"})
+    ns = {'g': 'http://graphml.graphdrawing.org/xmlns'}
+    graph = ET.fromstring(f.getvalue().encode()).find('g:graph', ns)
+    labels = {n.get('id'): n.find('g:data[@key="label"]', ns).text for n in graph.findall('g:node', ns)}
+    assert labels == {'n4000': 'a<b & "c"', 'n4003': '#4003', 'n4005': '#4005', 'n4006': '#4006', 'n4008': "d>'e'"}
+    edges = sorted((e.get('source'), e.get('target'), e.find('g:data', ns).text) for e in graph.findall('g:edge', ns))
+    assert edges == sorted(('n%04x' % a, 'n%04x' % b, edgeKinds[k]) for (a, b, k) in cfg.edges())
+
+def test_call_graph():
+    # #4000 call #4009 / call #4009 / jp #400d, #4009 call #bb5a / ret, #400d ret
+    d = _traced(bytes.fromhex('cd0940' 'cd0940' 'c30d40' 'cd5abb' 'c9' 'c9'))
+    calls = d.callGraph()
+    # The jump to #400d is not a call: #400d is not an entry
+    assert sorted(calls.functions) == [0x4000, 0x4009, 0xbb5a]
+    assert sorted(calls.edges()) == [(0x4000, 0x4009, 2), (0x4009, 0xbb5a, 1)]
+    assert calls.functions[0x4000].count == 4
+    assert calls.functions[0xbb5a].blocks == []
+    assert calls.around(0x4000, depth=1) == {0x4000, 0x4009}
+    assert calls.around(0xbb5a) == {0x4000, 0x4009, 0xbb5a}
+    assert len(calls.around(0x4000, maxNodes=2)) == 2
+    f = io.StringIO()
+    calls.write_dot(f, {0xbb5a: 'TXT_OUTPUT'})
+    assert 'f4000 -> f4009 [label="2";penwidth=2];\n' in f.getvalue()
+    assert 'f4009 -> fbb5a;\n' in f.getvalue()
+    assert 'fbb5a [label="TXT_OUTPUT";shape=box];\n' in f.getvalue()
+    f = io.StringIO()
+    calls.write_dot(f, cluster=0x1000, nodes={0x4000, 0x4009})
+    assert 'subgraph cluster_4 {\nlabel="#4000-#4fff";\n' in f.getvalue()
+    assert 'fbb5a' not in f.getvalue()
+
+def test_tail_call():
+    # A jump to another function entry counts as a call
+    # #4000 call #4006 / jp #4006, #4006 ret
+    calls = _traced(bytes.fromhex('cd0640' 'c30640' 'c9')).callGraph()
+    assert list(calls.edges()) == [(0x4000, 0x4006, 2)]
+
+def test_loops():
+    # #4000 ld b,10 / #4002 ld c,5 / #4004 dec c / jr nz,#4004 / djnz #4002 / ret
+    d = _traced(bytes.fromhex('060a' '0e05' '0d' '20fd' '10f9' 'c9'))
+    loops = d.cfg().loops(d.starts)
+    assert [loop.head for loop in loops] == [0x4002, 0x4004]
+    (outer, inner) = loops
+    # dec c / jr nz taken
+    assert (inner.time, inner.nops, inner.count, inner.inner) == ((16, 16), (4, 4), 2, True)
+    assert inner.tails == [0x4004]
+    # ld c,5, the inner loop left once, djnz taken
+    assert (outer.time, outer.nops, outer.count, outer.inner) == ((31, 31), (9, 9), 4, False)
+    assert outer.blocks == {0x4002, 0x4004, 0x4007}
+    f = io.StringIO()
+    d.cfg().write_loops(f, {0x4002: 'outer'}, d.starts)
+    assert f.getvalue().splitlines()[2].split() == ['outer', '3', '4', '0', '31', '9', '#4007']
+
+def test_loop_cost_range():
+    # #4000 loop: bit 0,a / jr z,#4006 / inc a / #4006 djnz #4000 / ret
+    d = _traced(bytes.fromhex('cb47' '2801' '3c' '10f9' 'c9'))
+    (loop,) = d.cfg().loops(d.starts)
+    # jr z taken: 8+12+13, not taken: 8+7+4+13
+    assert (loop.time, loop.nops) == ((32, 33), (9, 9))
+    f = io.StringIO()
+    d.emit_asm(f, cycles=True)
+    asm = f.getvalue()
+    assert '  ; loop: 32-33T 9N per iteration\n  bit 0,a ; 8T 2N\n' in asm
+    assert '  djnz start_4000 ; 13/8T 4/3N\n' in asm
@@ -0,0 +1,95 @@
+"""
+Decoder tests: every prefix and opcode against the output of the original
+decoder (the one of py_z80 the project started from), saved in
+data/z80da_baseline.txt.gz. To write it again from that decoder:
+
+    PYTHONPATH=src python3 tests/test_z80da.py path/to/original/z80da.py
+"""
+import gzip
+import os
+import random
+
+from z80da import disassemble, decode, decodeAll, length, masked, timing
+
+_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'z80da_baseline.txt.gz')
+_PC = 0x1234
+
+def cases():
+    """
+    Instruction bytes: every opcode of every prefix group with operands
+    at the limits of their range, every DDCB/FDCB opcode and displacement
+    class, and random bytes.
+    """
+    operands = ((0, 0, 0), (0x80, 0x12, 0x34), (0x7f, 0xff, 0xfe), (0xff, 0x80, 0x01))
+    for p in ((), (0xcb,), (0xed,), (0xdd,), (0xfd,)):
+        for m in range(256):
+            for t in operands:
+                yield bytes(p + (m,) + t)
+    for p in (0xdd, 0xfd):
+        for d in (0, 0x7f, 0x80, 0xff):
+            for m in range(256):
+                yield bytes((p, 0xcb, d, m))
+    rnd = random.Random(5)
+    for i in range(4000):
+        yield bytes(rnd.getrandbits(8) for j in range(4))
+
+def _mem(b):
+    mem = bytearray(65536)
+    mem[_PC:_PC+len(b)] = b
+    return mem
+
+def _line(b, res):
+    return '%s %s|%s|%d' % (b.hex(), res[0], res[1], res[2])
+
+def test_disassemble_baseline():
+    with gzip.open(_baseline, 'rt') as f:
+        expected = f.read().splitlines()
+    got = [_line(b, disassemble(_mem(b), _PC)) for b in cases()]
+    assert len(got) == len(expected)
+    bad = [(e, g) for (e, g) in zip(expected, got) if e != g]
+    assert not bad, bad[:10]
+
+def test_decode_matches_disassemble():
+    for b in cases():
+        mem = _mem(b)
+        n = disassemble(mem, _PC)[2]
+        assert decode(mem, _PC)[0] == n == length(mem, _PC), b.hex()
+
+def test_decode_all():
+    mem = bytearray(random.Random(1).randbytes(4096))
+    (lengths, flows, conds, targets) = decodeAll(mem)
+    for pc in range(len(mem)-4):
+        (n, flow, target, cond) = decode(mem, pc)
+        assert (lengths[pc], flows[pc], conds[pc]) == (n, flow, cond), pc
+        if target >= 0:
+            assert targets[pc] == target, pc
+
+def test_timing():
+    assert timing(_mem(b'\x00'), _PC) == ((4, 4), (1, 1))
+    # djnz: 13 T-states taken, 8 not taken
+    assert timing(_mem(b'\x10\xfe'), _PC)[0] == (13, 8)
+    assert timing(_mem(b'\xdd\xcb\x05\x46'), _PC)[0] == (20, 20)
+
+def test_cpc_nops():
+    # (T-states, CPC NOPs) as (taken, not taken) pairs, the gate array
+    # stretching some instructions past the T-states rounded up to 4
+    for (code, t) in (('20fe', ((12, 7), (3, 2))), ('10fe', ((13, 8), (4, 3))), ('c0', ((11, 5), (4, 2))),
+                      ('c40000', ((17, 10), (5, 3))), ('edb0', ((21, 16), (6, 5))), ('c5', ((11, 11), (4, 4))),
+                      ('220000', ((16, 16), (5, 5))), ('e3', ((19, 19), (6, 6))), ('ed79', ((12, 12), (4, 4))),
+                      ('dd7e00', ((19, 19), (5, 5))), ('ddcb0046', ((20, 20), (6, 6))), ('c9', ((10, 10), (3, 3)))):
+        assert timing(_mem(bytes.fromhex(code)), _PC) == t, code
+
+def test_masked():
+    # call nn, jr e and ld a,n: only the adress operands are zeroed
+    mem = _mem(b'\xcd\x34\x12\x18\x05\x3e\x07')
+    assert masked(mem, _PC, _PC+7) == b'\xcd\x00\x00\x18\x00\x3e\x07'
+
+if __name__ == '__main__':
+    import importlib.util
+    import sys
+    spec = importlib.util.spec_from_file_location('z80da_original', sys.argv[1])
+    original = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(original)
+    with gzip.open(_baseline, 'wt') as f:
+        for b in cases():
+            f.write(_line(b, original.disassemble(_mem(b), _PC))+'\n')
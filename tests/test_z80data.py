@@ -0,0 +1,75 @@
+"""
+Data classification tests.
+"""
+import contextlib
+import io
+import os
+import random
+import subprocess
+import sys
+import time
+
+from z80data import classify, UNKNOWN, FILL, TEXT, POINTERS, COMPRESSED
+from z80smart import Disassembler
+import z80bench
+
+_nowhere = bytes(65536)
+
+def _kinds(data, targets=_nowhere):
+    return [(a, b, k) for (a, b, k) in classify(data, 0, len(data), targets)]
+
+def test_fill_and_text():
+    data = b'\x01\x02' + b'\xaa'*10 + b'Hello world' + b'\x03'
+    assert _kinds(data) == [(0, 2, UNKNOWN), (2, 12, FILL), (12, 23, TEXT), (23, 24, UNKNOWN)]
+
+def test_strings_ended_by_bit_7():
+    # Back to back CPC strings stay apart, each ending with its bit 7 character
+    assert _kinds(b'abcd\xe4efghi') == [(0, 5, TEXT), (5, 10, TEXT)]
+    assert _kinds(b'Hell\xefWorld\xa1xx') == [(0, 5, TEXT), (5, 11, TEXT), (11, 13, UNKNOWN)]
+
+def test_strings_ended_by_bit_7_asm():
+    d = Disassembler(platform='none')
+    d.load(b'\xc9Hell\xefWorld\xa1Again', 0x4000)
+    with contextlib.redirect_stdout(io.StringIO()):
+        d.trace([0x4000])
+    f = io.StringIO()
+    d.emit_asm(f)
+    assert '  db "Hell",#ef\n' in f.getvalue()
+    assert '  db "World",#a1\n' in f.getvalue()
+    assert d.verify() == []
+
+def test_pointers():
+    targets = bytearray(65536)
+    targets[0x4000:0x8000] = bytes((1,))*0x4000
+    targets[0x4100] = targets[0x4200] = 2
+    table = bytes((0x00, 0x41, 0x00, 0x42, 0x50, 0x45))
+    assert _kinds(b'\xff' + table + b'\xff', targets) == [(0, 1, UNKNOWN), (1, 7, POINTERS), (7, 8, UNKNOWN)]
+    # Less than half to code: not a table
+    table = bytes((0x00, 0x41, 0x50, 0x85, 0x60, 0x85))
+    assert _kinds(table, targets) == [(0, 6, UNKNOWN)]
+
+def test_compressed():
+    data = random.Random(1).randbytes(256)
+    assert [k for (a, b, k) in _kinds(data)] == [COMPRESSED]
+
+def test_full_memory_is_linear():
+    # A whole 64Kb memory where every word points inside the binary
+    data = random.Random(2).randbytes(65536)
+    t = time.perf_counter()
+    classify(data, 0, len(data), bytes((1,))*65536)
+    assert time.perf_counter()-t < 2.0
+
+def test_pipeline_twice_with_state(tmp_path):
+    # The second run reloads the state saved by the first one
+    (org, image, routines) = z80bench.corpus()['snapshot']
+    binary = tmp_path / 'snapshot.bin'
+    binary.write_bytes(image)
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'z80-smart-disassembler.py')
+    args = [sys.executable, script, '-i', str(binary), '-O', '0', '-T', '-S', str(tmp_path / 'snapshot.st'), '-a'] + ['%x' % a for a in routines]
+    outputs = []
+    for run in range(2):
+        p = subprocess.run(args, capture_output=True, text=True)
+        assert p.returncode == 0, p.stderr
+        outputs.append((p.stdout, (tmp_path / 'snapshot.bin.asm').read_text(), (tmp_path / 'snapshot.bin.reg').read_text()))
+    assert 'Analysis state loaded' in outputs[1][0]
+    assert outputs[1][1:] == outputs[0][1:]
@@ -0,0 +1,61 @@
+"""
+Binary diff tests: start adresses, exclusions and symbols of a version
+are found again in the next one, where code was inserted.
+"""
+from z80asm import assemble
+from z80smart import Disassembler
+import z80diff
+
+SOURCE = """
+  org #4000
+start:
+  call init
+  ld hl,table
+  call show
+  jp start
+init:
+  di
+  ld sp,#c000
+  ld a,2
+  call #bc0e
+  ret
+{}
+show:
+  ld a,(hl)
+  or a
+  ret z
+  call #bb5a
+  inc hl
+  jr show
+table:
+  db "Hello world",0
+"""
+
+INSERTED = """
+wait:
+  ld b,200
+loop:
+  halt
+  djnz loop
+  ret
+"""
+
+def _load(source):
+    symbols = {}
+    (org, data) = assemble(source.splitlines(), symbols)
+    d = Disassembler()
+    d.load(data, org)
+    return (d, symbols)
+
+def test_carry():
+    (old, oldSymbols) = _load(SOURCE.format(''))
+    (new, newSymbols) = _load(SOURCE.format(INSERTED))
+    symbols = [('show', oldSymbols['show'])]
+    (diff, starts, excluded, names, lost) = z80diff.carry(old, new, [0x4000], [oldSymbols['table']], symbols)
+    assert starts == [0x4000]
+    assert excluded == [newSymbols['table']]
+    assert names == [('show', newSymbols['show'])]
+    assert lost == []
+    status = {o: s for (s, o, n) in diff.functions if o is not None}
+    assert status[oldSymbols['show']] == z80diff.MOVED
+    assert status[oldSymbols['init']] == z80diff.UNCHANGED
@@ -0,0 +1,117 @@
+"""
+Emulator tests: small programs, assembled with z80asm, run from #4000
+until they return.
+"""
+from z80asm import assemble
+from z80emu import CPU, A, B, C, D, E, H, L, F, ALT, CF, ZF, HF, NF, HALT
+
+def run(source, limit=100000, symbols=None):
+    lines = ['  org #4000'] + [l if l.endswith(':') else '  '+l for l in source.strip().split('\n')]
+    (start, code) = assemble(lines, symbols)
+    mem = bytearray(65536)
+    mem[start:start+len(code)] = code
+    cpu = CPU(mem, start, start+len(code))
+    (pc, n) = cpu.run(start, limit)
+    assert pc == cpu.exit
+    return cpu
+
+def test_djnz():
+    # 11*13 by addition
+    cpu = run('ld b,11\nxor a\nloop:\nadd a,13\ndjnz loop\nret')
+    assert cpu.regs[A] == 143 and cpu.regs[B] == 0
+
+def test_ldir():
+    cpu = run("""
+ld hl,#8000
+ld de,#8001
+ld bc,#ff
+ld (hl),#55
+ldir
+ld hl,#9000
+ld (hl),1
+inc hl
+ld (hl),2
+ld hl,#9000
+ld de,#9002
+ld bc,6
+ldir
+ld a,(#9007)
+ret""")
+    assert cpu.regs[A] == 2
+    assert cpu.mem[0x8000:0x8100] == bytes((0x55,))*0x100 and cpu.mem[0x8100] == HALT
+    assert list(cpu.mem[0x9000:0x9008]) == [1, 2]*4
+    assert cpu.regs[B] == cpu.regs[C] == 0
+
+def test_daa():
+    cpu = run('ld a,#19\nadd a,#28\ndaa\nld b,a\nld a,#47\nsub #19\ndaa\nret')
+    assert cpu.regs[B] == 0x47 and cpu.regs[A] == 0x28
+
+def test_indexed():
+    cpu = run("""
+ld ix,#8000
+ld (ix+5),#81
+set 1,(ix+5)
+res 7,(ix+5)
+ld a,(ix+5)
+ld iy,#8010
+ld (iy-1),a
+ld b,(iy-1)
+ld ixl,3
+ld c,ixl
+ld ixl,0
+rlc (ix+5)
+ld d,(ix+5)
+ret""")
+    assert cpu.regs[A] == 3 and cpu.regs[B] == 3 and cpu.regs[C] == 3 and cpu.regs[D] == 6
+
+def test_jp_hl_targets():
+    symbols = {}
+    cpu = run("""
+ld a,1
+add a,a
+ld e,a
+ld d,0
+ld hl,table
+add hl,de
+ld a,(hl)
+inc hl
+ld h,(hl)
+ld l,a
+jump:
+jp (hl)
+r0:
+ld a,10
+ret
+r1:
+ld a,20
+ret
+table:
+dw r0,r1""", symbols=symbols)
+    assert cpu.regs[A] == 20
+    assert cpu.indirect == {symbols['jump']: {symbols['r1']}}
+
+def test_flags():
+    cpu = run('ld hl,#1000\nld de,1\nscf\nsbc hl,de\nret')
+    assert (cpu.regs[H] << 8 | cpu.regs[L]) == 0x0ffe
+    assert cpu.regs[F] & HF and cpu.regs[F] & NF and not cpu.regs[F] & CF
+    cpu = run('ld hl,#ffff\nld de,1\nand a\nadc hl,de\npush af\npop bc\nexx\nret')
+    assert cpu.regs[ALT+C] & ZF and cpu.regs[ALT+C] & CF
+
+def test_call_cpir():
+    cpu = run("""
+ld a,5
+call sub1
+ld hl,text
+ld bc,10
+ld a,'c'
+cpir
+ret
+sub1:
+inc a
+ld e,a
+ret
+text:
+db "abcdef"
+""")
+    assert cpu.regs[E] == 6
+    assert (cpu.regs[B] << 8 | cpu.regs[C]) == 7
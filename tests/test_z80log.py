@@ -0,0 +1,80 @@
+"""
+Execution log tests: every format and chunking gives the naive set of adresses.
+"""
+import contextlib
+import gzip
+import io
+import random
+
+import pytest
+
+import z80log
+from z80smart import Disassembler
+
+def _pcs(seed=1, n=20000):
+    # Loops run many times, with a few adresses in between
+    rnd = random.Random(seed)
+    loops = [[rnd.randrange(0x4000, 0x8000) for i in range(rnd.randint(1, 40))] for j in range(20)]
+    res = []
+    while len(res)<n:
+        if rnd.random()<0.1:
+            res.append(rnd.randrange(65536))
+        else:
+            res += rnd.choice(loops)*rnd.randint(1, 50)
+    return res
+
+def _text(pcs, newline='\n'):
+    formats = ('%04x', '#%04X', '$%x', '&%04x', '0x%04x', '%04Xh', '%x:')
+    return ''.join(formats[i % len(formats)] % pc + newline for (i, pc) in enumerate(pcs)).encode()
+
+def _binary(pcs):
+    return b''.join(pc.to_bytes(2, 'little') for pc in pcs)
+
+@pytest.fixture(params=[1 << 24, 1000, 999])
+def chunks(request, monkeypatch):
+    monkeypatch.setattr(z80log, 'chunkSize', request.param)
+    monkeypatch.setattr(z80log, 'sampleGroups', 64)
+
+# A tight loop, repeated 64 bit groups, and 3 adresses left after them
+_loop = [0x4000, 0x4003, 0x4004, 0x4006, 0x4008, 0x400a, 0x400b, 0x400d]*3000 + [0x5000, 0x5001, 0x5002]
+
+@pytest.mark.parametrize('kind', ['text', 'crlf', 'binary'])
+@pytest.mark.parametrize('compressed', [False, True])
+@pytest.mark.parametrize('pcs', [_pcs(), _loop], ids=['mixed', 'loop'])
+def test_read_log(tmp_path, chunks, kind, compressed, pcs):
+    data = _binary(pcs) if kind=='binary' else _text(pcs, '\r\n' if kind=='crlf' else '\n')
+    name = tmp_path / ('pc.log.gz' if compressed else 'pc.log')
+    name.write_bytes(gzip.compress(data) if compressed else data)
+    assert z80log.guessFormat(str(name)) == ('binary' if kind=='binary' else 'text')
+    (executed, size) = z80log.readLog(str(name))
+    assert size == len(data)
+    naive = bytearray(65536)
+    for pc in pcs:
+        naive[pc] = 1
+    assert executed == naive
+
+def test_parse_adress():
+    for t in (b'4000', b'#4000', b'$4000', b'&4000', b'0x4000', b'4000h', b'4000:'):
+        assert z80log.parseAdress(t) == 0x4000
+    for t in (b'', b'#', b'12345', b'40g0'):
+        with pytest.raises(ValueError):
+            z80log.parseAdress(t)
+
+def test_odd_binary_log(tmp_path):
+    name = tmp_path / 'pc.bin'
+    name.write_bytes(b'\x00\x40\x01')
+    with pytest.raises(ValueError):
+        z80log.readLog(str(name), 'binary')
+
+def test_import_log(tmp_path):
+    # #4000 jp (hl), #4001 nop / ret: only found from the log
+    name = tmp_path / 'pc.log'
+    name.write_bytes(_text([0x4000, 0x4001, 0x4002, 0x9000]))
+    d = Disassembler(platform='none')
+    d.load(bytes.fromhex('e9' '00' 'c9'), 0x4000)
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert d.importLog(str(name)) == 3
+        d.trace([0x4000])
+    assert d.codeBytes() == 3
+    assert d.executed[0x9000] == 1
+    assert d.starts == [0x4000]
@@ -0,0 +1,29 @@
+"""
+Firmware lookup tests.
+"""
+from z80platform import callTarget, firmware, platforms
+from z80cpc import checkFirmwareVector
+
+def test_call_target():
+    for s in ('  call #bb5a', '  CALL &BB5A', '  call nz,$bb5a', '  call 0xbb5a ; print', '  call 0bb5ah'):
+        assert callTarget(s) == 0xbb5a
+    for s in ('  jp #bb5a', '  call label', '  ld hl,#bb5a', '  call #zz'):
+        assert callTarget(s) is None
+
+def test_firmware_vector():
+    assert checkFirmwareVector('  call #BB5A') == 'TXT_OUTPUT'
+    assert checkFirmwareVector('  call z,&bb5a') == 'TXT_OUTPUT'
+    # Firmware adresses in other operands are not calls
+    assert checkFirmwareVector('  ld hl,#BB5A') is False
+    assert checkFirmwareVector('  call #4000 ; #BB5A') is False
+
+def test_platform_tables():
+    assert firmware('none') == {}
+    cpc6128 = firmware('cpc6128')
+    assert cpc6128[0xbb5a] == 'TXT_OUTPUT'
+    assert firmware('cpc6128') is cpc6128
+    # The 464 lacks the jumpblock entries added by the 664
+    cpc464 = firmware('cpc464')
+    assert 0xbd3a in cpc6128 and 0xbd3a not in cpc464
+    assert set(cpc464) < set(cpc6128)
+    assert set(firmware(p) is not None for p in platforms) == {True}
@@ -0,0 +1,93 @@
+"""
+Signature tests: routines of a labelled source are found, under their
+names, in a binary where they were assembled at other adresses.
+"""
+import contextlib
+import io
+
+from z80asm import assemble
+from z80smart import Disassembler
+import z80sig
+
+LIBRARY = """
+  org #8000
+decrunch:
+  ld a,(hl)
+  inc hl
+  or a
+  ret z
+  ld b,a
+  and #80
+  jr z,literal
+  ld a,(hl)
+  inc hl
+copy:
+  ld (de),a
+  inc de
+  djnz copy
+  jr decrunch
+literal:
+  ld a,(hl)
+  ld (de),a
+  inc hl
+  inc de
+  djnz literal
+  jr decrunch
+player:
+  ld ix,#9000
+  ld a,(ix+0)
+  call nz,next
+  ld (ix+1),a
+  ld hl,#9100
+  ld de,#9200
+  ld bc,16
+  ldir
+  ret
+next:
+  inc a
+  ret
+"""
+
+def _game():
+    """
+    The library assembled at #4100, after a main loop calling it.
+    """
+    lines = ['  org #4000', 'main:', '  ld hl,#5000', '  ld de,#c000', '  call #4100',
+             '  call #4100+player-decrunch', '  jp main', '  ds #4100-$,0']
+    lines += [l for l in LIBRARY.splitlines() if 'org' not in l]
+    symbols = {}
+    (org, data) = assemble(lines, symbols)
+    d = Disassembler(platform='none')
+    d.load(data, org)
+    with contextlib.redirect_stdout(io.StringIO()):
+        d.trace([org])
+    return (d, symbols)
+
+def test_from_source():
+    sigs = z80sig.fromSource(LIBRARY.splitlines(), 'lib_')
+    names = sorted(name for (name, size) in sigs.values())
+    # next is too short to be signed
+    assert names == ['lib_decrunch', 'lib_player']
+
+def test_file(tmp_path):
+    sigs = z80sig.fromSource(LIBRARY.splitlines())
+    fileName = str(tmp_path / 'lib.sig')
+    z80sig.write(fileName, sigs)
+    s = z80sig.Signatures(fileName)
+    assert len(s) == len(sigs)
+    for (h, v) in sigs.items():
+        assert s.lookup(h) == v
+    assert s.lookup(12345) is None
+    assert sorted((h, name, size) for (h, name, size) in s.items()) == sorted((h,)+v for (h, v) in sigs.items())
+    s.close()
+    assert z80sig.Signatures(str(tmp_path / 'none.sig')).lookup(1) is None
+
+def test_match(tmp_path):
+    fileName = str(tmp_path / 'lib.sig')
+    z80sig.write(fileName, z80sig.fromSource(LIBRARY.splitlines()))
+    (d, symbols) = _game()
+    s = z80sig.Signatures(fileName)
+    assert z80sig.match(d, s) == 2
+    s.close()
+    assert d.symbols == {symbols['decrunch']: 'decrunch', symbols['player']: 'player'}
+    assert d.labels()[symbols['player']] == 'player'
@@ -0,0 +1,229 @@
+"""
+Tracer and Disassembler engine tests.
+"""
+import contextlib
+import io
+import json
+
+import pytest
+
+from z80smart import Disassembler, Stats, runs, mergeRegions
+import z80bench
+
+def _trace(image, org, starts, superset=False):
+    d = Disassembler(platform='none', superset=superset)
+    d.load(image, org)
+    with contextlib.redirect_stdout(io.StringIO()):
+        d.trace(starts)
+    return d
+
+@pytest.mark.parametrize('superset', [False, True])
+def test_instruction_at_the_top_of_memory(superset):
+    # LD BC,nn at #fffe would run past #ffff
+    d = _trace(b'\x01\x00', 0xfffe, [0xfffe], superset)
+    assert d.codeBytes() == 0
+    # while a complete one is traced
+    d = _trace(b'\x00\x00', 0xfffe, [0xfffe], superset)
+    assert d.codeBytes() == 2
+
+def _state(d):
+    return {name: getattr(d, name) for name in ('mem', 'memcode', 'oplen', 'flow', 'cond', 'target', 'jpto', 'seen', 'starts', 'indirect', 'executed', 'symbols', 'data', 'org')}
+
+def test_load_replaces_the_previous_binary():
+    # CALL #5000 / RET, then a smaller binary elsewhere
+    first = b'\xcd\x00\x50\xc9' + bytes(0x1000-4) + b'\x3e\x01\xc9'
+    second = b'\x00\x00\xc9'
+    d = _trace(first, 0x4000, [0x4000])
+    with contextlib.redirect_stdout(io.StringIO()):
+        d.emulate([0x4000], 100)
+    d.symbols[0x5000] = 'routine'
+    d.load(second, 0x8000)
+    with contextlib.redirect_stdout(io.StringIO()):
+        d.trace([0x8000])
+    assert _state(d) == _state(_trace(second, 0x8000, [0x8000]))
+    f = io.StringIO()
+    d.emit_asm(f)
+    assert 'routine' not in f.getvalue() and '#4000' not in f.getvalue()
+
+@pytest.mark.parametrize('image', ['code', 'random'])
+def test_incremental_trace(image):
+    # Tracing A then B covers exactly what tracing A and B at once does
+    (org, data, starts) = z80bench.corpus()[image]
+    (a, b) = (starts[::2], starts[1::2])
+    d = Disassembler(platform='none')
+    d.load(data, org)
+    with contextlib.redirect_stdout(io.StringIO()):
+        count = d.trace(a)
+        count += d.trace(b)
+    full = _trace(data, org, a+b)
+    # The queued adresses depend on the tracing order, not the coverage
+    (inc, once) = (_state(d), _state(full))
+    del inc['seen'], once['seen']
+    assert inc == once
+    # and instructions are only decoded once
+    assert count == full.instructionCount()
+    assert d.regions() == full.regions()
+
+def _disark():
+    # LD A,1 / CALL TXT_OUTPUT / RET, then a string
+    d = Disassembler(platform='cpc6128')
+    d.load(bytes.fromhex('3e01cd5abbc9') + b'Hello world', 0x4000)
+    with contextlib.redirect_stdout(io.StringIO()):
+        d.trace([0x4000])
+    lines = ['  org #4000\n', 'start_4000 ld a,#01\n', '  call #bb5a\n', '  ret\n', 'data4006\n']
+    lines += ['  db %d\n' % c for c in b'Hello world']
+    return (d, lines)
+
+def test_disark_postprocessing(tmp_path):
+    (d, lines) = _disark()
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        asm = ''.join(d.disarkLines(lines))
+    assert asm == ('  org #4000\n'
+                   'start_4000:\n'
+                   '  ld a,#01\n'
+                   '  call #bb5a ; Call to firmware: TXT_OUTPUT\n'
+                   '  ret\n'
+                   'data4006:\n'
+                   '  \n'
+                   '  db #48,#65,#6c,#6c,#6f,#20,#77,#6f ;Hello.wo\n'
+                   '  db #72,#6c,#64 ;rld\n')
+    assert out.getvalue() == ''
+    # Streamed from the file by chunks of lines
+    tmp = tmp_path / 'disark.asm'
+    tmp.write_text(''.join(lines))
+    for chunk in (1, 3, 4096):
+        f = io.StringIO()
+        d.postprocess_disark(str(tmp), f, chunk)
+        assert f.getvalue() == asm
+
+def test_disark_drift():
+    # A db value that does not match memory is kept, with a warning
+    (d, lines) = _disark()
+    lines[5] = '  db #00\n'
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        asm = ''.join(d.disarkLines(lines))
+    assert 'Warning: Disark output does not match memory at #4006' in out.getvalue()
+    assert '  db #00,#65,#6c,' in asm
+
+def _perByteRegions(d):
+    # The former region computation, walking the coverage byte by byte
+    memcode = d.memcode
+    oplen = d.oplen
+    res = []
+    curZoneCodeType = True
+    curZoneStart = 0
+    curZoneEnd = 0
+    i = 0
+    while i<len(memcode):
+        t = memcode[i]>0
+        if t != curZoneCodeType:
+            if curZoneCodeType==False:
+                res.append((curZoneStart, curZoneEnd+1))
+            curZoneStart = i
+            curZoneCodeType = t
+        if t==True and oplen[i]>0:
+            curZoneEnd = i+oplen[i]-1
+            i += oplen[i]
+        else:
+            curZoneEnd = i
+            i += 1
+    if curZoneCodeType==False:
+        res.append((curZoneStart, curZoneEnd+1))
+    return res
+
+@pytest.mark.parametrize('image', sorted(z80bench.corpus()))
+def test_regions_match_per_byte_walk(image):
+    (org, data, starts) = z80bench.corpus()[image]
+    d = _trace(data, org, starts)
+    reg = _perByteRegions(d)
+    assert d.regions() == reg
+    f = io.StringIO()
+    d.emit_regions(f)
+    written = [l.split()[1] for l in f.getvalue().splitlines() if l.startswith('DisarkByteRegion')]
+    assert written == ['#%02x' % a for (start, end) in reg for a in (start, end)][:-1] + ['#%02x' % (reg[-1][1]-1)]
+    # Excluded adresses are data too
+    d = Disassembler(platform='none')
+    d.load(data, org)
+    d.exclude(range(org+7, org+len(data), 61))
+    with contextlib.redirect_stdout(io.StringIO()):
+        d.trace(starts)
+    assert d.regions() == _perByteRegions(d)
+
+def test_runs_and_merge():
+    assert runs(b'') == []
+    assert runs(b'\x01\x01') == []
+    assert runs(b'\x00\x01\x01\x00\x00') == [(0, 1), (3, 5)]
+    reg = [(0, 2), (4, 6), (10, 12)]
+    assert mergeRegions(reg, 0) == reg
+    assert mergeRegions(reg, 3) == [(0, 6), (10, 12)]
+    assert mergeRegions(reg, 5) == [(0, 12)]
+
+def test_stats():
+    s = Stats()
+    for i in range(3):
+        with s.phase('trace'):
+            pass
+    try:
+        with s.phase('asm'):
+            raise ValueError
+    except ValueError:
+        pass
+    s.add('pushes', 2)
+    s.add('pushes', 3)
+    s.peak('peak', 4)
+    s.peak('peak', 1)
+    d = s.asdict()
+    assert sorted(d['times']) == ['asm', 'trace']
+    assert d['counters'] == {'pushes': 5, 'peak': 4}
+
+def test_statistics():
+    # #4000 call #4006 / call #4006, #4006 ret: the second call target is a duplicate
+    d = _trace(bytes.fromhex('cd0640' 'cd0640' 'c9') + b'data', 0x4000, [0x4000])
+    res = json.loads(json.dumps(d.statistics()))
+    c = res['counters']
+    assert (c['instructions'], c['code_bytes'], c['data_regions']) == (3, 7, 2)
+    assert (c['instructions_decoded'], c['worklist_pushes'], c['worklist_pops']) == (3, 2, 2)
+    assert c['duplicate_targets'] == 1 and c['worklist_peak'] == 1
+    # Counters add up over incremental traces
+    with contextlib.redirect_stdout(io.StringIO()):
+        d.trace([0x4000, 0x4006])
+    assert d.statistics()['counters']['duplicate_targets'] == 3
+
+# #4000 ld hl,#4010 / ld e,(hl) / inc hl / ld d,(hl) / ex de,hl / jp (hl)
+# #4010 dw #4020,#4028,#4030,#4038, each handler on 8 bytes
+_dispatch = bytes.fromhex('211040' '5e' '23' '56' 'eb' 'e9') + b'\xff'*8
+_table = bytes.fromhex('2040' '2840' '3040' '3840') + b'\xff'*8
+_handlers = [bytes.fromhex('3e01320080c9'), bytes.fromhex('06020e03c9'), bytes.fromhex('2100c036ffc9'), bytes.fromhex('af320180c9')]
+
+def _jumpTable(handlers):
+    return _dispatch + _table + b''.join(h.ljust(8, b'\xff') for h in handlers)
+
+def test_pointer_table():
+    d = _trace(_jumpTable(_handlers), 0x4000, [0x4000])
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert d.scanPointers(5) == []
+        assert d.scanPointers() == [0x4020, 0x4028, 0x4030, 0x4038]
+    assert all(d.memcode[a]==1 for a in (0x4020, 0x4028, 0x4030, 0x4038))
+    # The targets are not start adresses
+    assert d.starts == [0x4000]
+
+def test_pointer_table_to_junk():
+    # ld b,b in one handler: its table is not trusted
+    handlers = list(_handlers)
+    handlers[1] = bytes.fromhex('060240c9')
+    d = _trace(_jumpTable(handlers), 0x4000, [0x4000])
+    assert d.pointerTables() == []
+
+def test_pointer_scan_on_data():
+    # Data only buffers give no table to trace
+    sprites = b''.join(z80bench.dataImage(s) for s in range(4))
+    mixed = b''.join(z80bench.randomImage(s) if s%2 else z80bench.dataImage(s) for s in range(4))
+    for image in (sprites, mixed):
+        d = _trace(image, 0, [])
+        with contextlib.redirect_stdout(io.StringIO()):
+            assert d.scanPointers() == []
+        assert d.codeBytes() == 0
+    # nor do the prefixed instructions and random bytes around traced code
+    (org, image, starts) = z80bench.corpus()['snapshot']
+    d = _trace(image, org, starts)
+    assert d.pointerTables() == []
@@ -0,0 +1,79 @@
+"""
+Analysis state tests: stale state detection, reload and incremental tracing.
+"""
+import contextlib
+import io
+
+import z80bench
+import z80state
+from z80smart import Disassembler
+
+_options = (0x4000, None, [], None, False, False)
+
+def _analyze(image, starts, state=None, options=_options):
+    d = Disassembler(platform='none')
+    d.load(image, 0x4000)
+    with contextlib.redirect_stdout(io.StringIO()):
+        reason = z80state.load(d, state, options, starts) if state else None
+        d.trace(starts)
+    return (d, reason)
+
+def _outputs(d):
+    asm = io.StringIO()
+    reg = io.StringIO()
+    d.emit_asm(asm)
+    d.emit_regions(reg)
+    return (asm.getvalue(), reg.getvalue())
+
+def _code():
+    (org, image, routines) = z80bench.corpus()['code']
+    return (image, routines)
+
+def test_stale_state(tmp_path):
+    (image, routines) = _code()
+    state = str(tmp_path / 'code.st')
+    assert z80state.check(state, image, _options) == 'no state file yet'
+    (d, reason) = _analyze(image, routines)
+    z80state.save(d, state, _options)
+    assert z80state.check(state, image, _options, routines) is None
+    assert z80state.check(state, image + b'\0', _options) == 'binary changed'
+    assert z80state.check(state, image, _options[:-1] + (4,)) == 'options changed'
+    assert z80state.check(state, image, _options, routines[1:]) == 'start adresses removed'
+    # A stale state leaves the Disassembler untouched
+    d = Disassembler(platform='none')
+    d.load(image + b'\0', 0x4000)
+    assert z80state.load(d, state, _options) == 'binary changed'
+    assert d.instructionCount() == 0
+    (tmp_path / 'other.st').write_bytes(b'not a state')
+    assert z80state.check(str(tmp_path / 'other.st'), image, _options) == 'not a state file'
+    with open(state, 'r+b') as f:
+        f.truncate(1000)
+    assert z80state.check(state, image, _options) == 'truncated state file'
+
+def test_reload(tmp_path):
+    (image, routines) = _code()
+    state = str(tmp_path / 'code.st')
+    (d, reason) = _analyze(image, routines)
+    z80state.save(d, state, _options)
+    (r, reason) = _analyze(image, routines, state)
+    assert reason is None
+    # Sections are restored with the types the Disassembler allocates
+    for (name, tc) in z80state._SECTIONS:
+        assert type(getattr(r, name)) is type(getattr(Disassembler(), name))
+    assert r.starts == d.starts
+    assert _outputs(r) == _outputs(d)
+    # and saved again unchanged
+    z80state.save(r, str(tmp_path / 'again.st'), _options)
+    assert (tmp_path / 'again.st').read_bytes() == (tmp_path / 'code.st').read_bytes()
+
+def test_incremental_trace(tmp_path):
+    (image, routines) = _code()
+    state = str(tmp_path / 'code.st')
+    half = routines[:len(routines)//2]
+    (d, reason) = _analyze(image, half)
+    z80state.save(d, state, _options)
+    (r, reason) = _analyze(image, routines, state)
+    assert reason is None
+    (full, reason) = _analyze(image, routines)
+    assert r.codeBytes() == full.codeBytes() > d.codeBytes()
+    assert _outputs(r) == _outputs(full)